@@ -2,8 +2,10 @@
 
 import sys
 import re
+import heapq
 import argparse
 import logging
+import numpy as np
 
 
 def get_options():
@@ -52,20 +54,74 @@ def get_options():
     return args
 
 
-def format_hmmer_domtbl_line(line):
-    stats = []
-    stat = ""
-    for c in line:
-        if c == ' ':
-            if len(stat) > 0:
-                stats.append(str(stat))
-                stat = ""
-            else:
-                pass
-        else:
-            stat += c
-    stats.append(str(stat))
-    return stats
+def split_hmmscan_domtbl(hmmscan_domtbl, marker_domtbl_map, num_seqs, max_domain_evalue=10.0):
+    """
+    Splits the domain table of an hmmscan search against a database of many HMMs into one domain table per HMM.
+    Since hmmscan reports the HMM as the target and the sequence as the query, the target and query columns are
+    swapped so the output files are formatted like those of hmmsearch and can be parsed by DomainTableParser.
+    The sequence description is not reported by hmmscan so it is replaced with '-'.
+
+    hmmsearch conditions each domain's E-value (c-Evalue) on the number of sequences the HMM hit, whereas hmmscan
+    conditions it on the number of HMMs each sequence hit. hmmscan must therefore be run with -Z and --domZ set to
+    num_seqs, making the conditional E-values equal to the independent ones (i-Evalue = P-value * num_seqs), and with
+    a --domE large enough to report every domain hmmsearch would. Each c-Evalue is then rescaled by the number of
+    sequences the HMM hit, the domains hmmsearch would not report are removed and the rest are renumbered.
+
+    :param hmmscan_domtbl: Path to the domain table written by hmmscan
+    :param marker_domtbl_map: Dictionary mapping the HMM names to the path of the domain table to write for each
+    :param num_seqs: The number of sequences searched, which hmmscan's -Z and --domZ were set to
+    :param max_domain_evalue: The largest c-Evalue of the domains to write, matching the --domE of hmmsearch
+    :return: None
+    """
+    try:
+        domtbl_handler = open(hmmscan_domtbl, 'r')
+    except IOError:
+        logging.error("Could not open " + hmmscan_domtbl + " or file is not available for reading.\n")
+        sys.exit(9)
+
+    marker_hits = {hmm_name: list() for hmm_name in marker_domtbl_map}
+    for line in domtbl_handler:
+        if line[0] == '#':
+            continue
+        hit = line.split(None, 22)
+        if len(hit) < 22:
+            continue
+        if hit[0] not in marker_hits:
+            logging.error("Unexpected HMM '" + hit[0] + "' found in " + hmmscan_domtbl + "\n")
+            sys.exit(9)
+        marker_hits[hit[0]].append(hit[3:6] + hit[0:3] + hit[6:22] + ['-'])
+    domtbl_handler.close()
+
+    for hmm_name in marker_domtbl_map:
+        # The number of sequences hmmsearch would report for this HMM, which it conditions the domain E-values on
+        dom_z = len(set([hit[0] for hit in marker_hits[hmm_name]]))
+        kept_hits = list()
+        num_domains = dict()
+        for hit in marker_hits[hmm_name]:
+            c_evalue = float(hit[12]) * dom_z / num_seqs
+            if c_evalue <= max_domain_evalue:
+                hit[11] = "%.2g" % c_evalue
+                kept_hits.append(hit)
+                num_domains[hit[0]] = num_domains.get(hit[0], 0) + 1
+        marker_lines = list()
+        domain_nums = dict()
+        for hit in kept_hits:
+            domain_nums[hit[0]] = domain_nums.get(hit[0], 0) + 1
+            hit[9] = str(domain_nums[hit[0]])
+            hit[10] = str(num_domains[hit[0]])
+            marker_lines.append(' '.join(hit))
+
+        try:
+            marker_domtbl = open(marker_domtbl_map[hmm_name], 'w')
+        except IOError:
+            logging.error("Unable to open " + marker_domtbl_map[hmm_name] + " for writing!\n")
+            sys.exit(9)
+        marker_domtbl.write("# Split from " + hmmscan_domtbl + "\n")
+        if marker_lines:
+            marker_domtbl.write("\n".join(marker_lines) + "\n")
+        marker_domtbl.close()
+
+    return
 
 
 class HmmMatch:
@@ -105,7 +161,7 @@ class DomainTableParser(object):
     def __init__(self, dom_tbl):
         self.alignments = {}
         self.i = 0
-        self.lines = []
+        self.columns = {}
         self.size = 0
         try:
             self.commentPattern = re.compile(r'^#')
@@ -119,55 +175,95 @@ class DomainTableParser(object):
 
     def read_domtbl_lines(self):
         """
-        Function to read the lines in the domain table file,
-        skipping those matching the comment pattern
-        :return: self.lines is a list populated with the lines
+        Function to read the lines in the domain table file in a single pass, skipping those matching the comment
+        pattern, and store the fields used downstream in columns
+        :return: self.columns is a dictionary of NumPy arrays (lists for the string fields) indexed by field name
+        """
+        queries, hmm_names, descriptions = [], [], []
+        int_rows, float_rows = [], []
+        for line in self.src:
+            if line[0] == '#':
+                continue
+            hit = line.split()
+            if not hit:
+                continue
+            queries.append(hit[0])
+            hmm_names.append(hit[3])
+            descriptions.append(' '.join(hit[22:]))
+            # query_len, hmm_len, num, of, pstart, pend, qstart (env from), qend (env to)
+            int_rows.append((hit[2], hit[5], hit[9], hit[10], hit[15], hit[16], hit[19], hit[20]))
+            # Eval, full_score, cEval, acc
+            float_rows.append((hit[6], hit[7], hit[11], hit[21]))
+        self.src.close()
+
+        self.size = len(queries)
+        int_columns = np.array(int_rows, dtype=np.int64).reshape(self.size, 8).T
+        float_columns = np.array(float_rows, dtype=np.float64).reshape(self.size, 4).T
+        self.columns = {"query": queries, "hmm_name": hmm_names, "desc": descriptions,
+                        "query_len": int_columns[0], "hmm_len": int_columns[1],
+                        "num": int_columns[2], "of": int_columns[3],
+                        "pstart": int_columns[4], "pend": int_columns[5],
+                        "qstart": int_columns[6], "qend": int_columns[7],
+                        "Eval": float_columns[0], "full_score": float_columns[1],
+                        "cEval": float_columns[2], "acc": float_columns[3]}
+        return
+
+    def drop_poor_single_hits(self, min_acc, min_e, perc_aligned):
+        """
+        Removes the alignments that were not split into multiple sub-alignments ('of' == 1) and fail the thresholds
+        applied by filter_poor_hits and filter_incomplete_hits. Since these alignments are not modified by
+        format_split_alignments they can be filtered here all at once rather than one HmmMatch at a time.
+        Sub-alignments are retained because they may be scaffolded before filtering.
+        :param min_acc: Minimum mean posterior probability of the aligned residues
+        :param min_e: Maximum conditional E-value
+        :param perc_aligned: Minimum percentage of the HMM profile covered by the alignment
+        :return: The number of alignments dropped
         """
-        line = self.src.readline()
-        while line:
-            comment = self.commentPattern.match(line)
-            if not comment:
-                self.lines.append(line.strip())
-            if not line:
-                break
-            line = self.src.readline()
-        self.size = len(self.lines)
+        if self.size == 0:
+            return 0
+        perc = (self.columns["pend"] - self.columns["pstart"]) * 100 / self.columns["hmm_len"]
+        passed = (self.columns["acc"] >= min_acc) & (self.columns["cEval"] <= min_e) & (perc >= perc_aligned)
+        keep = passed | (self.columns["of"] != 1)
+        num_dropped = int(self.size - np.count_nonzero(keep))
+        if num_dropped:
+            indices = np.flatnonzero(keep)
+            for field in self.columns:
+                if isinstance(self.columns[field], list):
+                    self.columns[field] = [self.columns[field][x] for x in indices]
+                else:
+                    self.columns[field] = self.columns[field][keep]
+            self.size = len(indices)
+        return num_dropped
 
     def next(self):
         """
-        Reformat the raw lines of the domain table into
-        an easily accessible hmm_domainTable format and perform
-        QC to validate the significance of the alignments
+        Reformat the next row of the domain table columns into
+        an easily accessible hmm_domainTable format
         """
         if self.i < self.size:
-            hit = format_hmmer_domtbl_line(self.lines[self.i])
-            self.prepare_data(hit)
+            self.prepare_data(self.i)
             self.i += 1
-
-            try:
-                return self.alignments
-            except ValueError:
-                return None
+            return self.alignments
         else:
-            self.src.close()
             return None
 
-    def prepare_data(self, hit):
-        self.alignments['query'] = str(hit[0])
-        self.alignments['query_len'] = int(hit[2])
-        self.alignments['hmm_name'] = str(hit[3])
-        self.alignments['hmm_len'] = str(hit[5])
-        self.alignments['Eval'] = float(hit[6])  # Full-sequence E-value (in the case a sequence alignment is split)
-        self.alignments['full_score'] = float(hit[7])  # Full-sequence score
-        self.alignments['num'] = int(hit[9])  # HMMER is able to detect whether there are multi-hits
-        self.alignments['of'] = int(hit[10])  # This is the number of multi-hits for a query
-        self.alignments['cEval'] = float(hit[11])  # conditional E-value
-        self.alignments['pstart'] = int(hit[15])  # First position on HMM profile
-        self.alignments['pend'] = int(hit[16])  # Last position on HMM profile
-        self.alignments['qstart'] = int(hit[19])  # env coord from
-        self.alignments['qend'] = int(hit[20])  # env coord to
-        self.alignments['acc'] = float(hit[21])
-        self.alignments['desc'] = ' '.join(hit[22:])
+    def prepare_data(self, x):
+        self.alignments['query'] = self.columns["query"][x]
+        self.alignments['query_len'] = int(self.columns["query_len"][x])
+        self.alignments['hmm_name'] = self.columns["hmm_name"][x]
+        self.alignments['hmm_len'] = str(self.columns["hmm_len"][x])
+        # Full-sequence E-value (in the case a sequence alignment is split)
+        self.alignments['Eval'] = float(self.columns["Eval"][x])
+        self.alignments['full_score'] = float(self.columns["full_score"][x])  # Full-sequence score
+        self.alignments['num'] = int(self.columns["num"][x])  # HMMER is able to detect whether there are multi-hits
+        self.alignments['of'] = int(self.columns["of"][x])  # This is the number of multi-hits for a query
+        self.alignments['cEval'] = float(self.columns["cEval"][x])  # conditional E-value
+        self.alignments['pstart'] = int(self.columns["pstart"][x])  # First position on HMM profile
+        self.alignments['pend'] = int(self.columns["pend"][x])  # Last position on HMM profile
+        self.alignments['qstart'] = int(self.columns["qstart"][x])  # env coord from
+        self.alignments['qend'] = int(self.columns["qend"][x])  # env coord to
+        self.alignments['acc'] = float(self.columns["acc"][x])
+        self.alignments['desc'] = self.columns["desc"][x]
 
 
 def detect_orientation(q_i, q_j, r_i, r_j):
@@ -205,58 +301,70 @@ def scaffold_subalignments(fragmented_alignment_data):
     # so we're allowing for some 'wobble' in how long or short paralogs could be
     seq_length_wobble = 1.2
     accepted_states = ["overlap", "satellite"]
-    i = j = 0
-    while i < len(fragmented_alignment_data):
-        base_aln = fragmented_alignment_data[i]
-        while j < len(fragmented_alignment_data):
-            if j != i:
-                projected_aln = fragmented_alignment_data[j]
-                # Check for sub- or super-sequence orientation on the query sequence
-                q_orientation = detect_orientation(base_aln.start, base_aln.end,
-                                                   projected_aln.start, projected_aln.end)
-                # Check for redundant profile HMM coverage
-                p_orientation = detect_orientation(base_aln.pstart, base_aln.pend,
-                                                   projected_aln.pstart, projected_aln.pend)
-                a_new_start = min([base_aln.start, projected_aln.start])
-                a_new_end = max([base_aln.end, projected_aln.end])
-                if q_orientation in accepted_states and p_orientation in accepted_states:
-                    if float(a_new_end - a_new_start) < float(seq_length_wobble * int(base_aln.hmm_len)):
-                        base_aln.start = a_new_start
-                        base_aln.end = a_new_end
-                        base_aln.pstart = min([base_aln.pstart, projected_aln.pstart])
-                        base_aln.pend = max([base_aln.pend, projected_aln.pend])
-                        if base_aln.num > 1:
-                            base_aln.num = min([base_aln.num, projected_aln.num])
-                        base_aln.of -= 1
-                        base_aln.ceval = min([base_aln.ceval, projected_aln.ceval])
-                        fragmented_alignment_data.pop(j)
-                        j -= 1
-                else:
-                    pass
-            j += 1
-        i += 1
-        # # For debugging:
-        # for aln in fragmented_alignment_data:
-        #     aln.print_info()
+    if not fragmented_alignment_data:
+        return fragmented_alignment_data
+    # Each sub-alignment is compared to the first one, which grows as others are merged into it,
+    # in the order they were reported in the domain table
+    base_aln = fragmented_alignment_data[0]
+    unmerged = [base_aln]
+    for projected_aln in fragmented_alignment_data[1:]:
+        # Check for sub- or super-sequence orientation on the query sequence
+        q_orientation = detect_orientation(base_aln.start, base_aln.end,
+                                           projected_aln.start, projected_aln.end)
+        # Check for redundant profile HMM coverage
+        p_orientation = detect_orientation(base_aln.pstart, base_aln.pend,
+                                           projected_aln.pstart, projected_aln.pend)
+        a_new_start = min([base_aln.start, projected_aln.start])
+        a_new_end = max([base_aln.end, projected_aln.end])
+        if q_orientation in accepted_states and p_orientation in accepted_states and \
+                float(a_new_end - a_new_start) < float(seq_length_wobble * int(base_aln.hmm_len)):
+            base_aln.start = a_new_start
+            base_aln.end = a_new_end
+            base_aln.pstart = min([base_aln.pstart, projected_aln.pstart])
+            base_aln.pend = max([base_aln.pend, projected_aln.pend])
+            if base_aln.num > 1:
+                base_aln.num = min([base_aln.num, projected_aln.num])
+            base_aln.of -= 1
+            base_aln.ceval = min([base_aln.ceval, projected_aln.ceval])
+        else:
+            unmerged.append(projected_aln)
+    # Replace the contents rather than the list since the caller counts the sub-alignments that were merged
+    fragmented_alignment_data[:] = unmerged
+    # # For debugging:
+    # for aln in fragmented_alignment_data:
+    #     aln.print_info()
     return fragmented_alignment_data
 
 
 def orient_alignments(fragmented_alignment_data):
+    """
+    Determines the orientation of the sub-alignments relative to each other on the query sequence.
+    Only the pairs that intersect are found, by sweeping over the alignments sorted by their start positions,
+    since 'satellite' pairs are ignored by consolidate_subalignments.
+    Each pair is oriented with the alignment found first in the domain table as the base,
+    and the pairs of alignments that are adjacent in the domain table are also oriented the other way around.
+    :param fragmented_alignment_data: List of HmmMatch instances for the sub-alignments of a query
+    :return: Dictionary with (base, projected) tuples of list indices as keys and their orientation as values
+    """
     alignment_relations = dict()
-    i = 0
-    j = 0
-    while i < len(fragmented_alignment_data):
-        initial_start = fragmented_alignment_data[i].start
-        initial_stop = fragmented_alignment_data[i].end
-        while j < len(fragmented_alignment_data):
-            if j != i:
-                alignment_relations[(i, j)] = detect_orientation(initial_start,
-                                                                 initial_stop,
-                                                                 fragmented_alignment_data[j].start,
-                                                                 fragmented_alignment_data[j].end)
-            j += 1
-        j = i
-        i += 1
+    active = list()
+    for j in sorted(range(len(fragmented_alignment_data)), key=lambda x: fragmented_alignment_data[x].start):
+        projected_aln = fragmented_alignment_data[j]
+        # Drop the alignments that end before this one starts; they cannot intersect any later alignments either
+        while active and active[0][0] < projected_aln.start:
+            heapq.heappop(active)
+        for _, i in active:
+            base, projected = min(i, j), max(i, j)
+            alignment_relations[(base, projected)] = detect_orientation(fragmented_alignment_data[base].start,
+                                                                        fragmented_alignment_data[base].end,
+                                                                        fragmented_alignment_data[projected].start,
+                                                                        fragmented_alignment_data[projected].end)
+            if projected - base == 1:
+                alignment_relations[(projected, base)] = detect_orientation(fragmented_alignment_data[projected].start,
+                                                                            fragmented_alignment_data[projected].end,
+                                                                            fragmented_alignment_data[base].start,
+                                                                            fragmented_alignment_data[base].end)
+        heapq.heappush(active, (projected_aln.end, j))
     return alignment_relations
 
 
@@ -285,7 +393,7 @@ def consolidate_subalignments(fragmented_alignment_data, alignment_relations, di
     while x < len(fragmented_alignment_data):
         if x not in alignments_to_defecate:
             hmm_match = fragmented_alignment_data[x]
-            query_header_strand = ' '.join([hmm_match.orf, hmm_match.desc]) + \
+            query_header_strand = ' '.join([hmm_match.orf, hmm_match.desc]) + '_' + hmm_match.target_hmm + \
                                   '_' + str(hmm_match.num) + '_' + str(hmm_match.of)
             distinct_alignments[query_header_strand] = hmm_match
         x += 1
@@ -351,8 +459,9 @@ def format_split_alignments(domain_table, num_fragmented, glued, multi_alignment
                                                             distinct_alignments)
             fragmented_alignment_data.clear()
 
-        # Carry on with this new alignment
-        query_header_desc_aln = ' '.join([hmm_match.orf, hmm_match.desc]) + \
+        # Carry on with this new alignment. The target HMM is part of the key so a query's alignments to different HMMs
+        # are all kept for parse_domain_tables to choose between
+        query_header_desc_aln = ' '.join([hmm_match.orf, hmm_match.desc]) + '_' + hmm_match.target_hmm + \
                                 '_' + str(hmm_match.num) + '_' + str(hmm_match.of)
         query_header = ' '.join([hmm_match.orf, hmm_match.desc])
         if not hmm_match.orf:
@@ -13,7 +13,7 @@ cmd_folder = os.path.realpath(os.path.abspath(os.path.split(inspect.getfile(insp
 if cmd_folder not in sys.path:
     sys.path.insert(0, cmd_folder)
 sys.path.insert(0, cmd_folder + os.sep + ".." + os.sep)
-from entish import get_node
+from entish import map_internal_nodes_leaves
 from jplace_utils import jplace_parser
 from classy import TreeProtein
 from utilities import annotate_internal_nodes, convert_outer_to_inner_nodes
@@ -172,46 +172,6 @@ def names_for_nodes(clusters, node_map, taxa_map):
     return node_only_clusters
 
 
-def create_node_map(jplace_tree_string):
-    """
-    Loads a mapping between all nodes (internal and leaves) and all leaves
-    :return:
-    """
-    no_length_tree = re.sub(":[0-9.]+{", ":{", jplace_tree_string)
-    node_map = dict()
-    node_stack = list()
-    leaf_stack = list()
-    x = 0
-    num_buffer = ""
-    while x < len(no_length_tree):
-        c = no_length_tree[x]
-        if re.search(r"[0-9]", c):
-            while re.search(r"[0-9]", c):
-                num_buffer += c
-                x += 1
-                c = no_length_tree[x]
-            node_stack.append([str(num_buffer)])
-            num_buffer = ""
-            x -= 1
-        elif c == ':':
-            # Append the most recent leaf
-            current_node, x = get_node(no_length_tree, x + 1)
-            node_map[current_node] = node_stack.pop()
-            leaf_stack.append(current_node)
-        elif c == ')':
-            # Set the child leaves to the leaves of the current node's two children
-            while c == ')' and x < len(no_length_tree):
-                if no_length_tree[x + 1] == ';':
-                    break
-                current_node, x = get_node(no_length_tree, x + 2)
-                node_map[current_node] = node_map[leaf_stack.pop()] + node_map[leaf_stack.pop()]
-                leaf_stack.append(current_node)
-                x += 1
-                c = no_length_tree[x]
-        x += 1
-    return node_map
-
-
 def map_queries_to_annotations(marker_tree_info, marker_build_dict, jplace_files_to_parse, master_dat):
     num_unclassified = 0
     for jplace in jplace_files_to_parse:
@@ -228,7 +188,6 @@ def map_queries_to_annotations(marker_tree_info, marker_build_dict, jplace_files
                 query_obj = TreeProtein()
                 itol_datum = jplace_parser(jplace)
                 query_obj.transfer(itol_datum)
-                query_obj.correct_decoding()
                 query_obj.filter_max_weight_placement()
                 for node in query_obj.list_placements():
                     for group in marker_tree_info[data_type][marker]:
@@ -347,7 +306,7 @@ def main():
             marker = marker_build_dict[gene_code].cog
             if marker in marker_subgroups[data_type]:
                 # Create the dictionary mapping an internal node to all child nodes
-                internal_node_map = create_node_map(jplace_tree_strings[gene_code])
+                internal_node_map = map_internal_nodes_leaves(jplace_tree_strings[gene_code])
 
                 # Routine for exchanging any organism designations for their respective node number
                 tax_ids_file = os.sep.join([args.treesapp, "data", "tree_data", "tax_ids_" + marker + ".txt"])
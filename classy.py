@@ -5,15 +5,15 @@ import os
 import shutil
 import re
 import random
-import copy
 import subprocess
 import logging
 from multiprocessing import Process, JoinableQueue
-from json import loads, dumps
+from json import dumps
+from hashlib import md5
 
 from fasta import format_read_fasta, get_headers, write_new_fasta, get_header_format
 from utilities import reformat_string, return_sequence_info_groups, median
-from entish import get_node, create_tree_info_hash, subtrees_to_dictionary
+from entish import create_tree_info_hash, subtrees_to_dictionary, parse_jplace_node_map
 from external_command_interface import launch_write_command
 from entrez_utils import get_lineage
 
@@ -45,6 +45,21 @@ class MarkerBuild:
             self.pfit = [float(x) for x in build_param_fields[5].split(',')]
         return
 
+    def set_description(self, description):
+        """
+        Sets the description of the marker from cog_list.tsv and the kind of marker it implies
+        :param description: The marker's description (third column) in cog_list.tsv
+        :return:
+        """
+        self.description = description
+        if description == "phylogenetic_cogs":
+            self.kind = "phylogenetic_cogs"
+        elif description == "rRNA_marker":
+            self.kind = "phylogenetic_rRNA_cogs"
+        else:
+            self.kind = "functional_cogs"
+        return
+
     def check_rank(self):
         taxonomies = ["NA", "Kingdoms", "Phyla", "Classes", "Orders", "Families", "Genera", "Species"]
 
@@ -354,6 +369,66 @@ class CreateFuncTreeUtility:
         return
 
 
+class JplacePlacement:
+    """
+    A single location on the reference tree that a pquery was placed, holding the fields RAxML writes to jplace files
+    """
+    __slots__ = ("edge_num", "likelihood", "like_weight_ratio", "distal_length", "pendant_length")
+
+    def __init__(self, edge_num, likelihood, like_weight_ratio, distal_length, pendant_length):
+        self.edge_num = edge_num
+        self.likelihood = likelihood
+        self.like_weight_ratio = like_weight_ratio
+        self.distal_length = distal_length
+        self.pendant_length = pendant_length
+
+    def to_list(self, fields):
+        """
+        :param fields: The (unquoted) jplace field names, in the order the values should be listed
+        :return: List of the placement's values in the order of fields
+        """
+        return [getattr(self, field) for field in fields]
+
+
+class JplacePquery:
+    """
+    A placed query from the "placements" element of a jplace file: its name(s) and the list of JplacePlacements
+    """
+    __slots__ = ("names", "placements")
+
+    def __init__(self, names, placements):
+        self.names = names  # A list of strings, usually of length one
+        self.placements = placements  # A list of JplacePlacement objects
+
+    def to_json(self, fields):
+        """
+        Serializes the pquery in the format RAxML uses,
+        e.g. {"p":[[226, -31067.028237, 0.999987, 0.012003, 2e-06]], "n":["query"]}
+
+        :param fields: The (unquoted) jplace field names, in the order the placement values should be written
+        :return: A string of the pquery as a JSON object
+        """
+        return '{"p":' + dumps([placement.to_list(fields) for placement in self.placements]) +\
+               ', "n":' + dumps(self.names) + '}'
+
+
+_jplace_node_maps = dict()
+
+
+def load_jplace_node_map(tree):
+    """
+    Returns the JplaceNodeMap of a jplace tree, parsing the tree only the first time it is seen (in this process).
+    The JplaceNodeMap is shared by all callers and must not be modified.
+
+    :param tree: A NEWICK tree string from a jplace file
+    :return: A JplaceNodeMap object
+    """
+    tree_hash = md5(tree.encode("utf-8")).hexdigest()
+    if tree_hash not in _jplace_node_maps:
+        _jplace_node_maps[tree_hash] = parse_jplace_node_map(tree)
+    return _jplace_node_maps[tree_hash]
+
+
 class ItolJplace:
     """
     A class to hold all data relevant to a jplace file to be viewed in iTOL
@@ -364,7 +439,7 @@ class ItolJplace:
         self.contig_name = ""  # Sequence name (from FASTA header)
         self.name = ""  # Code name of the tree it mapped to (e.g. mcrA)
         self.abundance = None  # Either the number of occurences, or the FPKM of that sequence
-        self.node_map = dict()  # A dictionary mapping internal nodes (Jplace) to all leaf nodes
+        self.node_map = dict()  # A mapping of internal nodes (Jplace) to all leaf nodes, e.g. a JplaceNodeMap
         self.seq_len = 0
         ##
         # Taxonomic information:
@@ -375,7 +450,7 @@ class ItolJplace:
         ##
         # Information derived from Jplace pqueries:
         ##
-        self.placements = list()
+        self.placements = list()  # A list of JplacePquery objects
         self.lwr = 0  # Likelihood weight ratio of an individual placement
         self.likelihood = 0
         self.avg_evo_dist = 0.0
@@ -403,7 +478,7 @@ class ItolJplace:
         summary_string += "Placement information:\n"
         if not self.placements:
             summary_string += "\tNone.\n"
-        elif self.placements[0] == '{}':
+        elif not self.placements[0].placements:
             summary_string += "\tNone.\n"
         else:
             if self.likelihood and self.lwr and self.inode:
@@ -412,10 +487,8 @@ class ItolJplace:
                 summary_string += "\tL.W.R\t\t" + str(self.lwr) + "\n"
             else:
                 for pquery in self.placements:
-                    placement = loads(str(pquery), encoding="utf-8")
-                    for k, v in placement.items():
-                        if k == 'p':
-                            summary_string += '\t' + str(v) + "\n"
+                    summary_string += '\t' + str([placement.to_list(self.fields)
+                                                  for placement in pquery.placements]) + "\n"
         summary_string += "Non-redundant lineages of child nodes:\n"
         if len(self.lineage_list) > 0:
             for lineage in sorted(set(self.lineage_list)):
@@ -440,99 +513,30 @@ class ItolJplace:
         :return:
         """
         nodes = list()
-        for d_place in self.placements:
-            if isinstance(d_place, str):
-                for k, v in loads(d_place).items():
-                    if k == 'p':
-                        for pquery in v:
-                            nodes.append(str(pquery[0]))
-            else:
-                logging.error("Unable to handle type " + type(d_place) + "\n")
-                sys.exit(17)
+        for pquery in self.placements:
+            for placement in pquery.placements:
+                nodes.append(str(placement.edge_num))
         return nodes
 
-    def correct_decoding(self):
-        """
-        Since the JSON decoding is unable to decode recursively, this needs to be fixed for each placement
-        Formatting and string conversion are also performed here
-
-        :return:
-        """
-        new_placement_collection = []  # a list of dictionary-like strings
-        placement_string = ""  # e.g. {"p":[[226, -31067.028237, 0.999987, 0.012003, 2e-06]], "n":["query"]}
-        for d_place in self.placements:
-            if not isinstance(d_place, str):
-                dict_strings = list()  # e.g. "n":["query"]
-                for k, v in d_place.items():
-                    dict_strings.append(dumps(k) + ':' + dumps(v))
-                    placement_string = ', '.join(dict_strings)
-                new_placement_collection.append('{' + placement_string + '}')
-            else:
-                new_placement_collection.append(d_place)
-        self.placements = new_placement_collection
-
-        decoded_fields = list()
-        for field in self.fields:
-            if not re.match('".*"', field):
-                decoded_fields.append(dumps(field))
-            else:
-                decoded_fields.append(field)
-        self.fields = decoded_fields
-        return
-
     def rename_placed_sequence(self, seq_name):
-        new_placement_collection = dict()
-        for d_place in self.placements:
-            for key, value in d_place.items():
-                if key == 'n':
-                    new_placement_collection['n'] = [seq_name]
-                else:
-                    new_placement_collection[key] = value
-        self.placements = [new_placement_collection]
+        for pquery in self.placements:
+            pquery.names = [seq_name]
         return
 
     def name_placed_sequence(self):
-        for d_place in self.placements:
-            for key, value in d_place.items():
-                if key == 'n':
-                    self.contig_name = value[0]
+        for pquery in self.placements:
+            self.contig_name = pquery.names[0]
         return
 
-    def get_field_position_from_jplace_fields(self, field_name):
-        """
-        Find the position in self.fields of 'like_weight_ratio'
-        :return: position in self.fields of 'like_weight_ratio'
-        """
-        x = 0
-        # Find the position of field_name in the placements from fields descriptor
-        quoted_field = '"' + field_name + '"'
-        for field in self.fields:
-            if str(field) == quoted_field:
-                break
-            else:
-                x += 1
-        if x == len(self.fields):
-            logging.warning("Unable to find '" + field_name + "' in the jplace \"field\" string!\n")
-            return None
-        return x
-
     def get_jplace_element(self, element_name):
         """
         Determines the element value (e.g. likelihood, edge_num) for a single placement.
         There may be multiple placements (or 'pquery's) in a single .jplace file.
         Therefore, this function is usually looped over.
         """
-        position = self.get_field_position_from_jplace_fields(element_name)
-        placement = loads(self.placements[0], encoding="utf-8")
-        element_value = None
-        for k, v in placement.items():
-            if k == 'p':
-                acc = 0
-                while acc < len(v):
-                    pquery_fields = v[acc]
-                    element_value = pquery_fields[position]
-                    acc += 1
-        return element_value
+        if not self.placements[0].placements:
+            return None
+        return getattr(self.placements[0].placements[-1], element_name)
 
     def filter_min_weight_threshold(self, threshold=0.1):
         """
@@ -540,43 +544,18 @@ class ItolJplace:
         :param threshold: The threshold which all placements with LWRs less than this are removed
         :return:
         """
-        # Find the position of like_weight_ratio in the placements from fields descriptor
-        x = self.get_field_position_from_jplace_fields("like_weight_ratio")
-        if not x:
-            return
         # Filter the placements
         new_placement_collection = list()
-        placement_string = ""
         for pquery in self.placements:
-            placement = loads(pquery, encoding="utf-8")
-            dict_strings = list()
-            if len(placement["p"]) > 1:
-                for k, v in placement.items():
-                    if k == 'p':
-                        # For debugging:
-                        # sys.stderr.write(str(v) + "\nRemoved:\n")
-                        acc = 0
-                        tmp_placements = copy.deepcopy(v)
-                        while acc < len(tmp_placements):
-                            candidate = tmp_placements[acc]
-                            if float(candidate[x]) < threshold:
-                                removed = tmp_placements.pop(acc)
-                                # For debugging:
-                                # sys.stderr.write("\t".join([self.name, str(removed[0]),
-                                #                             str(float(removed[x]))]) + "\n")
-                            else:
-                                acc += 1
-                            # sys.stderr.flush()
-                        # If no placements met the likelihood filter then the sequence cannot be classified
-                        # Alternatively: first two will be returned and used for LCA - can test...
-                        if len(tmp_placements) > 0:
-                            v = tmp_placements
-                            dict_strings.append(dumps(k) + ':' + dumps(v))
-                            placement_string = ', '.join(dict_strings)
-                        else:
-                            self.classified = False
-                # Add the filtered placements back to the object.placements
-                new_placement_collection.append('{' + placement_string + '}')
+            if len(pquery.placements) > 1:
+                retained = [placement for placement in pquery.placements
+                            if float(placement.like_weight_ratio) >= threshold]
+                # If no placements met the likelihood filter then the sequence cannot be classified
+                # Alternatively: first two will be returned and used for LCA - can test...
+                if retained:
+                    new_placement_collection.append(JplacePquery(pquery.names, retained))
+                else:
+                    self.classified = False
             else:
                 # If there is only one placement, the LWR is 1.0 so no filtering required!
                 new_placement_collection.append(pquery)
@@ -592,17 +571,13 @@ class ItolJplace:
         :return: dict()
         """
         for pquery in self.placements:
-            placement = loads(pquery, encoding="utf-8")
-            for k, v in placement.items():
-                if k == 'p':
-                    for locus in v:
-                        jplace_node = locus[0]
-                        tree_leaves = self.node_map[jplace_node]
-                        normalized_abundance = float(self.abundance/len(tree_leaves))
-                        for tree_leaf in tree_leaves:
-                            if tree_leaf not in leaf_rpkm_sums.keys():
-                                leaf_rpkm_sums[tree_leaf] = 0.0
-                            leaf_rpkm_sums[tree_leaf] += normalized_abundance
+            for placement in pquery.placements:
+                tree_leaves = self.node_map[placement.edge_num]
+                normalized_abundance = float(self.abundance/len(tree_leaves))
+                for tree_leaf in tree_leaves:
+                    if tree_leaf not in leaf_rpkm_sums.keys():
+                        leaf_rpkm_sums[tree_leaf] = 0.0
+                    leaf_rpkm_sums[tree_leaf] += normalized_abundance
         return leaf_rpkm_sums
 
     def filter_max_weight_placement(self):
@@ -611,77 +586,31 @@ class ItolJplace:
         leaving only the placement with maximum like_weight_ratio
         :return:
         """
-        # Find the position of like_weight_ratio in the placements from fields descriptor
-        x = self.get_field_position_from_jplace_fields("like_weight_ratio")
-        if not x:
-            return
-
         # Filter the placements
         new_placement_collection = list()
-        placement_string = ""
         for pquery in self.placements:
-            placement = loads(pquery, encoding="utf-8")
-            if placement:
-                dict_strings = list()
+            if not pquery.placements:
+                continue
+            if len(pquery.placements) > 1:
+                best = None
                 max_lwr = 0
-                if len(placement["p"]) > 1:
-                    for k, v in placement.items():
-                        if k == 'p':
-                            acc = 0
-                            tmp_placements = copy.deepcopy(v)
-                            while acc < len(tmp_placements):
-                                candidate = tmp_placements[acc]
-                                if float(candidate[x]) > max_lwr:
-                                    v = [tmp_placements.pop(acc)]
-                                    max_lwr = candidate[x]
-                                else:
-                                    acc += 1
-                        dict_strings.append(dumps(k) + ':' + dumps(v))
-                        placement_string = ', '.join(dict_strings)
-                    # Add the filtered placements back to the object.placements
-                    new_placement_collection.append('{' + placement_string + '}')
-                else:
-                    new_placement_collection.append(pquery)
+                for placement in pquery.placements:
+                    if float(placement.like_weight_ratio) > max_lwr:
+                        best = placement
+                        max_lwr = float(placement.like_weight_ratio)
+                if best:
+                    pquery = JplacePquery(pquery.names, [best])
+            new_placement_collection.append(pquery)
         self.placements = new_placement_collection
         return
 
     def create_jplace_node_map(self):
         """
-        Loads a mapping between all nodes (internal and leaves) and all leaves
+        Loads a mapping between all nodes (internal and leaves) and all leaves.
+        The map is cached for each tree so it is only built once for all pqueries placed on the same tree.
         :return:
         """
-        no_length_tree = re.sub(":[0-9.]+{", ":{", self.tree)
-        self.node_map.clear()
-        node_stack = list()
-        leaf_stack = list()
-        x = 0
-        num_buffer = ""
-        while x < len(no_length_tree):
-            c = no_length_tree[x]
-            if re.search(r"[0-9]", c):
-                while re.search(r"[0-9]", c):
-                    num_buffer += c
-                    x += 1
-                    c = no_length_tree[x]
-                node_stack.append([str(num_buffer)])
-                num_buffer = ""
-                x -= 1
-            elif c == ':':
-                # Append the most recent leaf
-                current_node, x = get_node(no_length_tree, x + 1)
-                self.node_map[current_node] = node_stack.pop()
-                leaf_stack.append(current_node)
-            elif c == ')':
-                # Set the child leaves to the leaves of the current node's two children
-                while c == ')' and x < len(no_length_tree):
-                    if no_length_tree[x + 1] == ';':
-                        break
-                    current_node, x = get_node(no_length_tree, x + 2)
-                    self.node_map[current_node] = self.node_map[leaf_stack.pop()] + self.node_map[leaf_stack.pop()]
-                    leaf_stack.append(current_node)
-                    x += 1
-                    c = no_length_tree[x]
-            x += 1
+        self.node_map = load_jplace_node_map(self.tree)
         return
 
     def harmonize_placements(self, treesapp_dir):
@@ -695,25 +624,20 @@ class ItolJplace:
             self.name = "COGrRNA"
         reference_tree_file = os.sep.join([treesapp_dir, "data", "tree_data"]) + os.sep + self.name + "_tree.txt"
         reference_tree_elements = _tree_parser._read_the_reference_tree(reference_tree_file)
-        lwr_pos = self.get_field_position_from_jplace_fields("like_weight_ratio")
-        if not lwr_pos:
-            return
         singular_placements = list()
         for pquery in self.placements:
-            placement = loads(pquery, encoding="utf-8")
-            dict_strings = list()
-            for k, v in placement.items():
-                if len(v) > 1:
-                    lwr_sum = 0
-                    loci = list()
-                    for locus in v:
-                        lwr_sum += float(locus[lwr_pos])
-                        loci.append(str(self.node_map[locus[0]][0]))
-                    ancestral_node = _tree_parser._lowest_common_ancestor(reference_tree_elements, ','.join(loci))
-                    # Create a placement from the ancestor, and the first locus in loci fields
-                    v = [[ancestral_node, v[0][1], round(lwr_sum, 2), 0, 0]]
-                dict_strings.append(dumps(k) + ':' + dumps(v))
-            singular_placements.append('{' + ','.join(dict_strings) + '}')
+            if len(pquery.placements) > 1:
+                lwr_sum = 0
+                loci = list()
+                for placement in pquery.placements:
+                    lwr_sum += float(placement.like_weight_ratio)
+                    loci.append(str(self.node_map[placement.edge_num][0]))
+                ancestral_node = _tree_parser._lowest_common_ancestor(reference_tree_elements, ','.join(loci))
+                # Create a placement from the ancestor, and the first locus in loci fields
+                pquery = JplacePquery(pquery.names,
+                                      [JplacePlacement(ancestral_node, pquery.placements[0].likelihood,
+                                                       round(lwr_sum, 2), 0, 0)])
+            singular_placements.append(pquery)
 
         self.placements = singular_placements
         return
@@ -721,7 +645,7 @@ class ItolJplace:
     def clear_object(self):
         self.placements.clear()
         self.fields.clear()
-        self.node_map.clear()
+        self.node_map = dict()
         self.contig_name = ""
         self.name = ""
         self.tree = ""
@@ -740,43 +664,30 @@ class TreeProtein(ItolJplace):
     def transfer(self, itol_jplace_object):
         self.placements = itol_jplace_object.placements
         self.tree = itol_jplace_object.tree
-        self.fields = itol_jplace_object.fields
+        self.fields = list(itol_jplace_object.fields)
         self.version = itol_jplace_object.version
         self.metadata = itol_jplace_object.metadata
 
-    def megan_lca(self):
+    def megan_lca(self, taxonomy):
         """
         Using the lineages of all leaves to which this sequence was mapped (n >= 1),
         A lowest common ancestor is found at the point which these lineages converge.
         This emulates the LCA algorithm employed by the MEtaGenome ANalyzer (MEGAN).
+
+        :param taxonomy: The TaxonomyTrie of the reference package's lineages
         :return:
         """
         # If there is only one child, return the joined string
         if len(self.lineage_list) == 1:
             return "; ".join(self.lineage_list[0])
 
-        listed_lineages = [lineage.strip().split("; ") for lineage in self.lineage_list]
-        max_depth = max([len(lineage) for lineage in listed_lineages])
-        lca_set = set()
-        lca_lineage_strings = list()
-        i = 0
-        while i < max_depth:
-            contributors = 0
-            for lineage in sorted(listed_lineages):
-                try:
-                    lca_set.add(lineage[i])
-                    contributors += 1
-                except IndexError:
-                    pass
-
-            if len(lca_set) == 1 and contributors == len(listed_lineages):
-                lca_lineage_strings.append(list(lca_set)[0])
-                i += 1
-                lca_set.clear()
-            else:
-                i = max_depth
-
-        return "; ".join(lca_lineage_strings)
+        lineage_nodes = [taxonomy.find(lineage.strip()) for lineage in self.lineage_list]
+        lineage_nodes = [node for node in lineage_nodes if node is not None]
+        if len(lineage_nodes) == 0:
+            logging.debug("None of the lineages of " + self.contig_name + " are in the reference taxonomy.\n")
+            return ""
+        lca_node = taxonomy.lowest_common_ancestor(lineage_nodes)
+        return taxonomy.lineages[lca_node]
 
 
 class TreeLeafReference:
@@ -813,6 +724,131 @@ class TreeLeafReference:
             self.analysis_type = ""
 
 
+class TaxonomyTrie:
+    """
+    The lineages of a reference package stored as a trie of integer node IDs. Node 0 is the root (empty lineage) and
+    each other node is a rank reached by following a '; '-separated lineage from the root. Rank names are interned so
+    lineages can be compared rank-by-rank as integers, and the number of reference lineages passing through each node
+    (the taxonomic counts) is tracked as lineages are added.
+    """
+    def __init__(self):
+        self.names = list()  # Interned rank names, indexed by name ID
+        self.name_ids = dict()
+        self.node_names = [-1]  # The name ID of each node's rank
+        self.parents = [-1]
+        self.depths = [0]
+        self.children = [dict()]  # Name ID -> child node ID
+        self.paths = [()]  # The node IDs from the first rank down to (and including) each node
+        self.lineages = [""]  # The '; '-joined lineage string of each node
+        self.counts = [0]
+        self.lineage_nodes = dict()
+
+    def __len__(self):
+        return len(self.parents)
+
+    def add_rank(self, node, rank):
+        """
+        :param node: The node ID of the parent rank
+        :param rank: The name of the child rank
+        :return: The node ID of the child rank, which is created if it is not yet in the trie
+        """
+        try:
+            name_id = self.name_ids[rank]
+        except KeyError:
+            name_id = len(self.names)
+            self.name_ids[rank] = name_id
+            self.names.append(rank)
+        try:
+            return self.children[node][name_id]
+        except KeyError:
+            pass
+        child = len(self.parents)
+        self.children[node][name_id] = child
+        self.node_names.append(name_id)
+        self.parents.append(node)
+        self.depths.append(self.depths[node] + 1)
+        self.children.append(dict())
+        self.paths.append(self.paths[node] + (child,))
+        if node == 0:
+            self.lineages.append(rank)
+        else:
+            self.lineages.append(self.lineages[node] + "; " + rank)
+        self.counts.append(0)
+        return child
+
+    def insert(self, lineage):
+        """
+        Finds the node of a lineage, creating nodes for any ranks not yet in the trie
+
+        :param lineage: A '; '-separated lineage string
+        :return: The node ID of the lineage's last rank
+        """
+        try:
+            return self.lineage_nodes[lineage]
+        except KeyError:
+            pass
+        node = 0
+        for rank in lineage.split("; "):
+            node = self.add_rank(node, rank)
+        self.lineage_nodes[lineage] = node
+        return node
+
+    def find(self, lineage):
+        """
+        Finds the node of a lineage without modifying the trie
+
+        :param lineage: A '; '-separated lineage string
+        :return: The node ID of the lineage's last rank, or None if any of its ranks are not in the trie
+        """
+        try:
+            return self.lineage_nodes[lineage]
+        except KeyError:
+            pass
+        node = 0
+        for rank in lineage.split("; "):
+            try:
+                node = self.children[node][self.name_ids[rank]]
+            except KeyError:
+                return None
+        return node
+
+    def add_lineage(self, lineage):
+        """
+        Inserts a reference lineage and counts it towards each of its ranks
+
+        :param lineage: A '; '-separated lineage string
+        :return: The node ID of the lineage's last rank
+        """
+        node = self.insert(lineage)
+        self.counts[0] += 1
+        for rank_node in self.paths[node]:
+            self.counts[rank_node] += 1
+        return node
+
+    def lowest_common_ancestor(self, nodes):
+        """
+        :param nodes: A non-empty list of node IDs
+        :return: The node ID of the deepest rank shared by all nodes (0 if they diverge at the first rank)
+        """
+        lca = nodes[0]
+        for node in nodes[1:]:
+            while lca != node:
+                if self.depths[lca] > self.depths[node]:
+                    lca = self.parents[lca]
+                elif self.depths[node] > self.depths[lca]:
+                    node = self.parents[node]
+                else:
+                    lca = self.parents[lca]
+                    node = self.parents[node]
+        return lca
+
+    def taxonomic_counts(self):
+        """
+        :return: Dictionary of each lineage (and lineage prefix) mapped to the number of reference lineages it includes
+        """
+        return {self.lineages[node]: self.counts[node] for node in range(1, len(self.parents)) if self.counts[node]}
+
+
 class ReferenceSequence:
     def __init__(self):
         self.accession = ""
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+__author__ = 'Connor Morgan-Lang'
+
+
+import sys
+import argparse
+import os
+import inspect
+cmd_folder = os.path.realpath(os.path.abspath(os.path.split(inspect.getfile(inspect.currentframe()))[0]))
+if cmd_folder not in sys.path:
+    sys.path.insert(0, cmd_folder)
+sys.path.insert(0, cmd_folder + os.sep + ".." + os.sep)
+from classy import prep_logging
+from reference_bundle import compile_reference_bundle, reference_bundle_path
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(add_help=False,
+                                     description="Compiles the build parameters, taxonomic lineages, reference "
+                                                 "alignment dimensions, tree indices and HMM lengths of all TreeSAPP "
+                                                 "reference packages into a single file that treesapp.py loads at "
+                                                 "startup. Re-run whenever a reference package is added or updated.")
+    miscellaneous_opts = parser.add_argument_group("Miscellaneous options")
+    miscellaneous_opts.add_argument("-o", "--output",
+                                    help="Path of the compiled bundle. treesapp.py only loads the default. "
+                                         "[ DEFAULT = data/ref_packages.bundle ]",
+                                    default=None)
+    miscellaneous_opts.add_argument('-v', '--verbose',
+                                    action='store_true',
+                                    default=False,
+                                    help='Prints a more verbose runtime log')
+    miscellaneous_opts.add_argument("-h", "--help",
+                                    action="help",
+                                    help="Show this help message and exit")
+
+    args = parser.parse_args()
+    args.treesapp = os.path.abspath(os.path.dirname(os.path.realpath(__file__))) + os.sep
+    if not args.output:
+        args.output = reference_bundle_path(args.treesapp)
+    # The log is written next to the bundle, so this is checked before logging is set up
+    output_dir = os.path.dirname(os.path.abspath(args.output))
+    if not os.path.isdir(output_dir) or not os.access(output_dir, os.W_OK):
+        sys.stderr.write("ERROR: Unable to write the reference package bundle to " + output_dir + "\n")
+        sys.exit(19)
+
+    return args
+
+
+def main():
+    args = get_arguments()
+    prep_logging(os.path.splitext(args.output)[0] + "_log.txt", args.verbose)
+    compile_reference_bundle(args.treesapp, args.output)
+
+
+main()
@@ -17,7 +17,7 @@ try:
     from time import gmtime, strftime, sleep
 
     from utilities import os_type, which, find_executables, reformat_string, return_sequence_info_groups,\
-        reformat_fasta_to_phy, write_phy_file, cluster_sequences
+        write_phy_file, cluster_sequences
     from fasta import format_read_fasta, get_headers, get_header_format, write_new_fasta, summarize_fasta_sequences,\
         trim_multiple_alignment, read_fasta_to_dict
     from classy import ReferenceSequence, Header, Cluster, prep_logging, register_headers, get_header_info
@@ -1685,8 +1685,7 @@ def main():
     else:
         for seq_name in aligned_fasta_dict:
             dict_for_phy[seq_name.split('_')[0]] = aligned_fasta_dict[seq_name]
-    phy_dict = reformat_fasta_to_phy(dict_for_phy)
-    write_phy_file(phylip_file, phy_dict)
+    write_phy_file(phylip_file, dict_for_phy)
 
     ##
     # Build the tree using RAxML
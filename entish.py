@@ -5,8 +5,6 @@ import re
 import _tree_parser
 import os
 from utilities import Autovivify
-from ete3 import Tree
-from scipy import log2
 
 
 def get_node(tree, pos):
@@ -20,44 +18,61 @@ def get_node(tree, pos):
     return int(node), pos
 
 
+class JplaceNodeMap:
+    """
+    A read-only mapping of every node (internal and leaves) in a jplace tree to the leaves beneath it.
+    The leaves are stored once, ordered such that the leaves of each node are contiguous, and each node only stores
+    the range of its leaves in that list.
+    """
+    def __init__(self, leaves, ranges):
+        self.leaves = leaves  # List of leaf names
+        self.ranges = ranges  # Dictionary mapping node numbers to (start, end) indices in self.leaves
+
+    def __getitem__(self, node):
+        start, end = self.ranges[node]
+        return self.leaves[start:end]
+
+    def __contains__(self, node):
+        return node in self.ranges
+
+    def __iter__(self):
+        return iter(self.ranges)
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def keys(self):
+        return self.ranges.keys()
+
+    def items(self):
+        for node in self.ranges:
+            yield node, self[node]
+
+
+def parse_jplace_node_map(tree):
+    """
+    Parses a jplace NEWICK tree, where each node is followed by its edge number in curly braces, in a single pass
+    (in linear time) with the _tree_parser extension.
+    The leaves of each node are in the same order as the lists of the original (concatenating) node map:
+    those of the right-most child first.
+
+    :param tree: A NEWICK tree string from a jplace file
+    :return: A JplaceNodeMap object
+    """
+    leaves, node_table = _tree_parser._map_jplace_nodes(tree)
+    ranges = dict()
+    # The node table is in post-order
+    for node, start, end in node_table:
+        ranges[node] = (start, end)
+    return JplaceNodeMap(leaves, ranges)
+
+
 def map_internal_nodes_leaves(tree):
     """
     Loads a mapping between all nodes (internal and leaves) and all leaves
-    :return:
+    :return: A JplaceNodeMap, which can be read like a dictionary of node numbers mapped to lists of leaves
     """
-    no_length_tree = re.sub(":[0-9.]+{", ":{", tree)
-    node_map = dict()
-    node_stack = list()
-    leaf_stack = list()
-    x = 0
-    num_buffer = ""
-    while x < len(no_length_tree):
-        c = no_length_tree[x]
-        if re.search(r"[0-9]", c):
-            while re.search(r"[0-9]", c):
-                num_buffer += c
-                x += 1
-                c = no_length_tree[x]
-            node_stack.append([str(num_buffer)])
-            num_buffer = ""
-            x -= 1
-        elif c == ':':
-            # Append the most recent leaf
-            current_node, x = get_node(no_length_tree, x + 1)
-            node_map[current_node] = node_stack.pop()
-            leaf_stack.append(current_node)
-        elif c == ')':
-            # Set the child leaves to the leaves of the current node's two children
-            while c == ')' and x < len(no_length_tree):
-                if no_length_tree[x + 1] == ';':
-                    break
-                current_node, x = get_node(no_length_tree, x + 2)
-                node_map[current_node] = node_map[leaf_stack.pop()] + node_map[leaf_stack.pop()]
-                leaf_stack.append(current_node)
-                x += 1
-                c = no_length_tree[x]
-        x += 1
-    return node_map
+    return parse_jplace_node_map(tree)
 
 
 def find_mean_pairwise_distances(children):
@@ -69,42 +84,6 @@ def find_mean_pairwise_distances(children):
     return sum(pairwise_dists) / len(pairwise_dists)
 
 
-def find_mean_leaf_distances(parent_node):
-    children = parent_node.get_leaves()
-    distances = [parent_node.get_distance(child) for child in children]
-    return sum(distances) / len(distances)
-
-
-def find_cluster(lost_node: Tree):
-    """
-    Function for determining the ancestor of the cluster which lost_node belongs to
-
-    :param lost_node: A node within a tree, for which we want to orient
-    :return: Tree node
-    """
-    parent = lost_node.up
-    if lost_node.is_root() or parent.is_root():
-        return lost_node
-
-    # Find the intra-cluster leaf distances
-    mean_intra = find_mean_leaf_distances(lost_node)
-
-    # Penalty for increasing the size of the clade
-    cousins = lost_node.get_sisters()[0].get_leaf_names()
-    parent_dist = parent.get_distance(lost_node) * log2(len(cousins) + 1)
-
-    while mean_intra > parent_dist:
-        lost_node = parent
-        parent = lost_node.up
-        if parent is None:
-            break
-        mean_intra = find_mean_leaf_distances(lost_node)
-        cousins = lost_node.get_sisters()[0].get_leaf_names()
-        parent_dist = parent.get_distance(lost_node) * log2(len(cousins) + 1)
-
-    return lost_node
-
-
 def subtrees_to_dictionary(subtrees_string, tree_info):
     subtree_list = subtrees_string.split(';')
     for subtree in subtree_list:
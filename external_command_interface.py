@@ -2,6 +2,7 @@ __author__ = 'Connor Morgan-Lang'
 
 import os
 import sys
+import time
 import logging
 import subprocess
 
@@ -38,6 +39,26 @@ def launch_write_command(cmd_list, collect_all=True):
     return stdout, proc.returncode
 
 
+def launch_timed_command(cmd_list):
+    """
+    Runs a command like launch_write_command but, since it is intended to be called from worker processes,
+    returns the returncode rather than exiting when the command fails.
+
+    :param cmd_list: A list of strings forming a complete command call
+    :return: The command list, a string with stdout and stderr text, the returncode and the wall time in seconds
+    """
+    start_time = time.time()
+    proc = subprocess.Popen(' '.join(cmd_list),
+                            shell=True,
+                            preexec_fn=os.setsid,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    stdout = proc.communicate()[0].decode("utf-8")
+    end_time = time.time()
+
+    return cmd_list, stdout, proc.returncode, end_time - start_time
+
+
 def setup_progress_bar(num_items):
     if num_items > 50:
         progress_bar_width = 50
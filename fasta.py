@@ -1,7 +1,10 @@
 __author__ = 'Connor Morgan-Lang'
 
 import sys
+import os
 import re
+import mmap
+import heapq
 import logging
 
 import _fasta_reader
@@ -101,6 +104,202 @@ def format_read_fasta(fasta_input, molecule, output_dir, max_header_length=110,
     return formatted_fasta_dict
 
 
+def format_fasta_to_file(fasta_input, molecule, output_dir, formatted_fasta_file,
+                         max_header_length=110, min_seq_length=10):
+    """
+    Reads a FASTA file, ensuring each sequence and sequence name is valid, and writes the formatted records to
+    formatted_fasta_file as they are parsed. Unlike format_read_fasta, the sequences are never all held in memory;
+    a faidx-style index is written alongside formatted_fasta_file so they can be retrieved from disk on demand.
+
+    :param fasta_input: Absolute path of the FASTA file to be read
+    :param molecule: Molecule type of the sequences ['prot', 'dna', 'rrna']
+    :param output_dir: Path to a directory for writing the log file to
+    :param formatted_fasta_file: Path to the FASTA file the formatted sequences are written to
+    :param max_header_length: The length of the header string before all characters after this length are removed
+    :param min_seq_length: All sequences shorter than this will not be written to formatted_fasta_file
+    :return: A FastaIndex instance for formatted_fasta_file
+    """
+    seq_offsets = dict()
+    offset_list = _fasta_reader._write_format_fasta(fasta_input,
+                                                    min_seq_length,
+                                                    output_dir,
+                                                    molecule,
+                                                    max_header_length,
+                                                    formatted_fasta_file)
+    if not offset_list:
+        sys.exit(5)
+
+    for header, offset, length in offset_list:
+        if len(header) > max_header_length:
+            logging.error(header + " is too long (" + str(len(header)) + ")!\n" +
+                          "There is a bug in _write_format_fasta - please report!\n")
+            sys.exit(5)
+        seq_offsets[header] = (offset, length)
+    write_fasta_index(formatted_fasta_file, seq_offsets)
+
+    return FastaIndex(formatted_fasta_file, seq_offsets)
+
+
+def write_fasta_index(fasta_file, seq_offsets):
+    """
+    Writes a faidx-style index (name, length, offset, line bases, line width) for a FASTA file with
+    single-line sequences, such as those written by format_fasta_to_file, to fasta_file + ".fai"
+
+    :param fasta_file: Path to the FASTA file that was indexed
+    :param seq_offsets: Dictionary mapping headers (including the '>') to (offset, sequence length) tuples
+    :return: Path to the index file
+    """
+    index_file = fasta_file + ".fai"
+    try:
+        index_handler = open(index_file, 'w')
+    except IOError:
+        logging.error("Unable to open " + index_file + " for writing!\n")
+        sys.exit(5)
+
+    index_lines = list()
+    for header in sorted(seq_offsets, key=lambda x: seq_offsets[x][0]):
+        offset, length = seq_offsets[header]
+        index_lines.append("\t".join([header[1:], str(length), str(offset), str(length), str(length + 1)]) + "\n")
+    index_handler.write("".join(index_lines))
+    index_handler.close()
+
+    return index_file
+
+
+def read_fasta_index(index_file):
+    """
+    Reads a faidx-style index written by write_fasta_index
+
+    :param index_file: Path to the .fai file
+    :return: Dictionary mapping headers (including the '>') to (offset, sequence length) tuples
+    """
+    seq_offsets = dict()
+    try:
+        index_handler = open(index_file, 'r')
+    except IOError:
+        logging.error("Unable to open " + index_file + " for reading!\n")
+        sys.exit(5)
+
+    for line in index_handler:
+        try:
+            name, length, offset, line_bases, line_width = line.rstrip("\n").split("\t")
+        except ValueError:
+            logging.error("Unexpected number of fields in " + index_file + ":\n" + line + "\n")
+            sys.exit(5)
+        if line_bases != length:
+            logging.error("Only FASTA files with single-line sequences are supported, unlike " + name +
+                          " in " + index_file + "\n")
+            sys.exit(5)
+        seq_offsets['>' + name] = (int(offset), int(length))
+    index_handler.close()
+
+    return seq_offsets
+
+
+class FastaIndex:
+    """
+    Read-only, dictionary-like access to the sequences of a FASTA file through its faidx-style index.
+    The FASTA file is memory-mapped so sequences are only read from disk when they are requested.
+    """
+    def __init__(self, fasta_file, seq_offsets=None):
+        self.fasta_file = fasta_file
+        self.index_file = fasta_file + ".fai"
+        if seq_offsets is None:
+            seq_offsets = read_fasta_index(self.index_file)
+        self.offsets = seq_offsets
+        self.fasta_handler = None
+        self.fasta_map = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, header):
+        return header in self.offsets
+
+    def __getitem__(self, header):
+        return self.subsequence(header, 0, self.offsets[header][1])
+
+    def keys(self):
+        return self.offsets.keys()
+
+    def open(self):
+        try:
+            self.fasta_handler = open(self.fasta_file, 'rb')
+        except IOError:
+            logging.error("Unable to open " + self.fasta_file + " for reading!\n")
+            sys.exit(5)
+        if os.fstat(self.fasta_handler.fileno()).st_size == 0:
+            # Empty files cannot be memory-mapped, but as they hold no sequences there is nothing to read
+            self.fasta_map = b""
+        else:
+            self.fasta_map = mmap.mmap(self.fasta_handler.fileno(), 0, access=mmap.ACCESS_READ)
+        return
+
+    def close(self):
+        if self.fasta_map is not None:
+            if isinstance(self.fasta_map, mmap.mmap):
+                self.fasta_map.close()
+            self.fasta_handler.close()
+        self.fasta_map = None
+        self.fasta_handler = None
+        return
+
+    def subsequence(self, header, start, end):
+        """
+        Reads the sequence of `header` between `start` and `end`, following Python's slicing rules
+
+        :param header: A sequence name, including the '>'
+        :param start: Position of the first character in the sequence to return
+        :param end: Position after the last character of the sequence to return
+        :return: The sub-sequence as a string
+        """
+        if self.fasta_map is None:
+            self.open()
+        offset, length = self.offsets[header]
+        start, end, _ = slice(start, end).indices(length)
+        if end <= start:
+            return ""
+        return self.fasta_map[offset + start:offset + end].decode("utf-8")
+
+
+def write_balanced_fasta_chunks(fasta_index, fasta_prefix, num_chunks):
+    """
+    Splits the sequences in fasta_index across num_chunks FASTA files such that each file holds roughly the same
+    number of residues, rather than the same number of sequences. Sequences are assigned longest-first to the chunk
+    with the fewest residues and are streamed from disk into the chunk files one at a time.
+
+    :param fasta_index: A FastaIndex of the sequences to be split
+    :param fasta_prefix: Prefix of the chunk files. These are named fasta_prefix + '_' + chunk number + ".fasta"
+    :param num_chunks: The number of files to split the sequences across
+    :return: List of the FASTA files written, excluding any that would have been empty
+    """
+    split_files = list()
+    chunk_heap = [(0, chunk_num) for chunk_num in range(1, num_chunks + 1)]
+    chunk_headers = {chunk_num: list() for chunk_num in range(1, num_chunks + 1)}
+
+    for header in sorted(fasta_index.keys(), key=lambda x: fasta_index.offsets[x][1], reverse=True):
+        residues, chunk_num = heapq.heappop(chunk_heap)
+        chunk_headers[chunk_num].append(header)
+        heapq.heappush(chunk_heap, (residues + fasta_index.offsets[header][1], chunk_num))
+
+    for chunk_num in sorted(chunk_headers):
+        if not chunk_headers[chunk_num]:
+            continue
+        fasta_name = fasta_prefix + '_' + str(chunk_num) + ".fasta"
+        try:
+            fa_out = open(fasta_name, 'w')
+        except IOError:
+            logging.error("Unable to open " + fasta_name + " for writing!\n")
+            sys.exit(5)
+        # Write the sequences in the order they are found in the indexed file to keep reads sequential
+        for header in sorted(chunk_headers[chunk_num], key=lambda x: fasta_index.offsets[x][0]):
+            fa_out.write(header + "\n" + fasta_index[header] + "\n")
+        fa_out.close()
+        split_files.append(fasta_name)
+
+    return split_files
+
+
 def get_headers(fasta_file):
     """
     Reads a FASTA file and returns a list of all headers it found in the file. No reformatting or filtering performed.
@@ -3,20 +3,24 @@
 import sys
 import os
 import re
+import string
 import logging
-from classy import TreeLeafReference, MarkerBuild, Cluster
-from utilities import Autovivify, calculate_overlap
+import numpy as np
+from classy import TreeLeafReference, MarkerBuild, Cluster, TaxonomyTrie
+from utilities import Autovivify, calculate_overlap, clean_lineage_string, interleave_phylip_blocks
 from HMMER_domainTblParser import DomainTableParser, format_split_alignments, filter_incomplete_hits, filter_poor_hits
 
 __author__ = 'Connor Morgan-Lang'
 
+# Upper-cases residues and converts '.' gaps (in insert columns) to '-' when reading Stockholm alignments
+_stockholm_translation = str.maketrans(string.ascii_lowercase + '.', string.ascii_uppercase + '-')
 
-def parse_ref_build_params(args):
+
+def read_ref_build_params(ref_build_parameters):
     """
-    Returns a dictionary of MarkerBuild objects storing information pertaining to the build parameters of each marker.
-    :param args: Command-line argument object returned by get_options and check_parser_arguments
+    :param ref_build_parameters: Path to a ref_build_parameters.tsv file
+    :return: List of the build parameter lines of each marker, excluding the header and commented lines
     """
-    ref_build_parameters = args.treesapp + 'data' + os.sep + 'tree_data' + os.sep + 'ref_build_parameters.tsv'
     try:
         param_handler = open(ref_build_parameters, 'r')
     except IOError:
@@ -29,17 +33,36 @@ def parse_ref_build_params(args):
         logging.error("Header of '" + ref_build_parameters + "' is unexpected!")
         sys.exit(5)
 
-    logging.info("Reading build parameters of reference markers... ")
     skipped_lines = []
-    missing_info = []
-    marker_build_dict = dict()
+    build_param_lines = []
     for line in param_handler:
         if header_re.match(line):
             continue
         line = line.strip()
+        if not line:
+            continue
         if line[0] == '#':
             skipped_lines.append(line)
             continue
+        build_param_lines.append(line)
+    param_handler.close()
+
+    logging.debug("Skipped the following lines:\n\t" +
+                  "\n\t".join(skipped_lines) + "\n")
+    return build_param_lines
+
+
+def load_marker_builds(args, build_param_lines):
+    """
+    :param args: Command-line argument object returned by get_options and check_parser_arguments
+    :param build_param_lines: List of build parameter lines, as returned by read_ref_build_params
+    :return: A dictionary (indexed by marker 5-character 'denominator's) mapping MarkerBuild objects of the markers in
+     args.targets
+    """
+    skipped_lines = []
+    missing_info = []
+    marker_build_dict = dict()
+    for line in build_param_lines:
         marker_build = MarkerBuild(line)
         if args.targets != ["ALL"] and marker_build.denominator not in args.targets:
             skipped_lines.append(line)
@@ -48,31 +71,44 @@ def parse_ref_build_params(args):
             if marker_build.load_pfit_params(line):
                 missing_info.append(marker_build)
             marker_build.check_rank()
-    param_handler.close()
-
-    logging.info("done.\n")
 
     logging.debug("Rank distance information missing for:\n\t" +
                   "\n\t".join([mb.cog + '-' + mb.denominator for mb in missing_info]) + "\n")
-    logging.debug("Skipped the following lines:\n\t" +
+    logging.debug("Skipped the following untargeted markers:\n\t" +
                   "\n\t".join(skipped_lines) + "\n")
     return marker_build_dict
 
 
-def parse_cog_list(args, marker_build_dict):
+def parse_ref_build_params(args):
     """
-    Loads the TreeSAPP COG list file into marker_build_dict and check that the args.reftree exists
-    :param args: The command-line and default arguments object
-    :param marker_build_dict: A dictionary (indexed by marker 5-character 'denominator's) mapping MarkerBuild objects
-    :return: marker_build_dict with updated information
+    Returns a dictionary of MarkerBuild objects storing information pertaining to the build parameters of each marker.
+    :param args: Command-line argument object returned by get_options and check_parser_arguments
     """
-    cog_list_file = args.treesapp + os.sep + 'data' + os.sep + 'tree_data' + os.sep + 'cog_list.tsv'
-    cog_input_list = open(cog_list_file, 'r', encoding="latin1")
+    ref_build_parameters = args.treesapp + 'data' + os.sep + 'tree_data' + os.sep + 'ref_build_parameters.tsv'
+
+    logging.info("Reading build parameters of reference markers... ")
+    marker_build_dict = load_marker_builds(args, read_ref_build_params(ref_build_parameters))
+    logging.info("done.\n")
+
+    return marker_build_dict
+
+
+def read_cog_list(cog_list_file):
+    """
+    :param cog_list_file: Path to a cog_list.tsv file
+    :return: Dictionary of marker denominators mapped to their descriptions
+    """
+    try:
+        cog_input_list = open(cog_list_file, 'r', encoding="latin1")
+    except IOError:
+        logging.error("Unable to open " + cog_list_file + " for reading.\n")
+        sys.exit(5)
     # Load lines from the COG list file and close
     cog_list_lines = [x.strip() for x in cog_input_list.readlines()]
     # Close the COG list file
     cog_input_list.close()
 
+    descriptions = dict()
     for marker_input in cog_list_lines:
         if re.match(r'\A#', marker_input):
             continue
@@ -83,25 +119,98 @@ def parse_cog_list(args, marker_build_dict):
             sys.exit(5)
 
         marker, denominator, description = marker_input.split("\t")
-        if args.targets != ["ALL"] and denominator not in args.targets:
-            continue
+        descriptions[denominator] = description
+    return descriptions
 
-        for ref_code in marker_build_dict:
-            if denominator == ref_code:
-                marker_build_dict[denominator].description = description
-                if description == "phylogenetic_cogs":
-                    marker_build_dict[denominator].kind = "phylogenetic_cogs"
-                elif description == "rRNA_marker":
-                    marker_build_dict[denominator].kind = "phylogenetic_rRNA_cogs"
-                else:
-                    marker_build_dict[denominator].kind = "functional_cogs"
+
+def set_marker_descriptions(args, marker_build_dict, descriptions, source_file):
+    """
+    Sets the description of each marker in marker_build_dict and checks that the args.reftree exists
+
+    :param args: The command-line and default arguments object
+    :param marker_build_dict: A dictionary (indexed by marker 5-character 'denominator's) mapping MarkerBuild objects
+    :param descriptions: Dictionary of marker denominators mapped to their descriptions, as returned by read_cog_list
+    :param source_file: Path to the file the descriptions were read from, for reporting errors
+    :return: marker_build_dict with updated information
+    """
+    for denominator in descriptions:
+        if denominator in marker_build_dict:
+            marker_build_dict[denominator].set_description(descriptions[denominator])
 
     if args.reftree not in ['i', 'g', 'p'] and args.reftree not in marker_build_dict.keys():
-        logging.error(args.reftree + " not found in " + cog_list_file + "! Please use a valid reference tree ID!\n")
+        logging.error(args.reftree + " not found in " + source_file + "! Please use a valid reference tree ID!\n")
         sys.exit(5)
     return marker_build_dict
 
 
+def parse_cog_list(args, marker_build_dict):
+    """
+    Loads the TreeSAPP COG list file into marker_build_dict and check that the args.reftree exists
+    :param args: The command-line and default arguments object
+    :param marker_build_dict: A dictionary (indexed by marker 5-character 'denominator's) mapping MarkerBuild objects
+    :return: marker_build_dict with updated information
+    """
+    cog_list_file = args.treesapp + os.sep + 'data' + os.sep + 'tree_data' + os.sep + 'cog_list.tsv'
+    return set_marker_descriptions(args, marker_build_dict, read_cog_list(cog_list_file), cog_list_file)
+
+
+def get_hmm_length(hmm_file):
+    """
+    Function to open the ref_tree's hmm file and determine its length
+    :param hmm_file: The HMM file produced by hmmbuild to parse for the HMM length
+    :return: The length (int value) of the HMM
+    """
+    try:
+        hmm = open(hmm_file, 'r')
+    except IOError:
+        raise IOError("Unable to open " + hmm_file + " for reading! Exiting.")
+
+    line = hmm.readline()
+    length = 0
+    while line:
+        # LENG XXX
+        if re.match(r"^LENG\s+([0-9]+)", line):
+            length = int(line.split()[1])
+        line = hmm.readline()
+    if length > 0:
+        return length
+    else:
+        raise AssertionError("Unable to parse the HMM length from " + hmm_file + ". Exiting.")
+
+
+def read_hmm_map_columns(hmm_file):
+    """
+    Reads the column of the reference alignment each match state of an HMM was built from (its MAP annotation)
+
+    :param hmm_file: An HMM file produced by hmmbuild
+    :return: List of the 0-based alignment columns of the match states, in order. Empty if the HMM has no MAP annotation
+    """
+    try:
+        hmm = open(hmm_file, 'r')
+    except IOError:
+        logging.error("Unable to open " + hmm_file + " for reading!\n")
+        sys.exit(5)
+
+    map_columns = list()
+    has_map = False
+    alphabet_size = 0
+    for line in hmm:
+        if re.match(r"^MAP\s+yes", line):
+            has_map = True
+        elif re.match(r"^HMM\s", line):
+            alphabet_size = len(line.split()) - 1
+            break
+    if has_map:
+        # Match state lines begin with the state number, followed by the emissions and then the MAP column
+        for line in hmm:
+            fields = line.split()
+            if fields and fields[0].isdigit() and len(fields) > alphabet_size + 1:
+                map_columns.append(int(fields[alphabet_size + 1]) - 1)
+    hmm.close()
+
+    return map_columns
+
+
 def best_match(matches):
     """
     Function for finding the best alignment in a list of HmmMatch() objects
@@ -152,6 +261,10 @@ def parse_domain_tables(args, hmm_domtbl_files):
         rp_marker, reference = re.sub("_domtbl.txt", '', os.path.basename(domtbl_file)).split("_to_")
         domain_table = DomainTableParser(domtbl_file)
         domain_table.read_domtbl_lines()
+        # Drop the unsplit alignments that fail the thresholds before any HmmMatch objects are created for them
+        single_dropped = domain_table.drop_poor_single_hits(float(args.min_acc), float(args.min_e), args.perc_aligned)
+        dropped += single_dropped
+        raw_alignments += single_dropped
         distinct_matches, fragmented, glued, multi_alignments, raw_alignments = format_split_alignments(domain_table,
                                                                                                         fragmented,
                                                                                                         glued,
@@ -361,27 +474,121 @@ def tax_ids_file_to_leaves(tax_ids_file):
     return tree_leaves
 
 
+def index_leaf_lineages(tree_leaves):
+    """
+    Maps the number of each leaf in a reference tree to its cleaned lineage, or its cleaned description if the
+    lineage is not known, so the lineages of placed sequences can be looked up rather than searched for
+
+    :param tree_leaves: A list of TreeLeafReference objects
+    :return: Dictionary of leaf numbers mapped to cleaned lineage strings
+    """
+    leaf_lineages = dict()
+    for leaf in tree_leaves:
+        if leaf.complete:
+            leaf_lineages[leaf.number] = clean_lineage_string(leaf.lineage)
+        else:
+            leaf_lineages[leaf.number] = clean_lineage_string(leaf.description)
+    return leaf_lineages
+
+
+def leaf_taxonomy_arrays(tree_leaves, leaf_lineages, taxonomy):
+    """
+    Flattens a marker's reference leaves, their cleaned lineages and its TaxonomyTrie into numpy arrays
+
+    :param tree_leaves: A list of TreeLeafReference objects
+    :param leaf_lineages: Dictionary of leaf numbers mapped to cleaned lineage strings
+    :param taxonomy: The TaxonomyTrie of the leaves' lineages
+    :return: Dictionary of array names mapped to numpy arrays, read by leaf_taxonomy_from_arrays
+    """
+    return {"numbers": np.array([leaf.number for leaf in tree_leaves], dtype=str),
+            "descriptions": np.array([leaf.description for leaf in tree_leaves], dtype=str),
+            "lineages": np.array([leaf.lineage for leaf in tree_leaves], dtype=str),
+            "cleaned": np.array([leaf_lineages[leaf.number] for leaf in tree_leaves], dtype=str),
+            "names": np.array(taxonomy.names, dtype=str),
+            "node_names": np.array(taxonomy.node_names, dtype=np.int64),
+            "parents": np.array(taxonomy.parents, dtype=np.int64),
+            "counts": np.array(taxonomy.counts, dtype=np.int64)}
+
+
+def leaf_taxonomy_from_arrays(arrays):
+    """
+    :param arrays: A mapping of the array names written by leaf_taxonomy_arrays to their arrays (e.g. a loaded .npz)
+    :return: A list of TreeLeafReference objects, a dictionary of leaf numbers mapped to cleaned lineage strings
+     and a TaxonomyTrie with the taxonomic counts of the reference lineages
+    """
+    tree_leaves = list()
+    numbers = arrays["numbers"].tolist()
+    for number, description, lineage in zip(numbers, arrays["descriptions"].tolist(), arrays["lineages"].tolist()):
+        leaf = TreeLeafReference(number, description)
+        if lineage:
+            leaf.lineage = lineage
+            leaf.complete = True
+        tree_leaves.append(leaf)
+    leaf_lineages = dict(zip(numbers, arrays["cleaned"].tolist()))
+    taxonomy = TaxonomyTrie()
+    names = arrays["names"].tolist()
+    node_names = arrays["node_names"].tolist()
+    parents = arrays["parents"].tolist()
+    for node in range(1, len(parents)):
+        taxonomy.add_rank(parents[node], names[node_names[node]])
+    taxonomy.counts = arrays["counts"].tolist()
+    return tree_leaves, leaf_lineages, taxonomy
+
+
+def load_leaf_taxonomy(tax_ids_file, cache_file):
+    """
+    Loads a marker's reference leaves, their cleaned lineages and the TaxonomyTrie of those lineages from cache_file,
+    parsing tax_ids_file and saving the results first if cache_file does not exist or is older than tax_ids_file.
+
+    :param tax_ids_file: Path to a marker's tax_ids file
+    :param cache_file: Path to the numpy .npz file to cache the marker's taxonomy in
+    :return: A list of TreeLeafReference objects, a dictionary of leaf numbers mapped to cleaned lineage strings
+     and a TaxonomyTrie with the taxonomic counts of the reference lineages
+    """
+    if os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(tax_ids_file):
+        return leaf_taxonomy_from_arrays(np.load(cache_file))
+
+    tree_leaves = tax_ids_file_to_leaves(tax_ids_file)
+    leaf_lineages = index_leaf_lineages(tree_leaves)
+    taxonomy = TaxonomyTrie()
+    for leaf in tree_leaves:
+        if leaf.complete:
+            taxonomy.add_lineage(leaf_lineages[leaf.number])
+        else:
+            taxonomy.add_lineage("")
+    # Written to a temporary file and moved into place so concurrent runs never load a partially written cache
+    temp_file = cache_file + '.' + str(os.getpid()) + ".tmp"
+    try:
+        with open(temp_file, 'wb') as cache_handler:
+            np.savez(cache_handler, **leaf_taxonomy_arrays(tree_leaves, leaf_lineages, taxonomy))
+        os.replace(temp_file, cache_file)
+    except IOError:
+        logging.debug("Unable to write the taxonomy cache " + cache_file + "\n")
+    return tree_leaves, leaf_lineages, taxonomy
+
+
 def read_species_translation_files(args, marker_build_dict):
     """
     :param args:
     :param marker_build_dict: A dictionary (indexed by marker 5-character 'denominator's) mapping MarkerBuild objects
-    :return: The taxonomic identifiers for each of the organisms in a tree for all trees
+    :return: The taxonomic identifiers for each of the organisms in a tree for all trees,
+     a dictionary of each marker's leaf numbers mapped to their cleaned lineages (from index_leaf_lineages)
+     and a dictionary of each marker's TaxonomyTrie
     """
 
     tree_numbers_translation = dict()
-    translation_files = dict()
+    leaf_lineages = dict()
+    taxonomies = dict()
     tree_resources_dir = os.sep.join([args.treesapp, "data", "tree_data"]) + os.sep
 
     for denominator in sorted(marker_build_dict.keys()):
         marker_build_obj = marker_build_dict[denominator]
-        filename = 'tax_ids_' + str(marker_build_obj.cog) + '.txt'
-        translation_files[denominator] = tree_resources_dir + filename
+        tax_ids_file = tree_resources_dir + 'tax_ids_' + str(marker_build_obj.cog) + '.txt'
+        cache_file = tree_resources_dir + str(marker_build_obj.cog) + '_taxonomy.npz'
+        tree_numbers_translation[denominator], leaf_lineages[denominator], taxonomies[denominator] = \
+            load_leaf_taxonomy(tax_ids_file, cache_file)
 
-    for denominator in sorted(translation_files.keys()):
-        filename = translation_files[denominator]
-        tree_numbers_translation[denominator] = tax_ids_file_to_leaves(filename)
-
-    return tree_numbers_translation
+    return tree_numbers_translation, leaf_lineages, taxonomies
 
 
 def xml_parser(xml_record, term):
@@ -477,39 +684,167 @@ def read_phylip_to_dict(phylip_input):
     return seq_dict
 
 
-def read_stockholm_to_dict(sto_file):
+def read_stockholm_chunks(sto_handler):
     """
+    Collects the interleaved blocks of each sequence in a Stockholm-formatted multiple alignment, without joining or
+    translating them, so large alignments are read with a single pass and no repeated string concatenation.
 
-    :param sto_file: A Stockholm-formatted multiple alignment file
+    :param sto_handler: An open Stockholm file (or an iterable of its lines)
+    :return: A dictionary with sequence headers as keys and lists of their raw sequence blocks, in file order, as values
+    :raises ValueError: With the offending line, if a sequence line does not have exactly two fields
+    """
+    seq_chunks = dict()
+    for line in sto_handler:
+        fields = line.split()
+        if not fields or fields[0][0] in "#|/":
+            # Skip the header (first line), blank lines as well as secondary structure and annotation lines
+            continue
+        if len(fields) != 2:
+            raise ValueError(line.strip())
+        seq_name, sequence = fields
+        if seq_name not in seq_chunks:
+            seq_chunks[seq_name] = list()
+        seq_chunks[seq_name].append(sequence)
+
+    return seq_chunks
+
+
+def parse_stockholm(sto_handler):
+    """
+    Reads the sequences of a Stockholm-formatted multiple alignment, converting them to upper-case and '.' gaps to '-'
+
+    :param sto_handler: An open Stockholm file (or an iterable of its lines)
     :return: A dictionary with sequence headers as keys and sequences as values
+    :raises ValueError: With the offending line, if a sequence line does not have exactly two fields
     """
+    seq_chunks = read_stockholm_chunks(sto_handler)
     seq_dict = dict()
+    for seq_name in seq_chunks:
+        seq_dict[seq_name] = "".join(seq_chunks[seq_name]).translate(_stockholm_translation)
 
-    try:
-        sto_handler = open(sto_file, 'r')
-    except IOError:
-        logging.error("Unable to open " + sto_file + " for reading!\n")
-        sys.exit(3)
+    return seq_dict
 
-    line = sto_handler.readline()
-    while line:
+
+def convert_stockholm(sto_handler, out_handler, output_format="fasta", truncate_names=False):
+    """
+    Converts a Stockholm-formatted multiple alignment to either FASTA or strict, interleaved Phylip format.
+    Sequences are converted to upper-case, '.' gaps to '-', and written in the sorted order of their names.
+    The sequence blocks are translated and written as they are, so no whole-alignment string is ever built.
+    The Phylip layout is that of write_phy_file: names padded to 11 characters, then 50 columns per block in groups of 10.
+
+    :param sto_handler: An open Stockholm file (or an iterable of its lines)
+    :param out_handler: A file handler, open for writing, to write the converted alignment to
+    :param output_format: Either "fasta" or "phylip"
+    :param truncate_names: Flag indicating whether to truncate each sequence name at its first underscore.
+     If this makes two names identical, only the sequence appearing last in the Stockholm file is written.
+    :return: Tuple of the number of sequences and alignment length written
+    :raises ValueError: If a sequence line does not have exactly two fields, the aligned sequences are not all the
+     same length, a Phylip sequence name is longer than 10 characters, or output_format is not recognized
+    """
+    if output_format not in ["fasta", "phylip"]:
+        raise ValueError("Unrecognized alignment output format '" + str(output_format) + "'.")
+
+    seq_chunks = read_stockholm_chunks(sto_handler)
+    names = dict()
+    for seq_name in seq_chunks:
+        if truncate_names:
+            names[seq_name.split('_')[0]] = seq_name
+        else:
+            names[seq_name] = seq_name
+
+    alignment_length = -1
+    for seq_name in names.values():
+        seq_length = sum(len(chunk) for chunk in seq_chunks[seq_name])
+        if alignment_length < 0:
+            alignment_length = seq_length
+        elif seq_length != alignment_length:
+            raise ValueError("Number of aligned columns is inconsistent for sequence '" + seq_name + "'.")
+    alignment_length = max(0, alignment_length)
+
+    if output_format == "fasta":
+        for name in sorted(names):
+            out_handler.write('>' + name + "\n")
+            for chunk in seq_chunks[names[name]]:
+                out_handler.write(chunk.translate(_stockholm_translation))
+            out_handler.write("\n")
+    else:
+        # Interleaving needs every sequence at once, so they are joined and translated one at a time
+        phy_names = list()
+        aligned_seqs = list()
+        for name in sorted(names):
+            if len(name) > 10:
+                raise ValueError("Sequence name '" + name + "' is too long for the Phylip format.")
+            phy_names.append(name.ljust(11))
+            aligned_seqs.append("".join(seq_chunks.pop(names[name])).translate(_stockholm_translation))
+        out_handler.write(' ' + str(len(aligned_seqs)) + ' ' + str(alignment_length) + "\n")
+        for block in interleave_phylip_blocks(phy_names, aligned_seqs):
+            out_handler.write(block)
+
+    return len(names), alignment_length
+
+
+def parse_stockholm_states(sto_handler):
+    """
+    Reads the sequences of a Stockholm alignment written by hmmalign in terms of the profile HMM's states: the residue
+    (or '-' for a deletion) aligned to each match state and the residues inserted before, between and after them.
+    Match state columns are those marked 'x' in the #=GC RF line.
+
+    :param sto_handler: An open Stockholm file (or an iterable of its lines) written by hmmalign
+    :return: A dictionary with sequence headers as keys and tuples of (match state string, list of insert strings) as
+     values. There is one more insert string than match states, the first and last being the N- and C-terminal flanks.
+     All residues are upper-case.
+    :raises ValueError: With the offending line, if a sequence line does not have exactly two fields
+    """
+    aligned_seqs = dict()
+    reference_annotation = ""
+    for line in sto_handler:
         line = line.strip()
-        if re.match("^[#|/].*", line):
-            # Skip the header (first line) as well as secondary structure lines
-            pass
-        elif not line:
+        if line.startswith("#=GC RF"):
+            reference_annotation += line.split()[-1]
+        elif not line or re.match("^[#|/].*", line):
             pass
         else:
             try:
                 seq_name, sequence = line.split()
             except ValueError:
-                logging.error("Unexpected line format in " + sto_file + ":\n" + line + "\n")
-                sys.exit(3)
+                raise ValueError(line)
+            if seq_name not in aligned_seqs:
+                aligned_seqs[seq_name] = list()
+            aligned_seqs[seq_name].append(sequence)
 
-            if seq_name not in seq_dict:
-                seq_dict[seq_name] = ""
-            seq_dict[seq_name] += re.sub('\.', '-', sequence.upper())
-        line = sto_handler.readline()
+    seq_dict = dict()
+    for seq_name in aligned_seqs:
+        matches = list()
+        inserts = [[]]
+        for annotation, character in zip(reference_annotation, "".join(aligned_seqs[seq_name])):
+            if annotation == 'x':
+                matches.append(character.upper())
+                inserts.append([])
+            elif character not in ".-":
+                inserts[-1].append(character.upper())
+        seq_dict[seq_name] = ("".join(matches), ["".join(insert) for insert in inserts])
+
+    return seq_dict
+
+
+def read_stockholm_to_dict(sto_file):
+    """
+
+    :param sto_file: A Stockholm-formatted multiple alignment file
+    :return: A dictionary with sequence headers as keys and sequences as values
+    """
+    try:
+        sto_handler = open(sto_file, 'r')
+    except IOError:
+        logging.error("Unable to open " + sto_file + " for reading!\n")
+        sys.exit(3)
+
+    try:
+        seq_dict = parse_stockholm(sto_handler)
+    except ValueError as error:
+        logging.error("Unexpected line format in " + sto_file + ":\n" + str(error) + "\n")
+        sys.exit(3)
+    sto_handler.close()
 
     return seq_dict
 
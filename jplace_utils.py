@@ -2,68 +2,50 @@ __author__ = 'Connor Morgan-Lang'
 
 import sys
 import re
-import glob
-import os
 import logging
-from classy import ItolJplace, TreeProtein
-from json import load, loads, dumps
-from utilities import clean_lineage_string
+from classy import ItolJplace, TreeProtein, JplacePquery, JplacePlacement
+from json import load, dumps
 
 
-def children_lineage(leaves, pquery, node_map):
+def children_lineage(leaf_lineages, pquery, node_map):
     """
-    From the jplace placement field ()
-    :param leaves:
-    :param pquery:
-    :param node_map:
-    :return:
+    Collects the cleaned lineages of all reference leaves descending from each placement edge of a pquery
+    :param leaf_lineages: Dictionary of a marker's leaf numbers mapped to their cleaned lineages (index_leaf_lineages)
+    :param pquery: A JplacePquery object
+    :param node_map: Dictionary (or JplaceNodeMap) mapping each edge number to the leaves it subtends
+    :return: List of lineage strings
     """
     children = list()
-    placement = loads(pquery, encoding="utf-8")
-    loci = placement['p']
-    for locus in loci:
-        jplace_node = locus[0]
-        tree_leaves = node_map[jplace_node]
-        for tree_leaf in tree_leaves:
-            # ref_leaf is a TreeLeafReference object
-            for ref_leaf in leaves:
-                if ref_leaf.number == tree_leaf:
-                    if ref_leaf.complete:
-                        children.append(clean_lineage_string(ref_leaf.lineage))
-                    else:
-                        children.append(clean_lineage_string(ref_leaf.description))
+    for placement in pquery.placements:
+        for tree_leaf in node_map[placement.edge_num]:
+            if tree_leaf in leaf_lineages:
+                children.append(leaf_lineages[tree_leaf])
     return children
 
 
-def pquery_likelihood_weight_ratio(pquery, position):
+def pquery_likelihood_weight_ratio(pquery):
     """
     Determines the likelihood weight ratio (LWR) for a single placement. There may be multiple placements
     (or 'pquery's) in a single .jplace file. Therefore, this function is usually looped over.
-    :param pquery:
-    :param position: The position of "like_weight_ration" in the pquery fields
+    :param pquery: A JplacePquery object
     :return: The float(LWR) of a single placement
     """
     lwr = 0.0
-    placement = loads(str(pquery), encoding="utf-8")
-    for k, v in placement.items():
-        if k == 'p':
-            acc = 0
-            while acc < len(v):
-                pquery_fields = v[acc]
-                lwr = float(pquery_fields[position])
-                acc += 1
+    for placement in pquery.placements:
+        lwr = float(placement.like_weight_ratio)
     return lwr
 
 
 def jplace_parser(filename):
     """
-    Parses the jplace file using the load function from the JSON library
+    Parses the jplace file using the load function from the JSON library.
+    Each pquery is converted to a JplacePquery here, once, and only serialized again by write_jplace.
     :param filename: jplace file output by RAxML
     :return: ItolJplace object
     """
     itol_datum = ItolJplace()
     with open(filename) as jplace:
-        jplace_dat = load(jplace, encoding="utf-8")
+        jplace_dat = load(jplace)
         itol_datum.tree = jplace_dat["tree"]
         # A list of strings
         if sys.version_info > (2, 9):
@@ -72,8 +54,20 @@ def jplace_parser(filename):
             itol_datum.fields = [x.decode("utf-8") for x in jplace_dat["fields"]]
         itol_datum.version = jplace_dat["version"]
         itol_datum.metadata = jplace_dat["metadata"]
-        # A list of dictionaries of where the key is a string and the value is a list of lists
-        itol_datum.placements = jplace_dat["placements"]
+
+    # The positions of JplacePlacement's arguments in the jplace placement lists
+    try:
+        positions = [itol_datum.fields.index(field) for field in JplacePlacement.__slots__]
+    except ValueError:
+        logging.error("Unexpected fields in " + filename + ": " + ', '.join(itol_datum.fields) + "\n")
+        sys.exit(9)
+    edge_pos, likelihood_pos, lwr_pos, distal_pos, pendant_pos = positions
+    # A list of dictionaries of where the key is a string and the value is a list of lists
+    for pquery in jplace_dat["placements"]:
+        placements = [JplacePlacement(values[edge_pos], values[likelihood_pos], values[lwr_pos],
+                                      values[distal_pos], values[pendant_pos])
+                      for values in pquery["p"]]
+        itol_datum.placements.append(JplacePquery(pquery["n"], placements))
 
     jplace_dat.clear()
 
@@ -87,7 +81,6 @@ def demultiplex_pqueries(jplace_data):
         pquery_obj.transfer(jplace_data)
         pquery_obj.placements = [pquery]
         pquery_obj.name_placed_sequence()
-        pquery_obj.correct_decoding()
         tree_placement_queries.append(pquery_obj)
 
     return tree_placement_queries
@@ -101,27 +94,17 @@ def filter_jplace_data(jplace_data: ItolJplace, tree_saps: list):
     :param tree_saps: List of TreeProtein objects
     :return:
     """
-    jplace_data.correct_decoding()
     jplace_data.filter_max_weight_placement()
     new_placement_collection = list()
-    for d_place in jplace_data.placements:
-        dict_strings = list()
+    for pquery in jplace_data.placements:
         classified = False
-        for k, v in loads(d_place).items():
-            if k == 'n':
-                # Find the TreeProtein that matches the placement (same contig name)
-                for sapling in tree_saps:
-                    if re.match(re.escape(sapling.contig_name) + "_\d+_\d+", v[0]):
-                        # If the TreeProtein is classified, flag to append
-                        classified = sapling.classified
-                dict_strings.append(dumps(k) + ":" + dumps(v))
-            elif k == 'p':
-                dict_strings.append(dumps(k) + ":" + dumps(v))
-            else:
-                logging.error("Unrecognized key '" + str(k) + "' in Jplace \"placements\".")
-                sys.exit(9)
+        # Find the TreeProtein that matches the placement (same contig name)
+        for sapling in tree_saps:
+            if re.match(re.escape(sapling.contig_name) + "_\d+_\d+", pquery.names[0]):
+                # If the TreeProtein is classified, flag to append
+                classified = sapling.classified
         if classified:
-            new_placement_collection.append('{' + ', '.join(dict_strings) + '}')
+            new_placement_collection.append(pquery)
     jplace_data.placements = new_placement_collection
     return jplace_data
 
@@ -145,31 +128,16 @@ def write_jplace(itol_datum: ItolJplace, jplace_file: str):
         logging.error("Unable to open " + jplace_file + " for writing.\n")
         sys.exit(9)
 
-    itol_datum.correct_decoding()
-
     # Begin writing elements to the jplace file
     jplace_out.write('{\n\t"tree": "')
     jplace_out.write(itol_datum.tree + "\", \n")
     jplace_out.write("\t\"placements\": [\n\t")
-    # The [] is lost from 'n': ["query"] during loads
-    new_placement_collection = list()
-    for d_place in itol_datum.placements:
-        dict_strings = list()
-        for k, v in loads(d_place).items():
-            if k == 'n':
-                dict_strings.append(dumps(k) + ":[" + dumps(v) + "]")
-            elif k == 'p':
-                dict_strings.append(dumps(k) + ":" + dumps(v))
-            else:
-                logging.error("Unrecognized key '" + str(k) + "' in Jplace \"placements\".")
-                sys.exit(9)
-        new_placement_collection.append('{' + ', '.join(dict_strings) + '}')
-    jplace_out.write(",\n\t".join(new_placement_collection))
+    jplace_out.write(",\n\t".join([pquery.to_json(itol_datum.fields) for pquery in itol_datum.placements]))
     jplace_out.write("\n\t],\n")
     jplace_out.write("\t\"metadata\": " + re.sub('\'', '"', str(itol_datum.metadata)) + ",\n")
     jplace_out.write("\t\"version\": " + str(itol_datum.version) + ",\n")
     jplace_out.write("\t\"fields\": [\n\t")
-    jplace_out.write(", ".join(itol_datum.fields) + "\n\t]\n}\n")
+    jplace_out.write(", ".join([dumps(field) for field in itol_datum.fields]) + "\n\t]\n}\n")
 
     jplace_out.close()
     return
@@ -204,27 +172,6 @@ def organize_jplace_files(jplace_files):
     return jplace_collection
 
 
-def sub_indices_for_seq_names_jplace(args, numeric_contig_index, marker_build_dict):
-    """
-    Ugly script for running re.sub on a set of jplace files
-    :param args:
-    :param numeric_contig_index:
-    :param marker_build_dict:
-    :return:
-    """
-    jplace_files = glob.glob(args.output_dir_var + '*.jplace')
-    jplace_collection = organize_jplace_files(jplace_files)
-    for denominator, jplace_files in jplace_collection.items():
-        marker = marker_build_dict[denominator].cog
-        for jplace_path in jplace_files:
-            jplace_data = jplace_parser(jplace_path)
-            for pquery in jplace_data.placements:
-                pquery["n"] = numeric_contig_index[marker][int(pquery["n"][0])]
-            write_jplace(jplace_data, args.output_dir_var + os.sep + "tmp.jplace")
-            os.rename(args.output_dir_var + os.sep + "tmp.jplace", jplace_path)
-    return
-
-
 def add_bipartitions(itol_datum, bipartition_file):
     """
     Adds bootstrap values read from a NEWICK tree-file where they are indicated by values is square-brackets
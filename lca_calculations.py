@@ -5,95 +5,95 @@ import sys
 import re
 import logging
 from utilities import median
+from classy import TaxonomyTrie
 
 
-def disseminate_vote_weights(megan_lca, taxonomic_counts, lineages_list):
-    lca_depth = 0
-    max_depth = max([len(lineage) for lineage in lineages_list])
-    nucleus = float(len(lineages_list)/taxonomic_counts[megan_lca])
+def disseminate_vote_weights(lca_node, taxonomy, lineage_nodes):
+    """
+    Splits the votes of the lineages descending from their lowest common ancestor (LCA) among the taxa in the subtree
+
+    :param lca_node: The TaxonomyTrie node ID of the lineages' LCA
+    :param taxonomy: The TaxonomyTrie of the reference package's lineages
+    :param lineage_nodes: TaxonomyTrie node IDs of the lineages
+    :return: Dictionary of vote weights for each node, the taxonomic subtree as a dictionary of node IDs mapped to
+     the set of their children and the vote weight needed for a majority
+    """
+    lca_depth = taxonomy.depths[lca_node]
+    max_depth = max([taxonomy.depths[node] for node in lineage_nodes])
+    nucleus = float(len(lineage_nodes)/taxonomy.counts[lca_node])
     vote_weights = dict()
     taxonomic_tree = dict()
     subtree_taxonomic_counts = dict()
-    vote_weights[megan_lca] = nucleus
-    taxonomic_tree[megan_lca] = set()
-
-    # Find the depth of the LCA
-    while "; ".join(lineages_list[0][:lca_depth]) != megan_lca:
-        lca_depth += 1
+    vote_weights[lca_node] = nucleus
+    taxonomic_tree[lca_node] = set()
 
     # Load the taxonomic subtree into a dictionary
     while lca_depth < max_depth:
-        for lineage in lineages_list:
-            taxonomic_lineage = "; ".join(lineage[0:lca_depth+1])
-            parent = "; ".join(lineage[0:lca_depth])
-            if parent == taxonomic_lineage:
+        for node in lineage_nodes:
+            path = taxonomy.paths[node]
+            if len(path) <= lca_depth:
                 continue
-            if taxonomic_lineage not in taxonomic_tree:
-                taxonomic_tree[taxonomic_lineage] = set()
-            if taxonomic_lineage not in subtree_taxonomic_counts:
-                subtree_taxonomic_counts[taxonomic_lineage] = 0
-            subtree_taxonomic_counts[taxonomic_lineage] += 1
-            taxonomic_tree[parent].add(taxonomic_lineage)
+            taxon = path[lca_depth]
+            parent = taxonomy.parents[taxon]
+            if taxon not in taxonomic_tree:
+                taxonomic_tree[taxon] = set()
+            if taxon not in subtree_taxonomic_counts:
+                subtree_taxonomic_counts[taxon] = 0
+            subtree_taxonomic_counts[taxon] += 1
+            taxonomic_tree[parent].add(taxon)
         lca_depth += 1
 
     # Calculate the vote weights for each taxonomic lineage based on it's parent's and polyphyly
-    for node in sorted(taxonomic_tree, key=lambda x: x.count(';')):
+    for node in sorted(taxonomic_tree, key=lambda x: taxonomy.depths[x]):
         children = taxonomic_tree[node]
         n_taxa_split = len(children)
         for child in children:
-            taxa_portion = float(subtree_taxonomic_counts[child]/taxonomic_counts[child])
+            taxa_portion = float(subtree_taxonomic_counts[child]/taxonomy.counts[child])
             vote_weights[child] = vote_weights[node] * float(taxa_portion/n_taxa_split)
 
     return vote_weights, taxonomic_tree, nucleus/2
 
 
-def megan_lca(lineage_list: list):
+def megan_lca(lineage_list: list, taxonomy=None):
     """
     Using the lineages of all leaves to which this sequence was mapped (n >= 1),
     A lowest common ancestor is found at the point which these lineages converge.
     This emulates the LCA algorithm employed by the MEtaGenome ANalyzer (MEGAN).
 
     :param lineage_list: List of '; '-separated lineage strings
+    :param taxonomy: A TaxonomyTrie to find the lineages in, which is not modified. Lineages that are not in it are
+     ignored. If not provided, a new one is built from lineage_list.
     :return:
     """
     # If there is only one child, return the joined string
     if len(lineage_list) == 1:
         return "; ".join(lineage_list[0])
 
-    listed_lineages = [lineage.strip().split("; ") for lineage in lineage_list]
-    max_depth = max([len(lineage) for lineage in listed_lineages])
-    lca_set = set()
-    lca_lineage_strings = list()
-    i = 0
-    while i < max_depth:
-        contributors = 0
-        for lineage in sorted(listed_lineages):
-            try:
-                lca_set.add(lineage[i])
-                contributors += 1
-            except IndexError:
-                pass
-
-        if len(lca_set) == 1 and contributors == len(listed_lineages):
-            lca_lineage_strings.append(list(lca_set)[0])
-            i += 1
-            lca_set.clear()
-        else:
-            i = max_depth
-    if len(lca_lineage_strings) == 0:
+    if taxonomy is None:
+        taxonomy = TaxonomyTrie()
+        for lineage in lineage_list:
+            taxonomy.insert(lineage.strip())
+    lineage_nodes = [taxonomy.find(lineage.strip()) for lineage in lineage_list]
+    lineage_nodes = [node for node in lineage_nodes if node is not None]
+    if len(lineage_nodes) == 0:
+        lca_node = 0
+    else:
+        lca_node = taxonomy.lowest_common_ancestor(lineage_nodes)
+    if lca_node == 0:
         logging.debug("Empty LCA from lineages:\n\t" + "\n\t".join(lineage_list) + "\n")
-        lca_lineage_strings.append("Unclassified")
+        return "Unclassified"
 
-    return "; ".join(lca_lineage_strings)
+    return taxonomy.lineages[lca_node]
 
 
-def lowest_common_taxonomy(children, megan_lca, taxonomic_counts, algorithm="LCA*"):
+def lowest_common_taxonomy(children, megan_lca, taxonomy, algorithm="LCA*"):
     """
     Input is a list >= 2, potentially either a leaf string or NCBI lineage
 
     :param children: Lineages of all leaves for this sequence
     :param megan_lca:
-    :param taxonomic_counts:
+    :param taxonomy: The TaxonomyTrie of the reference package's lineages, with their taxonomic counts.
+     Children with lineages that are not in it are ignored.
     :param algorithm: A string indicating what lowest common ancestor algorithm should be used [ MEGAN | LCA* | LCAp ]
     :return: string - represent the consensus lineage for that node
     """
@@ -101,18 +101,21 @@ def lowest_common_taxonomy(children, megan_lca, taxonomic_counts, algorithm="LCA
     # Check that children have lineage information and discard those that don't have a known lineage
     # (e.g. unclassified sequences; metagenomes; ecological metagenomes)
     max_ranks = 0
+    child_nodes = list()
     for child in children:
-        # child = clean_lineage_string(child)
-        ranks = child.split("; ")
-        num_ranks = len(ranks)
+        node = taxonomy.find(child)
+        if node is None:
+            logging.debug("Lineage '" + child + "' is not in the reference taxonomy and will be ignored.\n")
+        else:
+            child_nodes.append(node)
+    for node in child_nodes:
+        num_ranks = taxonomy.depths[node]
         if num_ranks > 3:
-            lineages_considered.append(ranks)
+            lineages_considered.append(node)
         if num_ranks > max_ranks:
             max_ranks = num_ranks
-    # print("All children:", children)
-    # print("Lineages considered:", lineages_considered)
     if len(lineages_considered) == 0:
-        lineages_considered = [child.split("; ") for child in children]
+        lineages_considered = child_nodes
 
     if algorithm == "MEGAN":
         # Already calculated by tree_sap.megan_lca()
@@ -121,22 +124,22 @@ def lowest_common_taxonomy(children, megan_lca, taxonomic_counts, algorithm="LCA
         # approximate LCA* (no entropy calculations):
         hits = dict()
         consensus = list()
+        majority = float(len(lineages_considered)/2)
         i = 0  # The accumulator to guarantee the lineages are parsed from Kingdom -> Strain
         while i < max_ranks:
             hits.clear()
-            lineages_used = 0
             elected = False
-            for ranks in lineages_considered:
+            for node in lineages_considered:
+                path = taxonomy.paths[node]
                 # If the ranks of this hit has not been exhausted (i.e. if it has a depth of 4 and max_ranks >= 5)
-                if len(ranks) > i:
-                    taxonomy = ranks[i]
-                    if taxonomy not in hits.keys():
-                        hits[taxonomy] = 0
-                    hits[taxonomy] += 1
-                    lineages_used += 1
-            for taxonomy in hits.keys():
-                if hits[taxonomy] > float(len(lineages_considered)/2):
-                    consensus.append(str(taxonomy))
+                if len(path) > i:
+                    name_id = taxonomy.node_names[path[i]]
+                    if name_id not in hits:
+                        hits[name_id] = 0
+                    hits[name_id] += 1
+            for name_id in hits:
+                if hits[name_id] > majority:
+                    consensus.append(taxonomy.names[name_id])
                     elected = True
 
             # If there is no longer a consensus, break the loop
@@ -146,14 +149,19 @@ def lowest_common_taxonomy(children, megan_lca, taxonomic_counts, algorithm="LCA
         lineage_string = "; ".join(consensus)
     elif algorithm == "LCAp":
         lineage_string = megan_lca
-        vote_weights, t_tree, majority = disseminate_vote_weights(megan_lca, taxonomic_counts, lineages_considered)
-        for parent in sorted(t_tree, key=lambda x: x.count(';')):
+        if len(lineages_considered) == 0:
+            return lineage_string
+        lca_node = taxonomy.find(megan_lca) if megan_lca else 0
+        if lca_node is None:
+            lca_node = taxonomy.lowest_common_ancestor(lineages_considered)
+        vote_weights, t_tree, majority = disseminate_vote_weights(lca_node, taxonomy, lineages_considered)
+        for parent in sorted(t_tree, key=lambda x: taxonomy.depths[x]):
             if len(t_tree[parent]) == 0:
                 break
             children = t_tree[parent]
             for child in children:
                 if vote_weights[child] > majority:
-                    lineage_string = child
+                    lineage_string = taxonomy.lineages[child]
                 else:
                     pass
     else:
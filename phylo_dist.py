@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import sys
+import os
 import re
 import logging
 from ete3 import Tree
@@ -219,6 +220,219 @@ def parent_to_tip_distances(parent: Tree, children: Tree, estimate=False):
     return branch_distances
 
 
+class TreeDistanceIndex:
+    """
+    Precomputed distances of a reference tree, for answering the distance queries of filter_placements with array
+    lookups rather than traversing an ete3 Tree for every placement.
+    Nodes are numbered in the pre-order of ete3's Tree.traverse() and the lowest common ancestor of any nodes is found
+    with a range-minimum query over the Euler tour of the tree.
+    """
+    def __init__(self, parents, dists, names, euler, first):
+        self.parents = parents  # The parent of each node (-1 for the root)
+        self.dists = dists  # The length of the branch leading to each node
+        self.names = names  # The name of each node
+        self.euler = euler  # The nodes in the order they are visited by an Euler tour
+        self.first = first  # The position in euler of each node's first visit
+        self.leaf_ids = dict()
+        self.depths = np.zeros(len(parents))
+        self.levels = np.zeros(len(parents), dtype=np.int64)
+        self.max_leaf_depths = np.zeros(len(parents))
+        self.leaf_counts = np.zeros(len(parents), dtype=np.int64)
+        self.tip_distance_sums = np.zeros(len(parents))  # Summed path lengths from each node to its leaves
+        self.sisters = np.zeros(len(parents), dtype=np.int64)
+        self.sparse_table = list()
+        self._index()
+
+    def _index(self):
+        # Parents precede their children in pre-order so the depths can be accumulated in a single pass
+        for node in range(1, len(self.parents)):
+            parent = self.parents[node]
+            self.depths[node] = self.depths[parent] + self.dists[node]
+            self.levels[node] = self.levels[parent] + 1
+        is_leaf = np.ones(len(self.parents), dtype=bool)
+        is_leaf[self.parents[1:]] = False
+        self.max_leaf_depths = np.where(is_leaf, self.depths, -np.inf)
+        self.leaf_counts = is_leaf.astype(np.int64)
+        self.tip_distance_sums = np.zeros(len(self.parents))
+        # Accumulate the subtree statistics into the parents one level at a time, deepest first
+        for level in range(int(self.levels.max()), 0, -1):
+            nodes = np.flatnonzero(self.levels == level)
+            np.maximum.at(self.max_leaf_depths, self.parents[nodes], self.max_leaf_depths[nodes])
+            np.add.at(self.leaf_counts, self.parents[nodes], self.leaf_counts[nodes])
+            np.add.at(self.tip_distance_sums, self.parents[nodes],
+                      self.tip_distance_sums[nodes] + self.leaf_counts[nodes] * self.dists[nodes])
+        # The first of each node's sisters, in the order of ete3's Node.get_sisters()
+        self.sisters = np.full(len(self.parents), -1, dtype=np.int64)
+        children = dict()
+        for node in range(1, len(self.parents)):
+            parent = int(self.parents[node])
+            if parent not in children:
+                children[parent] = list()
+            children[parent].append(node)
+        for parent in children:
+            for node in children[parent]:
+                for sister in children[parent]:
+                    if sister != node:
+                        self.sisters[node] = sister
+                        break
+        for node in np.flatnonzero(is_leaf):
+            self.leaf_ids[str(self.names[node])] = int(node)
+
+        # Sparse table of the positions in the Euler tour with the minimum level, for constant-time range queries
+        euler_levels = self.levels[self.euler]
+        positions = np.arange(len(self.euler))
+        self.sparse_table = [positions]
+        span = 1
+        while 2 * span <= len(self.euler):
+            previous = self.sparse_table[-1]
+            left = previous[:len(previous) - span]
+            right = previous[span:]
+            self.sparse_table.append(np.where(euler_levels[left] <= euler_levels[right], left, right))
+            span *= 2
+        return
+
+    def farthest_leaf_distance(self):
+        """
+        :return: The distance from the root to its farthest leaf, equivalent to ete3's Tree.get_farthest_leaf()[1]
+        """
+        return float(self.max_leaf_depths[0])
+
+    def leaf(self, leaf_name):
+        return self.leaf_ids[str(leaf_name)]
+
+    def lca(self, nodes):
+        """
+        :param nodes: A list of node numbers
+        :return: The node number of the lowest common ancestor of nodes
+        """
+        firsts = self.first[nodes]
+        start, end = int(firsts.min()), int(firsts.max())
+        k = (end - start + 1).bit_length() - 1
+        left = self.sparse_table[k][start]
+        right = self.sparse_table[k][end - (1 << k) + 1]
+        if self.levels[self.euler[left]] <= self.levels[self.euler[right]]:
+            return int(self.euler[left])
+        return int(self.euler[right])
+
+    def distances_to_ancestor(self, ancestor, nodes):
+        """
+        :param ancestor: A node number
+        :param nodes: A list of node numbers descended from ancestor
+        :return: A numpy array of the path lengths between ancestor and each of nodes
+        """
+        return self.depths[nodes] - self.depths[ancestor]
+
+    def max_tip_distance(self, node):
+        """
+        :param node: A node number
+        :return: The longest path length from node to one of its descendent leaves
+        """
+        return float(self.max_leaf_depths[node] - self.depths[node])
+
+    def mean_tip_distance(self, node):
+        """
+        :param node: A node number
+        :return: The mean path length from node to each of its descendent leaves
+        """
+        return float(self.tip_distance_sums[node] / self.leaf_counts[node])
+
+    def find_cluster(self, lost_node):
+        """
+        Function for determining the ancestor of the cluster which lost_node belongs to.
+        Walks up from lost_node while the mean distance to its leaves exceeds the distance to its parent,
+        scaled by a penalty for increasing the size of the clade.
+
+        :param lost_node: A node number within the tree, for which we want to orient
+        :return: The node number of the cluster's ancestor
+        """
+        parent = self.parents[lost_node]
+        if parent == -1 or self.parents[parent] == -1:
+            return lost_node
+
+        while True:
+            # Find the intra-cluster leaf distances
+            mean_intra = self.mean_tip_distance(lost_node)
+            # Penalty for increasing the size of the clade
+            sister = self.sisters[lost_node]
+            if sister == -1:
+                # An only child gains no leaves by moving up to its parent
+                cousins = 0
+            else:
+                cousins = self.leaf_counts[sister]
+            parent_dist = self.dists[lost_node] * np.log2(cousins + 1)
+            if mean_intra <= parent_dist:
+                break
+            lost_node = int(parent)
+            parent = self.parents[lost_node]
+            if parent == -1:
+                break
+        return lost_node
+
+    def save(self, index_file):
+        # Written to a temporary file and moved into place so concurrent runs never load a partially written index
+        temp_file = index_file + '.' + str(os.getpid()) + ".tmp"
+        with open(temp_file, 'wb') as index_handler:
+            np.savez(index_handler, parents=self.parents, dists=self.dists, names=self.names,
+                     euler=self.euler, first=self.first)
+        os.replace(temp_file, index_file)
+        return
+
+
+def build_tree_distance_index(tree: Tree):
+    """
+    Numbers the nodes of an ete3 Tree in pre-order and records the information needed for a TreeDistanceIndex
+
+    :param tree: The root of an ete3 Tree
+    :return: A TreeDistanceIndex
+    """
+    nodes = list(tree.traverse("preorder"))
+    node_ids = dict()
+    for i in range(len(nodes)):
+        node_ids[nodes[i]] = i
+    parents = np.full(len(nodes), -1, dtype=np.int64)
+    dists = np.zeros(len(nodes))
+    names = np.array([str(node.name) for node in nodes])
+    for i in range(1, len(nodes)):
+        parents[i] = node_ids[nodes[i].up]
+        dists[i] = nodes[i].dist
+
+    # Iterative Euler tour, recording a node each time it is entered or returned to
+    euler = list()
+    first = np.zeros(len(nodes), dtype=np.int64)
+    stack = [(0, 0)]
+    while stack:
+        node, child_index = stack.pop()
+        if child_index == 0:
+            first[node] = len(euler)
+        euler.append(node)
+        children = nodes[node].children
+        if child_index < len(children):
+            stack.append((node, child_index + 1))
+            stack.append((node_ids[children[child_index]], 0))
+    return TreeDistanceIndex(parents, dists, names, np.array(euler, dtype=np.int64), first)
+
+
+def load_tree_distance_index(tree_file, index_file):
+    """
+    Loads the TreeDistanceIndex of a reference tree from index_file, building and saving it first if index_file
+    does not exist or is older than tree_file.
+
+    :param tree_file: Path to a NEWICK reference tree
+    :param index_file: Path to the numpy .npz file to cache the index in
+    :return: A TreeDistanceIndex
+    """
+    if os.path.isfile(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(tree_file):
+        index_data = np.load(index_file)
+        return TreeDistanceIndex(index_data["parents"], index_data["dists"], index_data["names"],
+                                 index_data["euler"], index_data["first"])
+    tree_index = build_tree_distance_index(Tree(tree_file))
+    try:
+        tree_index.save(index_file)
+    except IOError:
+        logging.debug("Unable to write the distance index " + index_file + "\n")
+    return tree_index
+
+
 def bound_taxonomic_branch_distances(tree, leaf_taxa_map):
     # Seed the final dictionary to be used for bounding
     taxonomic_rank_distances = dict()
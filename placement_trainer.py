@@ -11,7 +11,7 @@ import numpy as np
 from fasta import read_fasta_to_dict, write_new_fasta, deduplicate_fasta_sequences,\
     trim_multiple_alignment, format_read_fasta
 from file_parsers import tax_ids_file_to_leaves
-from utilities import reformat_fasta_to_phy, write_phy_file, median, clean_lineage_string,\
+from utilities import write_phy_file, median, clean_lineage_string,\
     find_executables, cluster_sequences
 from entrez_utils import read_accession_taxa_map, get_multiple_lineages, build_entrez_queries, \
     write_accession_lineage_map, verify_lineage_information
@@ -320,8 +320,7 @@ def train_placement_distances(rank_training_seqs: dict, taxonomic_ranks: dict,
             logging.debug("\t" + str(leaves_excluded) + " sequences pruned from tree.\n")
 
             # Write the reference MSA with sequences of `taxonomy` removed
-            phy_dict = reformat_fasta_to_phy(dict_for_phy)
-            write_phy_file(temp_ref_phylip_file, phy_dict)
+            write_phy_file(temp_ref_phylip_file, dict_for_phy)
 
             # Copy the tree since we are removing leaves of `taxonomy` and don't want this to be permanent
             tmp_tree = ref_tree.copy(method="deepcopy")
@@ -361,36 +360,29 @@ def train_placement_distances(rank_training_seqs: dict, taxonomic_ranks: dict,
                 top_lwr = 0.5
                 distance = 100
                 top_placement = None
-                seq_name = ''
-                for name, info in pquery.items():
-                    if name == 'p':
-                        for placement in info:
-                            # Only record the best placement's distance
-                            lwr = float(placement[2])
-                            if lwr > top_lwr:
-                                top_lwr = lwr
-                                top_placement = PQuery(taxonomy, rank)
-                                top_placement.inode = placement[0]
-                                top_placement.likelihood = placement[1]
-                                top_placement.lwr = lwr
-                                top_placement.distal = float(placement[3])
-                                top_placement.pendant = float(placement[4])
-                                leaf_children = node_map[int(top_placement.inode)]
-                                if len(leaf_children) > 1:
-                                    # Reference tree with clade excluded
-                                    parent = tmp_tree.get_common_ancestor(leaf_children)
-                                    tip_distances = parent_to_tip_distances(parent, leaf_children)
-                                    top_placement.mean_tip = float(sum(tip_distances)/len(tip_distances))
-                                distance = top_placement.total_distance()
-                    elif name == 'n':
-                        seq_name = info.pop()
-                    else:
-                        logging.error("Unexpected variable in pquery keys: '" + name + "'\n")
-                        sys.exit(33)
-
-                    if top_placement:
-                        top_placement.name = seq_name
-                        pqueries.append(top_placement)
+                for placement in pquery.placements:
+                    # Only record the best placement's distance
+                    lwr = float(placement.like_weight_ratio)
+                    if lwr > top_lwr:
+                        top_lwr = lwr
+                        top_placement = PQuery(taxonomy, rank)
+                        top_placement.inode = placement.edge_num
+                        top_placement.likelihood = placement.likelihood
+                        top_placement.lwr = lwr
+                        top_placement.distal = float(placement.distal_length)
+                        top_placement.pendant = float(placement.pendant_length)
+                        leaf_children = node_map[int(top_placement.inode)]
+                        if len(leaf_children) > 1:
+                            # Reference tree with clade excluded
+                            parent = tmp_tree.get_common_ancestor(leaf_children)
+                            tip_distances = parent_to_tip_distances(parent, leaf_children)
+                            top_placement.mean_tip = float(sum(tip_distances)/len(tip_distances))
+                        distance = top_placement.total_distance()
+                seq_name = pquery.names[-1]
+
+                if top_placement:
+                    top_placement.name = seq_name
+                    pqueries.append(top_placement)
                 if distance < 100:
                     taxonomic_placement_distances[rank].append(distance)
             os.system("rm papara_* RAxML*")
@@ -0,0 +1,274 @@
+__author__ = 'Connor Morgan-Lang'
+
+import sys
+import os
+import logging
+from json import dumps, loads
+
+import numpy as np
+
+from classy import MarkerBuild
+from fasta import read_fasta_to_dict
+from file_parsers import get_hmm_length, load_leaf_taxonomy, leaf_taxonomy_arrays, leaf_taxonomy_from_arrays, \
+    read_ref_build_params, load_marker_builds, read_cog_list, set_marker_descriptions
+from phylo_dist import TreeDistanceIndex, load_tree_distance_index
+
+_bundle_magic = b"TSAPPRPK"
+_bundle_version = 1
+
+
+def _pad(length):
+    """
+    :return: length rounded up to the next multiple of 8, so each array in the bundle starts word-aligned
+    """
+    return (length + 7) // 8 * 8
+
+
+def reference_bundle_path(treesapp_dir):
+    return os.sep.join([treesapp_dir, "data", "ref_packages.bundle"])
+
+
+def compile_reference_bundle(treesapp_dir, bundle_file, reference_data_prefix=''):
+    """
+    Reads the build parameters, leaf taxonomy, reference alignment dimensions, tree distance index and HMM length of
+    every marker in ref_build_parameters.tsv and writes them to a single indexed binary file that ReferenceBundle
+    memory-maps. The file begins with a magic string, the length of a JSON header and the header itself, followed by
+    the raw numpy arrays the header indexes by offset, dtype and shape.
+
+    :param treesapp_dir: Path to the TreeSAPP directory, containing the data directory
+    :param bundle_file: Path to write the bundle to
+    :param reference_data_prefix: Prefix of the alignment_data and hmm_data directories to read (e.g. 'geba_')
+    :return:
+    """
+    data_dir = os.sep.join([treesapp_dir, "data"]) + os.sep
+    tree_data_dir = data_dir + "tree_data" + os.sep
+    alignment_data_dir = data_dir + reference_data_prefix + "alignment_data" + os.sep
+    hmm_data_dir = data_dir + reference_data_prefix + "hmm_data" + os.sep
+    ref_build_parameters = tree_data_dir + "ref_build_parameters.tsv"
+    cog_list_file = tree_data_dir + "cog_list.tsv"
+
+    sources = list()
+    markers = dict()
+    array_table = dict()
+    arrays = list()
+    data_length = 0
+
+    build_param_lines = read_ref_build_params(ref_build_parameters)
+    sources.append(ref_build_parameters)
+    descriptions = read_cog_list(cog_list_file)
+    sources.append(cog_list_file)
+
+    for line in build_param_lines:
+        marker_build = MarkerBuild(line)
+        denominator = marker_build.denominator
+        logging.debug("Compiling " + marker_build.cog + " (" + denominator + ")\n")
+        marker_entry = {"build_params": line,
+                        "description": descriptions.get(denominator),
+                        "alignment_dims": None,
+                        "hmm_length": None,
+                        "taxonomy": None,
+                        "tree_index": None}
+        marker_arrays = dict()
+
+        tax_ids_file = tree_data_dir + "tax_ids_" + marker_build.cog + ".txt"
+        if os.path.isfile(tax_ids_file):
+            tree_leaves, leaf_lineages, taxonomy = load_leaf_taxonomy(tax_ids_file,
+                                                                      tree_data_dir + marker_build.cog + "_taxonomy.npz")
+            marker_arrays["taxonomy"] = leaf_taxonomy_arrays(tree_leaves, leaf_lineages, taxonomy)
+            sources.append(tax_ids_file)
+
+        tree_file = tree_data_dir + marker_build.cog + "_tree.txt"
+        if os.path.isfile(tree_file):
+            tree_index = load_tree_distance_index(tree_file, tree_data_dir + marker_build.cog + "_tree_index.npz")
+            marker_arrays["tree_index"] = {"parents": tree_index.parents, "dists": tree_index.dists,
+                                           "names": tree_index.names, "euler": tree_index.euler,
+                                           "first": tree_index.first}
+            sources.append(tree_file)
+
+        mfa_file = alignment_data_dir + marker_build.cog + ".fa"
+        if os.path.isfile(mfa_file):
+            seq_dict = read_fasta_to_dict(mfa_file)
+            lengths = set([len(seq_dict[seq_name]) for seq_name in seq_dict])
+            if len(lengths) > 1:
+                logging.error("Number of aligned columns is inconsistent in " + mfa_file + "!\n")
+                sys.exit(19)
+            marker_entry["alignment_dims"] = [len(seq_dict), max(lengths) if lengths else 0]
+            sources.append(mfa_file)
+
+        hmm_file = hmm_data_dir + marker_build.cog + ".hmm"
+        if os.path.isfile(hmm_file):
+            marker_entry["hmm_length"] = get_hmm_length(hmm_file)
+            sources.append(hmm_file)
+
+        for group in marker_arrays:
+            marker_entry[group] = dict()
+            for name in marker_arrays[group]:
+                array = np.ascontiguousarray(marker_arrays[group][name])
+                key = denominator + '/' + group + '/' + name
+                marker_entry[group][name] = key
+                array_table[key] = [data_length, array.dtype.str, list(array.shape)]
+                arrays.append(array)
+                data_length = _pad(data_length + array.nbytes)
+        markers[denominator] = marker_entry
+
+    source_stats = dict()
+    for source in sources:
+        source_stats[os.path.relpath(source, treesapp_dir)] = [os.path.getmtime(source), os.path.getsize(source)]
+    header = dumps({"version": _bundle_version,
+                    "reference_data_prefix": reference_data_prefix,
+                    "sources": source_stats,
+                    "markers": markers,
+                    "arrays": array_table}).encode("utf-8")
+
+    tmp_file = bundle_file + '.' + str(os.getpid()) + ".tmp"
+    try:
+        with open(tmp_file, 'wb') as bundle_handler:
+            bundle_handler.write(_bundle_magic)
+            bundle_handler.write(np.array([len(header)], dtype="<u8").tobytes())
+            bundle_handler.write(header)
+            bundle_handler.write(b'\0' * (_pad(16 + len(header)) - 16 - len(header)))
+            for array in arrays:
+                bundle_handler.write(array.tobytes())
+                bundle_handler.write(b'\0' * (_pad(array.nbytes) - array.nbytes))
+        os.replace(tmp_file, bundle_file)
+    except IOError:
+        logging.error("Unable to write the reference package bundle " + bundle_file + "!\n")
+        sys.exit(19)
+
+    logging.info("Compiled " + str(len(markers)) + " reference packages into " + bundle_file + "\n")
+    return
+
+
+class ReferenceBundle:
+    """
+    The reference package data written by compile_reference_bundle, memory-mapped from a single file.
+    Only the JSON header is parsed on load; arrays are views into the mapping that are read when they are accessed.
+    """
+    def __init__(self, bundle_file):
+        self.bundle_file = bundle_file
+        self.buffer = np.memmap(bundle_file, dtype=np.uint8, mode='r')
+        if self.buffer.size < 16 or bytes(self.buffer[:8]) != _bundle_magic:
+            raise ValueError(bundle_file + " is not a TreeSAPP reference package bundle")
+        header_length = int(self.buffer[8:16].view("<u8")[0])
+        header = loads(bytes(self.buffer[16:16 + header_length]).decode("utf-8"))
+        self.data_start = _pad(16 + header_length)
+        self.version = header["version"]
+        self.reference_data_prefix = header["reference_data_prefix"]
+        self.sources = header["sources"]
+        self.markers = header["markers"]
+        self.arrays = header["arrays"]
+
+    def array(self, key):
+        offset, dtype, shape = self.arrays[key]
+        dtype = np.dtype(dtype)
+        start = self.data_start + offset
+        return self.buffer[start:start + int(np.prod(shape)) * dtype.itemsize].view(dtype).reshape(shape)
+
+    def is_current(self, treesapp_dir):
+        """
+        :param treesapp_dir: Path to the TreeSAPP directory the bundle was compiled from
+        :return: True if all of the files the bundle was compiled from are unchanged since it was compiled
+        """
+        if self.version != _bundle_version:
+            return False
+        for source in self.sources:
+            source_path = os.path.join(treesapp_dir, source)
+            if not os.path.isfile(source_path):
+                return False
+            mtime, size = self.sources[source]
+            if os.path.getmtime(source_path) != mtime or os.path.getsize(source_path) != size:
+                return False
+        return True
+
+    def marker_build_dict(self, args):
+        """
+        Equivalent to parse_ref_build_params followed by parse_cog_list
+
+        :param args: Command-line argument object returned by get_options and check_parser_arguments
+        :return: A dictionary (indexed by marker 5-character 'denominator's) mapping MarkerBuild objects
+        """
+        marker_build_dict = load_marker_builds(args, [self.markers[denominator]["build_params"]
+                                                      for denominator in self.markers])
+        descriptions = dict()
+        for denominator in self.markers:
+            if self.markers[denominator]["description"] is not None:
+                descriptions[denominator] = self.markers[denominator]["description"]
+        return set_marker_descriptions(args, marker_build_dict, descriptions, self.bundle_file)
+
+    def leaf_taxonomies(self, marker_build_dict):
+        """
+        Equivalent to read_species_translation_files
+
+        :param marker_build_dict: A dictionary (indexed by marker 5-character 'denominator's) mapping MarkerBuild objects
+        :return: Dictionaries of each marker's TreeLeafReference objects, leaf numbers mapped to cleaned lineages
+         and TaxonomyTrie
+        """
+        tree_numbers_translation = dict()
+        leaf_lineages = dict()
+        taxonomies = dict()
+        for denominator in sorted(marker_build_dict.keys()):
+            taxonomy_keys = self.markers[denominator]["taxonomy"]
+            if taxonomy_keys is None:
+                logging.error("Unable to open the tax_ids file of " + denominator + " when compiling " +
+                              self.bundle_file + "\n")
+                sys.exit(19)
+            arrays = dict()
+            for name in taxonomy_keys:
+                arrays[name] = self.array(taxonomy_keys[name])
+            tree_numbers_translation[denominator], leaf_lineages[denominator], taxonomies[denominator] = \
+                leaf_taxonomy_from_arrays(arrays)
+        return tree_numbers_translation, leaf_lineages, taxonomies
+
+    def alignment_dims(self, marker_build_dict):
+        """
+        Equivalent to get_alignment_dims
+
+        :param marker_build_dict: A dictionary (indexed by marker 5-character 'denominator's) mapping MarkerBuild objects
+        :return: Dictionary of marker denominators mapped to tuples of the number of rows and columns in their
+         reference alignments
+        """
+        alignment_dimensions_dict = dict()
+        for denominator in marker_build_dict:
+            dims = self.markers[denominator]["alignment_dims"]
+            if dims is not None:
+                alignment_dimensions_dict[denominator] = (dims[0], dims[1])
+        return alignment_dimensions_dict
+
+    def tree_distance_index(self, denominator):
+        """
+        :param denominator: The marker's 5-character denominator
+        :return: The TreeDistanceIndex of the marker's reference tree, or None if it was not compiled
+        """
+        index_keys = self.markers[denominator]["tree_index"]
+        if index_keys is None:
+            return None
+        return TreeDistanceIndex(self.array(index_keys["parents"]), self.array(index_keys["dists"]),
+                                 self.array(index_keys["names"]), self.array(index_keys["euler"]),
+                                 self.array(index_keys["first"]))
+
+    def hmm_length(self, denominator):
+        return self.markers[denominator]["hmm_length"]
+
+
+def load_reference_bundle(args):
+    """
+    Memory-maps the compiled reference package bundle, if there is one and it is up to date with the reference data
+
+    :param args: Command-line argument object returned by get_options and check_parser_arguments
+    :return: A ReferenceBundle, or None if the reference data should be parsed from the individual files
+    """
+    bundle_file = reference_bundle_path(args.treesapp)
+    if not os.path.isfile(bundle_file):
+        return None
+    try:
+        reference_bundle = ReferenceBundle(bundle_file)
+    except (ValueError, KeyError):
+        logging.warning("Unable to read " + bundle_file + ". Reference data will be parsed from the data directory.\n")
+        return None
+    if reference_bundle.reference_data_prefix != args.reference_data_prefix or \
+            not reference_bundle.is_current(args.treesapp):
+        logging.warning(bundle_file + " is out of date and will not be used. " +
+                        "Run compile_reference_packages.py to update it.\n")
+        return None
+    logging.debug("Loading reference packages from " + bundle_file + "\n")
+    return reference_bundle
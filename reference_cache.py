@@ -0,0 +1,131 @@
+__author__ = 'Connor Morgan-Lang'
+
+import sys
+import os
+import logging
+import hashlib
+from json import dumps, loads
+
+from fasta import read_fasta_to_dict, get_headers
+from utilities import write_phy_file
+
+# Content hashes of source files, so each is only read once per process while it is unchanged
+_content_hashes = dict()
+
+
+def reference_cache_path(treesapp_dir):
+    return os.sep.join([treesapp_dir, "data", "cache"]) + os.sep
+
+
+def file_content_hash(file_path):
+    """
+    :param file_path: Path to the file to hash
+    :return: The hexadecimal MD5 digest of the file's contents
+    """
+    try:
+        file_stats = os.stat(file_path)
+        hash_key = (file_path, file_stats.st_size, file_stats.st_mtime_ns)
+        if hash_key in _content_hashes:
+            return _content_hashes[hash_key]
+        file_handler = open(file_path, 'rb')
+    except (IOError, OSError):
+        logging.error("Unable to open " + file_path + " for reading!\n")
+        sys.exit(21)
+    content_hash = hashlib.md5()
+    for block in iter(lambda: file_handler.read(1 << 20), b''):
+        content_hash.update(block)
+    file_handler.close()
+    _content_hashes[hash_key] = content_hash.hexdigest()
+    return _content_hashes[hash_key]
+
+
+def cached_artifact_path(cache_dir, source_file, suffix):
+    """
+    Artifacts are addressed by the name and content hash of the file they were derived from, so an artifact is never
+    stale: a modified source file simply maps to a new path. Outdated artifacts are left in place and can be deleted.
+
+    :param cache_dir: Path to the cache directory
+    :param source_file: Path to the file the artifact is derived from
+    :param suffix: Suffix (including the extension) identifying the type of artifact
+    :return: Path of the artifact in cache_dir
+    """
+    source_name = os.path.splitext(os.path.basename(source_file))[0]
+    return cache_dir + source_name + '_' + file_content_hash(source_file) + suffix
+
+
+def _replace_cached_file(temp_file, cache_file):
+    """
+    Moves a fully written artifact into place. Runs sharing the cache may build the same artifact at once, but as the
+    rename is atomic none of them can read a partially written file.
+    """
+    try:
+        os.replace(temp_file, cache_file)
+    except OSError:
+        logging.error("Unable to move " + temp_file + " to " + cache_file + "!\n")
+        sys.exit(21)
+    return
+
+
+def reference_alignment_summary(cache_dir, aligned_fasta):
+    """
+    Loads the dimensions and sequence headers of a reference alignment from the cache, building the cached summary
+    from the alignment if there is none for its current contents.
+
+    :param cache_dir: Path to the cache directory
+    :param aligned_fasta: Path to a FASTA-formatted reference alignment
+    :return: Tuple of the alignment's (number of sequences, number of columns) and a list of its headers, as returned
+     by get_headers
+    """
+    summary_file = cached_artifact_path(cache_dir, aligned_fasta, "_summary.json")
+    if os.path.isfile(summary_file):
+        try:
+            with open(summary_file, 'r') as summary_handler:
+                summary = loads(summary_handler.read())
+            return tuple(summary["dims"]), summary["headers"]
+        except (IOError, ValueError, KeyError):
+            logging.warning("Unable to read " + summary_file + ". It will be rebuilt from " + aligned_fasta + ".\n")
+
+    seq_dict = read_fasta_to_dict(aligned_fasta)
+    seq_lengths = set([len(sequence) for sequence in seq_dict.values()])
+    if len(seq_lengths) > 1:
+        logging.error("Number of aligned columns is inconsistent in " + aligned_fasta + "!\n")
+        sys.exit(21)
+    dims = (len(seq_dict), max(seq_lengths, default=0))
+    headers = get_headers(aligned_fasta)
+
+    temp_file = summary_file + '.' + str(os.getpid()) + ".tmp"
+    try:
+        summary_handler = open(temp_file, 'w')
+    except IOError:
+        logging.error("Unable to open " + temp_file + " for writing!\n")
+        sys.exit(21)
+    summary_handler.write(dumps({"source": aligned_fasta, "dims": dims, "headers": headers}))
+    summary_handler.close()
+    _replace_cached_file(temp_file, summary_file)
+
+    return dims, headers
+
+
+def cached_reference_phylip(cache_dir, aligned_fasta):
+    """
+    Returns the path to a Phylip-formatted copy of a reference alignment, as required by PaPaRa, with each sequence
+    named by its leaf number. The Phylip file is written to the cache the first time the alignment's contents are seen.
+
+    :param cache_dir: Path to the cache directory
+    :param aligned_fasta: Path to a FASTA-formatted reference alignment
+    :return: Path to the cached Phylip file
+    """
+    phylip_file = cached_artifact_path(cache_dir, aligned_fasta, ".phy")
+    if os.path.isfile(phylip_file):
+        return phylip_file
+
+    dims, _ = reference_alignment_summary(cache_dir, aligned_fasta)
+    aligned_fasta_dict = read_fasta_to_dict(aligned_fasta)
+    dict_for_phy = dict()
+    for seq_name in aligned_fasta_dict:
+        dict_for_phy[seq_name.split('_')[0]] = aligned_fasta_dict[seq_name]
+    temp_file = phylip_file + '.' + str(os.getpid()) + ".tmp"
+    write_phy_file(temp_file, dict_for_phy, dims)
+    _replace_cached_file(temp_file, phylip_file)
+
+    return phylip_file
@@ -19,6 +19,8 @@ Fasta::Fasta(char * input, char * output_dir, char * molecule_type) {
     molecule.assign(molecule_type);
     log_file = new char[1000];
     write_buffer = new char[1000];
+    formatted_fasta = NULL;
+    write_offset = 0;
     sprintf(log_file, "%s/fasta_reader_log.txt", output_dir);
 
     fasta_file = new ifstream(input);
@@ -35,7 +37,11 @@ Fasta::Fasta(char * input, char * output_dir, char * molecule_type) {
     }
 }
 
-Fasta::Fasta(void) { clear(); }
+Fasta::Fasta(void) {
+    formatted_fasta = NULL;
+    write_offset = 0;
+    clear();
+}
 
 void Fasta::clear(void) {
     sequence_buffer.clear();
@@ -46,12 +52,30 @@ void Fasta::clear(void) {
 Fasta::~Fasta() {
     fasta_file->close();
     parse_log->close();
+    if (formatted_fasta != NULL) {
+        formatted_fasta->close();
+        delete formatted_fasta;
+    }
     sequence_buffer.clear();
     header_base.clear();
     delete[] write_buffer;
     delete[] log_file;
 }
 
+int Fasta::open_formatted_fasta(char * output_fasta) {
+    /*
+    * Switches the Fasta object to streaming mode: formatted records are written to output_fasta as they are parsed
+    * and only the header, byte offset and length of each sequence is stored in fasta_list
+    */
+    formatted_fasta = new ofstream(output_fasta, ios::out | ios::binary);
+    if ( !formatted_fasta->is_open() ) {
+        cerr << "Unable to open '" << output_fasta << "' for writing. Exiting now!" << endl;
+        exit(0);
+    }
+    write_offset = 0;
+    return 0;
+}
+
 char replace_operators(char it) {
     if (it == ' ' || it == '\t')
         it = '_';
@@ -137,8 +161,40 @@ int Fasta::record_header( string line, std::size_t max_header_length) {
         sprintf(write_buffer, "WARNING: Duplicate header (%s) replaced with %s\n", line.c_str(), new_header.c_str());
         parse_log->write(write_buffer, 44+line.length()+new_header.length());
     }
-    PyList_Append(fasta_list, Py_BuildValue("s", new_header.c_str()));
+    formatted_header = new_header;
+
+    return 0;
+}
 
+int Fasta::append_record( string header, std::size_t max_header_length) {
+    /*
+    * Formats the header and either appends the header and sequence to fasta_list or, in streaming mode,
+    * writes the record to formatted_fasta and appends the header with the sequence's offset and length
+    */
+    PyObject *record;
+    record_header(header, max_header_length);
+    if (formatted_fasta == NULL) {
+        record = Py_BuildValue("s", formatted_header.c_str());
+        PyList_Append(fasta_list, record);
+        Py_DECREF(record);
+        record = Py_BuildValue("s", sequence_buffer.c_str());
+        PyList_Append(fasta_list, record);
+        Py_DECREF(record);
+    }
+    else {
+        formatted_fasta->write(formatted_header.c_str(), formatted_header.length());
+        formatted_fasta->put('\n');
+        write_offset += formatted_header.length() + 1;
+        record = Py_BuildValue("(sLn)",
+                               formatted_header.c_str(),
+                               write_offset,
+                               (Py_ssize_t) sequence_buffer.length());
+        PyList_Append(fasta_list, record);
+        Py_DECREF(record);
+        formatted_fasta->write(sequence_buffer.c_str(), sequence_buffer.length());
+        formatted_fasta->put('\n');
+        write_offset += sequence_buffer.length() + 1;
+    }
     return 0;
 }
 
@@ -256,12 +312,10 @@ int Fasta::parse_fasta(int min_length, std::size_t max_header_length) {
                     else if (status == 2) {
                         sprintf(write_buffer, " %s\n", header.c_str());
                         parse_log->write(write_buffer, 2+header.length());
-                        record_header(header, max_header_length);
-                        PyList_Append(fasta_list, Py_BuildValue("s", sequence_buffer.c_str()));
+                        append_record(header, max_header_length);
                     }
                     else if (status < 2) {
-                        record_header(header, max_header_length);
-                        PyList_Append(fasta_list, Py_BuildValue("s", sequence_buffer.c_str()));
+                        append_record(header, max_header_length);
                     }
                     else
                         return 5;
@@ -289,12 +343,10 @@ int Fasta::parse_fasta(int min_length, std::size_t max_header_length) {
         else if (status == 2) {
             sprintf(write_buffer, " %s\n", header.c_str());
             parse_log->write(write_buffer, 2+header.length());
-            record_header(header, max_header_length);
-            PyList_Append(fasta_list, Py_BuildValue("s", sequence_buffer.c_str()));
+            append_record(header, max_header_length);
         }
         else if (status < 2) {
-            record_header(header, max_header_length);
-            PyList_Append(fasta_list, Py_BuildValue("s", sequence_buffer.c_str()));
+            append_record(header, max_header_length);
         }
         else
             return 5;
@@ -339,3 +391,33 @@ static PyObject *read_format_fasta(PyObject *self, PyObject *args) {
 
     return fasta_object.fasta_list;
 }
+
+static PyObject *write_format_fasta(PyObject *self, PyObject *args) {
+    char * fasta_file;
+    char * output_dir;
+    char * formatted_fasta_file;
+    int min_length;
+    std::size_t max_header_length;
+    char * molecule;
+    if (!PyArg_ParseTuple(args, "sissns", &fasta_file, &min_length, &output_dir, &molecule, &max_header_length,
+                          &formatted_fasta_file)) {
+        return NULL;
+    }
+    /*
+    * Same as read_format_fasta except the formatted records are written to formatted_fasta_file while parsing,
+    * so the sequences are never all held in memory. The list returned holds (header, offset, length) tuples.
+    */
+    Fasta fasta_object(fasta_file, output_dir, molecule);
+    fasta_object.open_formatted_fasta(formatted_fasta_file);
+    int return_status = fasta_object.parse_fasta(min_length, max_header_length);
+    if (return_status > 0)
+        fasta_object.fasta_list = PyList_New(0);
+    if (return_status == 1)
+        fprintf(stderr, "ERROR: The input was not parsed correctly (N_contigs differs from vector size)!\n");
+    if (return_status == 2)
+        fprintf(stderr, "ERROR: Your input file appears to be corrupted. No sequences were found!\n");
+    if (return_status == 3)
+        fprintf(stderr, "ERROR: The majority of sequence(s) are completely ambiguous (only X or N)!\n");
+
+    return fasta_object.fasta_list;
+}
@@ -20,15 +20,24 @@
 using namespace std;
 
 static PyObject *read_format_fasta(PyObject *self, PyObject *args);
+static PyObject *write_format_fasta(PyObject *self, PyObject *args);
 
 static char read_format_fasta_docstring[] =
         "Reads the FASTA file and formats it (checking duplicate headers, ambiguity characters, etc.) for TreeSAPP";
 
+static char write_format_fasta_docstring[] =
+        "Reads and formats the FASTA file like _read_format_fasta, but writes each formatted record to an output file "
+        "as it is parsed and returns a list of (header, sequence offset, sequence length) tuples instead of sequences";
+
 static PyMethodDef module_methods[] = {
         {"_read_format_fasta",
         read_format_fasta,
         METH_VARARGS,
         read_format_fasta_docstring},
+        {"_write_format_fasta",
+        write_format_fasta,
+        METH_VARARGS,
+        write_format_fasta_docstring},
         {NULL, NULL, 0, NULL}
 };
 
@@ -104,6 +113,7 @@ class Fasta {
 protected:
     int record_header( std::string, std::size_t );
     int record_sequence();
+    int append_record( std::string, std::size_t );
 
 public:
     // Initialization functions
@@ -112,11 +122,13 @@ public:
     ~Fasta();
     Fasta( const Fasta& other);
     void clear( void );
+    int open_formatted_fasta( char * );
 
     // Class objects
     std::set<std::string> header_base;
     PyObject *fasta_list;
     std::string sequence_buffer;
+    std::string formatted_header;
     std::string molecule;
     long int N_contigs;
     long int count_ambiguity;
@@ -126,6 +138,8 @@ public:
     char* write_buffer;
     ifstream *fasta_file;
     ofstream *parse_log;
+    ofstream *formatted_fasta;
+    long long write_offset;
 
     // Class functions
     int parse_fasta(int min_length, std::size_t max_header_length);
@@ -1,5 +1,6 @@
 #include <Python.h>
 #include <stdlib.h>
+#include <string.h>
 #include <iostream>
 #include <iomanip>
 #include <stack>
@@ -12,6 +13,7 @@ static PyObject *read_the_reference_tree(PyObject *self, PyObject *args);
 static PyObject *get_parents_and_children(PyObject *self, PyObject *args);
 static PyObject *build_subtrees_newick(PyObject *self, PyObject *args);
 static PyObject *lowest_common_ancestor(PyObject *self, PyObject *args);
+static PyObject *map_jplace_nodes(PyObject *self, PyObject *args);
 char *get_node_relationships(char *tree_string);
 char *split_tree_string(char *tree_string);
 
@@ -23,6 +25,8 @@ static char build_subtrees_newick_docstring[] =
         "Reads the labelled, rooted tree and returns all subtrees in the tree";
 static char lowest_common_ancestor_docstring[] =
         "Calculate lowest common ancestor for a set of nodes in a tree";
+static char map_jplace_nodes_docstring[] =
+        "Parses a jplace tree into its leaves and a post-order table of each node's span of leaves";
 
 //static PyMethodDef module_methods[] = {
 //    {"error_out", (PyCFunction)error_out, METH_NOARGS, NULL},
@@ -46,6 +50,10 @@ static PyMethodDef module_methods[] = {
         lowest_common_ancestor,
         METH_VARARGS,
         lowest_common_ancestor_docstring},
+        {"_map_jplace_nodes",
+        map_jplace_nodes,
+        METH_VARARGS,
+        map_jplace_nodes_docstring},
         {NULL, NULL, 0, NULL}
 };
 
@@ -719,6 +727,83 @@ static PyObject *lowest_common_ancestor(PyObject *self, PyObject *args) {
 }
 
 
+static PyObject *map_jplace_nodes(PyObject *self, PyObject *args) {
+    char* tree_string;
+    if (!PyArg_ParseTuple(args, "s", &tree_string)) {
+        return NULL;
+    }
+
+    std::vector<string> leaves;
+    std::vector<long> nodes;
+    std::vector<long> starts;
+    std::vector<long> ends;
+    // The number of leaves seen when each open parenthesis was reached
+    std::stack<long> open_clades;
+    size_t tree_len = strlen(tree_string);
+    size_t x = 0;
+    while (x < tree_len) {
+        char c = tree_string[x];
+        if (c == '(') {
+            open_clades.push(leaves.size());
+            x++;
+        }
+        else if (c == ',' || c == ';' || c == ' ' || c == '\n' || c == '\t') {
+            x++;
+        }
+        else {
+            // Either a leaf or the label, branch length and edge number following a closing parenthesis
+            size_t y = x + 1;
+            while (y < tree_len && strchr("{,();", tree_string[y]) == NULL)
+                y++;
+            long start;
+            if (c == ')') {
+                if (open_clades.empty()) {
+                    PyErr_SetString(PyExc_ValueError, "Unbalanced parentheses in jplace tree");
+                    return NULL;
+                }
+                start = open_clades.top();
+                open_clades.pop();
+            }
+            else {
+                start = leaves.size();
+                string name (tree_string + x, y - x);
+                leaves.push_back(name.substr(0, name.find(':')));
+            }
+            if (y < tree_len && tree_string[y] == '{') {
+                char* end;
+                long node = strtol(tree_string + y + 1, &end, 10);
+                if (*end != '}') {
+                    PyErr_SetString(PyExc_ValueError, "Unable to parse an edge number in jplace tree");
+                    return NULL;
+                }
+                nodes.push_back(node);
+                starts.push_back(start);
+                ends.push_back(leaves.size());
+                x = (end - tree_string) + 1;
+            }
+            else if (c == ')')
+                x++;
+            else
+                x = y;
+        }
+    }
+
+    // Leaves are returned in reverse order so the leaves of each node's right-most child come first
+    long num_leaves = leaves.size();
+    PyObject *leaf_list = PyList_New(num_leaves);
+    for (long i = 0; i < num_leaves; i++)
+        PyList_SET_ITEM(leaf_list, i, Py_BuildValue("s", leaves[num_leaves - 1 - i].c_str()));
+    PyObject *node_table = PyList_New(nodes.size());
+    for (size_t i = 0; i < nodes.size(); i++)
+        PyList_SET_ITEM(node_table, i, Py_BuildValue("(lll)", nodes[i], num_leaves - ends[i], num_leaves - starts[i]));
+
+    PyObject *node_spans = Py_BuildValue("(OO)", leaf_list, node_table);
+    Py_DECREF(leaf_list);
+    Py_DECREF(node_table);
+    return node_spans;
+}
+
+
 static PyObject *build_subtrees_newick(PyObject *self, PyObject *args) {
     /*
      Function to parse the rooted, assigned tree and find all subtrees of the inserted node
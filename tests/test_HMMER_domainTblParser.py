@@ -0,0 +1,240 @@
+import copy
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from argparse import Namespace
+
+from HMMER_domainTblParser import DomainTableParser, HmmMatch, detect_orientation, scaffold_subalignments,\
+    orient_alignments, consolidate_subalignments, format_split_alignments, filter_poor_hits, filter_incomplete_hits
+
+TREESAPP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+DOMTBL_FILE = TREESAPP_DIR + "test_data" + os.sep + "marker_test_suite_domtbl.txt"
+
+
+def quadratic_scaffold_subalignments(fragmented_alignment_data):
+    """
+    The pairwise scaffold_subalignments that the single pass replaced, to which its decisions are pinned
+    """
+    seq_length_wobble = 1.2
+    accepted_states = ["overlap", "satellite"]
+    i = j = 0
+    while i < len(fragmented_alignment_data):
+        base_aln = fragmented_alignment_data[i]
+        while j < len(fragmented_alignment_data):
+            if j != i:
+                projected_aln = fragmented_alignment_data[j]
+                q_orientation = detect_orientation(base_aln.start, base_aln.end,
+                                                   projected_aln.start, projected_aln.end)
+                p_orientation = detect_orientation(base_aln.pstart, base_aln.pend,
+                                                   projected_aln.pstart, projected_aln.pend)
+                a_new_start = min([base_aln.start, projected_aln.start])
+                a_new_end = max([base_aln.end, projected_aln.end])
+                if q_orientation in accepted_states and p_orientation in accepted_states:
+                    if float(a_new_end - a_new_start) < float(seq_length_wobble * int(base_aln.hmm_len)):
+                        base_aln.start = a_new_start
+                        base_aln.end = a_new_end
+                        base_aln.pstart = min([base_aln.pstart, projected_aln.pstart])
+                        base_aln.pend = max([base_aln.pend, projected_aln.pend])
+                        if base_aln.num > 1:
+                            base_aln.num = min([base_aln.num, projected_aln.num])
+                        base_aln.of -= 1
+                        base_aln.ceval = min([base_aln.ceval, projected_aln.ceval])
+                        fragmented_alignment_data.pop(j)
+                        j -= 1
+            j += 1
+        i += 1
+    return fragmented_alignment_data
+
+
+def quadratic_orient_alignments(fragmented_alignment_data):
+    """
+    The pairwise orient_alignments that the interval sweep replaced, to which its decisions are pinned
+    """
+    alignment_relations = dict()
+    i = 0
+    j = 0
+    while i < len(fragmented_alignment_data):
+        initial_start = fragmented_alignment_data[i].start
+        initial_stop = fragmented_alignment_data[i].end
+        while j < len(fragmented_alignment_data):
+            if j != i:
+                alignment_relations[(i, j)] = detect_orientation(initial_start,
+                                                                 initial_stop,
+                                                                 fragmented_alignment_data[j].start,
+                                                                 fragmented_alignment_data[j].end)
+            j += 1
+        j = i
+        i += 1
+    return alignment_relations
+
+
+def make_match(start, end, pstart, pend, num, of, ceval, hmm_len=100, orf="seq"):
+    hmm_match = HmmMatch()
+    hmm_match.orf = orf
+    hmm_match.target_hmm = "marker"
+    hmm_match.hmm_len = str(hmm_len)
+    hmm_match.start, hmm_match.end = start, end
+    hmm_match.pstart, hmm_match.pend = pstart, pend
+    hmm_match.num, hmm_match.of = num, of
+    hmm_match.ceval = ceval
+    return hmm_match
+
+
+def join_split_decisions(fragmented_alignment_data, scaffold, orient):
+    """
+    Scaffolds, orients and consolidates a copy of a query's sub-alignments
+    :return: The alignment relations that were not 'satellite' and the retained alignments' coordinates
+    """
+    alignments = scaffold(copy.deepcopy(fragmented_alignment_data))
+    alignment_relations = orient(alignments)
+    distinct_alignments = consolidate_subalignments(alignments, alignment_relations, dict())
+    relations = {pair: alignment_relations[pair] for pair in alignment_relations
+                 if alignment_relations[pair] != "satellite"}
+    retained = {name: (aln.start, aln.end, aln.pstart, aln.pend, aln.num, aln.of, aln.ceval)
+                for name, aln in distinct_alignments.items()}
+    return relations, retained
+
+
+class SubalignmentScaffoldingTest(unittest.TestCase):
+    def assert_same_decisions(self, fragmented_alignment_data):
+        self.assertEqual(join_split_decisions(fragmented_alignment_data,
+                                              quadratic_scaffold_subalignments, quadratic_orient_alignments),
+                         join_split_decisions(fragmented_alignment_data,
+                                              scaffold_subalignments, orient_alignments))
+
+    def test_bundled_domain_table(self):
+        domain_table = DomainTableParser(DOMTBL_FILE)
+        domain_table.read_domtbl_lines()
+        queries = dict()
+        while domain_table.next():
+            data = domain_table.alignments
+            if data["of"] == 1:
+                continue
+            key = (data["hmm_name"], data["query"])
+            if key not in queries:
+                queries[key] = list()
+            queries[key].append(make_match(data["qstart"], data["qend"], data["pstart"], data["pend"],
+                                           data["num"], data["of"], data["cEval"], data["hmm_len"], data["query"]))
+        self.assertTrue(len(queries) >= 10)
+
+        num_joined = num_split = 0
+        for key in queries:
+            self.assert_same_decisions(queries[key])
+            retained = join_split_decisions(queries[key], scaffold_subalignments, orient_alignments)[1]
+            if len(retained) < len(queries[key]):
+                num_joined += 1
+            if len(retained) > 1:
+                num_split += 1
+        # The domain table should exercise both decisions
+        self.assertTrue(num_joined > 0)
+        self.assertTrue(num_split > 0)
+
+    def test_overlapping_and_contained(self):
+        # Neighbouring fragments of the profile, scaffolded into a single alignment
+        self.assert_same_decisions([make_match(1, 40, 1, 40, 1, 2, 1e-10), make_match(35, 90, 38, 95, 2, 2, 1e-20)])
+        # Overlapping alignments of the same region of the profile; only the better is kept
+        self.assert_same_decisions([make_match(1, 60, 1, 60, 1, 2, 1e-5), make_match(40, 100, 5, 65, 2, 2, 1e-9)])
+        # An alignment contained within another, on the query and the profile
+        self.assert_same_decisions([make_match(1, 100, 1, 100, 1, 3, 1e-30), make_match(20, 50, 20, 50, 2, 3, 1e-3),
+                                    make_match(60, 70, 60, 70, 3, 3, 1e-2)])
+        # The contained alignment listed first, and a distant repeat that is reported separately
+        self.assert_same_decisions([make_match(20, 50, 20, 50, 1, 3, 1e-3), make_match(1, 100, 1, 100, 2, 3, 1e-30),
+                                    make_match(300, 400, 1, 100, 3, 3, 1e-25)])
+        # Alignments that share an end position
+        self.assert_same_decisions([make_match(1, 50, 1, 50, 1, 2, 1e-5), make_match(50, 90, 1, 40, 2, 2, 1e-5)])
+
+    def test_random_subalignments(self):
+        rng = random.Random(7)
+        for _ in range(2000):
+            hmm_len = rng.randint(50, 300)
+            num_alignments = rng.randint(2, 12)
+            fragments = list()
+            for num in range(1, num_alignments + 1):
+                start = rng.randint(1, 3 * hmm_len)
+                pstart = rng.randint(1, hmm_len)
+                fragments.append(make_match(start, start + rng.randint(0, hmm_len),
+                                            pstart, rng.randint(pstart, hmm_len),
+                                            num, num_alignments, rng.choice([1e-3, 1e-5, 1e-10, 1e-20]), hmm_len))
+            self.assert_same_decisions(fragments)
+
+
+def split_domtbl_lines(dom_tbl):
+    """
+    Reads the domain table one line at a time, as DomainTableParser did before it was parsed into columns
+    """
+    rows = list()
+    with open(dom_tbl) as domtbl_handler:
+        for line in domtbl_handler:
+            if line[0] == '#' or not line.strip():
+                continue
+            hit = line.split()
+            rows.append({"query": hit[0], "query_len": int(hit[2]), "hmm_name": hit[3], "hmm_len": hit[5],
+                         "Eval": float(hit[6]), "full_score": float(hit[7]), "num": int(hit[9]), "of": int(hit[10]),
+                         "cEval": float(hit[11]), "pstart": int(hit[15]), "pend": int(hit[16]),
+                         "qstart": int(hit[19]), "qend": int(hit[20]), "acc": float(hit[21]),
+                         "desc": ' '.join(hit[22:])})
+    return rows
+
+
+def filtered_hits(args, drop_single_hits):
+    """
+    Runs the steps of parse_domain_tables on the bundled domain table
+    :return: The coordinates of the alignments passing the filters and the number of alignments dropped
+    """
+    domain_table = DomainTableParser(DOMTBL_FILE)
+    domain_table.read_domtbl_lines()
+    dropped = 0
+    if drop_single_hits:
+        dropped = domain_table.drop_poor_single_hits(args.min_acc, args.min_e, args.perc_aligned)
+    distinct_matches = format_split_alignments(domain_table, 0, 0, 0, 0)[0]
+    purified_matches, dropped = filter_poor_hits(args, distinct_matches, dropped)
+    complete_gene_hits, dropped = filter_incomplete_hits(args, purified_matches, dropped)
+    hits = sorted([(hit.target_hmm, hit.orf, hit.start, hit.end, hit.pstart, hit.pend, hit.num, hit.of, hit.ceval)
+                   for hit in complete_gene_hits])
+    return hits, dropped
+
+
+class DomainTableColumnsTest(unittest.TestCase):
+    def test_read_domtbl_lines(self):
+        domain_table = DomainTableParser(DOMTBL_FILE)
+        domain_table.read_domtbl_lines()
+        rows = list()
+        while domain_table.next():
+            rows.append(dict(domain_table.alignments))
+        self.assertEqual(split_domtbl_lines(DOMTBL_FILE), rows)
+
+    def test_drop_poor_single_hits(self):
+        # The unsplit alignments dropped up front must be those the per-match filters would have dropped
+        for min_acc, min_e, perc_aligned in [(0.6, 0.01, 80), (0.9, 1e-20, 50), (0.0, 10.0, 0), (0.99, 1e-100, 100)]:
+            args = Namespace(min_acc=min_acc, min_e=min_e, perc_aligned=perc_aligned)
+            self.assertEqual(filtered_hits(args, False), filtered_hits(args, True))
+
+        args = Namespace(min_acc=0.6, min_e=0.01, perc_aligned=80)
+        domain_table = DomainTableParser(DOMTBL_FILE)
+        domain_table.read_domtbl_lines()
+        num_rows = domain_table.size
+        num_dropped = domain_table.drop_poor_single_hits(args.min_acc, args.min_e, args.perc_aligned)
+        self.assertTrue(0 < num_dropped < num_rows)
+        self.assertEqual(num_rows - num_dropped, domain_table.size)
+        for field in domain_table.columns:
+            self.assertEqual(domain_table.size, len(domain_table.columns[field]))
+
+    def test_empty_domain_table(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            empty_domtbl = os.path.join(output_dir, "empty_domtbl.txt")
+            with open(empty_domtbl, 'w') as domtbl_handler:
+                domtbl_handler.write("# target name\taccession\n#\n")
+            domain_table = DomainTableParser(empty_domtbl)
+            domain_table.read_domtbl_lines()
+            self.assertEqual(0, domain_table.size)
+            self.assertEqual(0, domain_table.drop_poor_single_hits(0.6, 0.01, 80))
+            self.assertIsNone(domain_table.next())
+        finally:
+            shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
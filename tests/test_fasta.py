@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from fasta import FastaIndex, format_fasta_to_file, read_fasta_to_dict, write_fasta_index, read_fasta_index,\
+    write_balanced_fasta_chunks
+
+TREESAPP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+TEST_DATA_DIR = TREESAPP_DIR + "test_data" + os.sep
+
+
+class FastaIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp() + os.sep
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_formatted_fasta_index(self):
+        formatted_fasta = self.output_dir + "protein_test_formatted.fasta"
+        fasta_index = format_fasta_to_file(TEST_DATA_DIR + "protein_test.fasta", "prot", self.output_dir,
+                                           formatted_fasta)
+        formatted_seqs = read_fasta_to_dict(formatted_fasta)
+        self.assertTrue(len(formatted_seqs) > 0)
+        # The index is read back from the .fai file as a later stage would
+        for index in [fasta_index, FastaIndex(formatted_fasta)]:
+            self.assertEqual(sorted(formatted_seqs), sorted([header[1:] for header in index.keys()]))
+            for header in index.keys():
+                sequence = formatted_seqs[header[1:]]
+                self.assertEqual(sequence, index[header].upper())
+                self.assertEqual(sequence[5:-5], index.subsequence(header, 5, -5).upper())
+                self.assertEqual("", index.subsequence(header, len(sequence), len(sequence) + 10))
+            index.close()
+
+    def test_empty_fasta(self):
+        empty_fasta = self.output_dir + "empty.fasta"
+        open(empty_fasta, 'w').close()
+        write_fasta_index(empty_fasta, dict())
+        self.assertEqual(dict(), read_fasta_index(empty_fasta + ".fai"))
+
+        fasta_index = FastaIndex(empty_fasta)
+        self.assertEqual(0, len(fasta_index))
+        self.assertFalse(">missing" in fasta_index)
+        fasta_index.open()
+        self.assertEqual([], write_balanced_fasta_chunks(fasta_index, self.output_dir + "chunk", 4))
+        fasta_index.close()
+        fasta_index.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from file_parsers import load_leaf_taxonomy
+
+TREESAPP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+TAX_IDS_FILE = TREESAPP_DIR + "data" + os.sep + "tree_data" + os.sep + "tax_ids_McrA.txt"
+
+
+def leaf_taxonomy_values(leaf_taxonomy):
+    tree_leaves, leaf_lineages, taxonomy = leaf_taxonomy
+    leaves = [(leaf.number, leaf.description, leaf.lineage, leaf.complete) for leaf in tree_leaves]
+    return leaves, leaf_lineages, (taxonomy.names, taxonomy.node_names, taxonomy.parents, taxonomy.counts,
+                                   taxonomy.lineages)
+
+
+class LeafTaxonomyCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp() + os.sep
+        self.tax_ids_file = self.output_dir + "tax_ids_McrA.txt"
+        shutil.copy(TAX_IDS_FILE, self.tax_ids_file)
+        self.cache_file = self.output_dir + "McrA_taxonomy.npz"
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_cache_round_trip(self):
+        built = leaf_taxonomy_values(load_leaf_taxonomy(self.tax_ids_file, self.cache_file))
+        # The cache is moved into place once written, leaving no temporary file behind
+        self.assertEqual(sorted(["tax_ids_McrA.txt", "McrA_taxonomy.npz"]), sorted(os.listdir(self.output_dir)))
+        cache_mtime = os.path.getmtime(self.cache_file)
+        self.assertEqual(built, leaf_taxonomy_values(load_leaf_taxonomy(self.tax_ids_file, self.cache_file)))
+        self.assertEqual(cache_mtime, os.path.getmtime(self.cache_file))
+        self.assertTrue(len(built[0]) > 0)
+
+    def test_stale_cache(self):
+        original = leaf_taxonomy_values(load_leaf_taxonomy(self.tax_ids_file, self.cache_file))
+        with open(self.tax_ids_file) as tax_ids_handler:
+            tax_ids_lines = tax_ids_handler.readlines()
+        tax_ids_lines[0] = tax_ids_lines[0].rstrip("\n") + "; Euryarchaeota\n"
+        with open(self.tax_ids_file, 'w') as tax_ids_handler:
+            tax_ids_handler.writelines(tax_ids_lines)
+        # The tax_ids file is now newer than the cache, so the cache must be rebuilt from it
+        tax_ids_mtime = os.path.getmtime(self.tax_ids_file)
+        os.utime(self.cache_file, (tax_ids_mtime - 10, tax_ids_mtime - 10))
+
+        updated = leaf_taxonomy_values(load_leaf_taxonomy(self.tax_ids_file, self.cache_file))
+        self.assertNotEqual(original, updated)
+        self.assertEqual("cellular organisms; Archaea; Euryarchaeota", updated[0][0][2])
+        self.assertTrue(os.path.getmtime(self.cache_file) >= os.path.getmtime(self.tax_ids_file))
+        self.assertEqual(updated, leaf_taxonomy_values(load_leaf_taxonomy(self.tax_ids_file, self.cache_file)))
+
+    def test_unwritable_cache(self):
+        # A cache that cannot be written is skipped and the taxonomy is parsed from the tax_ids file
+        cache_file = self.output_dir + "missing_dir" + os.sep + "McrA_taxonomy.npz"
+        self.assertEqual(leaf_taxonomy_values(load_leaf_taxonomy(self.tax_ids_file, self.cache_file)),
+                         leaf_taxonomy_values(load_leaf_taxonomy(self.tax_ids_file, cache_file)))
+        self.assertFalse(os.path.exists(self.output_dir + "missing_dir"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from file_parsers import load_leaf_taxonomy
+from lca_calculations import megan_lca, lowest_common_taxonomy
+from classy import TreeProtein
+
+TREESAPP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+TAX_IDS_FILE = TREESAPP_DIR + "data" + os.sep + "tree_data" + os.sep + "tax_ids_McrA.txt"
+
+
+class TaxonomyTrieFindTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        cache_file = self.cache_dir + os.sep + "McrA_taxonomy.npz"
+        # The first load builds the trie with insert, the second rebuilds it from the cached arrays
+        _, leaf_lineages, self.built_taxonomy = load_leaf_taxonomy(TAX_IDS_FILE, cache_file)
+        _, _, self.cached_taxonomy = load_leaf_taxonomy(TAX_IDS_FILE, cache_file)
+        lineages = sorted(set(leaf_lineages.values()), key=lambda x: (-len(x.split("; ")), x))
+        self.genus_lineages = [lineage for lineage in lineages if lineage.split("; ")[-1].startswith("Methanosarcina")]
+        self.deepest = lineages[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_find_known_and_unknown(self):
+        for taxonomy in [self.built_taxonomy, self.cached_taxonomy]:
+            node = taxonomy.find(self.deepest)
+            self.assertIsNotNone(node)
+            self.assertEqual(self.deepest, taxonomy.lineages[node])
+            self.assertIsNone(taxonomy.find(self.deepest + "; Unknown strain"))
+            self.assertIsNone(taxonomy.find("Unknown domain; Unknown phylum"))
+
+    def test_lca_does_not_grow_taxonomy(self):
+        unknown = "cellular organisms; Archaea; Unknown phylum"
+        known = self.genus_lineages[:3]
+        self.assertEqual(3, len(known))
+        for taxonomy in [self.built_taxonomy, self.cached_taxonomy]:
+            num_nodes = len(taxonomy)
+            num_names = len(taxonomy.names)
+            lca = megan_lca(known + [unknown], taxonomy)
+            self.assertEqual(megan_lca(known), lca)
+            tree_sap = TreeProtein()
+            tree_sap.lineage_list = known + [unknown]
+            self.assertEqual(lca, tree_sap.megan_lca(taxonomy))
+            for algorithm in ["MEGAN", "LCA*", "LCAp"]:
+                self.assertEqual(lowest_common_taxonomy(known, lca, taxonomy, algorithm),
+                                 lowest_common_taxonomy(known + [unknown], lca, taxonomy, algorithm))
+            self.assertEqual(num_nodes, len(taxonomy))
+            self.assertEqual(num_names, len(taxonomy.names))
+            self.assertNotIn(unknown, taxonomy.lineage_nodes)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from math import log2
+
+import numpy as np
+from ete3 import Tree
+
+from phylo_dist import build_tree_distance_index, load_tree_distance_index
+
+TREESAPP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+TREE_FILE = TREESAPP_DIR + "data" + os.sep + "tree_data" + os.sep + "McrA_tree.txt"
+
+
+def ete3_mean_leaf_distance(parent_node):
+    children = parent_node.get_leaves()
+    distances = [parent_node.get_distance(child) for child in children]
+    return sum(distances) / len(distances)
+
+
+def ete3_cousins(lost_node):
+    sisters = lost_node.get_sisters()
+    if not sisters:
+        return []
+    return sisters[0].get_leaf_names()
+
+
+def ete3_find_cluster(lost_node):
+    """
+    The traversal of an ete3 Tree that TreeDistanceIndex.find_cluster replaced, to which its results are pinned.
+    An only child has no cousins rather than raising an IndexError.
+    """
+    parent = lost_node.up
+    if lost_node.is_root() or parent.is_root():
+        return lost_node
+
+    mean_intra = ete3_mean_leaf_distance(lost_node)
+    cousins = ete3_cousins(lost_node)
+    parent_dist = parent.get_distance(lost_node) * log2(len(cousins) + 1)
+
+    while mean_intra > parent_dist:
+        lost_node = parent
+        parent = lost_node.up
+        if parent is None:
+            break
+        mean_intra = ete3_mean_leaf_distance(lost_node)
+        cousins = ete3_cousins(lost_node)
+        parent_dist = parent.get_distance(lost_node) * log2(len(cousins) + 1)
+
+    return lost_node
+
+
+class TreeDistanceIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tree = Tree(TREE_FILE)
+        self.tree_index = build_tree_distance_index(self.tree)
+        # The index numbers the nodes in the pre-order of ete3's traversal
+        self.nodes = list(self.tree.traverse("preorder"))
+        self.node_ids = {self.nodes[i]: i for i in range(len(self.nodes))}
+
+    def test_distances(self):
+        self.assertAlmostEqual(self.tree.get_farthest_leaf()[1], self.tree_index.farthest_leaf_distance(), places=9)
+        for node_id in range(len(self.nodes)):
+            node = self.nodes[node_id]
+            tip_distances = [node.get_distance(leaf) for leaf in node.get_leaves()]
+            self.assertAlmostEqual(max(tip_distances), self.tree_index.max_tip_distance(node_id), places=9)
+            self.assertAlmostEqual(sum(tip_distances) / len(tip_distances),
+                                   self.tree_index.mean_tip_distance(node_id), places=9)
+        leaf_names = self.tree.get_leaf_names()
+        self.assertEqual(0, self.tree_index.lca([self.tree_index.leaf(leaf) for leaf in leaf_names]))
+
+        rng = random.Random(3)
+        for _ in range(500):
+            leaf_children = rng.sample(leaf_names, rng.randint(2, 8))
+            leaf_ids = [self.tree_index.leaf(leaf) for leaf in leaf_children]
+            ancestor = self.tree.get_common_ancestor(leaf_children)
+            parent = self.tree_index.lca(leaf_ids)
+            self.assertIs(ancestor, self.nodes[parent])
+            np.testing.assert_allclose([ancestor.get_distance(leaf) for leaf in leaf_children],
+                                       self.tree_index.distances_to_ancestor(parent, leaf_ids), atol=1e-9)
+
+    def test_only_child_distances(self):
+        # C is the only child of Y, so C and Y share the same leaves
+        tree = Tree("((A:1,B:2)X:0.5,((C:1)Y:0.3,D:1.5)Z:0.2)R;", format=1)
+        tree_index = build_tree_distance_index(tree)
+        nodes = list(tree.traverse("preorder"))
+        for node_id in range(len(nodes)):
+            tip_distances = [nodes[node_id].get_distance(leaf) for leaf in nodes[node_id].get_leaves()]
+            self.assertAlmostEqual(max(tip_distances), tree_index.max_tip_distance(node_id))
+            self.assertAlmostEqual(sum(tip_distances) / len(tip_distances), tree_index.mean_tip_distance(node_id))
+        for leaf_children in [["C", "D"], ["A", "C"]]:
+            ancestor = tree.get_common_ancestor(leaf_children)
+            leaf_ids = [tree_index.leaf(leaf) for leaf in leaf_children]
+            self.assertEqual(ancestor.name, nodes[tree_index.lca(leaf_ids)].name)
+            np.testing.assert_allclose([ancestor.get_distance(leaf) for leaf in leaf_children],
+                                       tree_index.distances_to_ancestor(tree_index.lca(leaf_ids), leaf_ids))
+        self.assertEqual(tree.get_farthest_leaf()[1], tree_index.farthest_leaf_distance())
+
+    def test_find_cluster(self):
+        # The root and its children are their own clusters
+        self.assertEqual(0, self.tree_index.find_cluster(0))
+        for child in self.tree.children:
+            self.assertEqual(self.node_ids[child], self.tree_index.find_cluster(self.node_ids[child]))
+        for node_id in range(len(self.nodes)):
+            self.assertEqual(self.node_ids[ete3_find_cluster(self.nodes[node_id])],
+                             self.tree_index.find_cluster(node_id))
+
+    def test_find_cluster_only_child(self):
+        # V is the only child of Y, so moving up to Y adds no leaves and the walk continues past it
+        tree = Tree("((A:1,B:2)X:0.5,((((C:0.1,F:0.1)V:0.5)Y:0.01,E:0.1)W:1.0,D:1.5)Z:0.2)R;", format=1)
+        tree_index = build_tree_distance_index(tree)
+        nodes = list(tree.traverse("preorder"))
+        for node_id in range(len(nodes)):
+            self.assertEqual(ete3_find_cluster(nodes[node_id]).name, nodes[tree_index.find_cluster(node_id)].name)
+        self.assertEqual("W", nodes[tree_index.find_cluster([node.name for node in nodes].index("V"))].name)
+
+    def test_saved_index(self):
+        index_dir = tempfile.mkdtemp() + os.sep
+        try:
+            index_file = index_dir + "McrA_tree_index.npz"
+            load_tree_distance_index(TREE_FILE, index_file)
+            self.assertEqual(["McrA_tree_index.npz"], os.listdir(index_dir))
+            loaded_index = load_tree_distance_index(TREE_FILE, index_file)
+            for name in ["parents", "dists", "names", "euler", "first", "depths", "leaf_counts", "sisters"]:
+                np.testing.assert_array_equal(getattr(self.tree_index, name), getattr(loaded_index, name))
+        finally:
+            shutil.rmtree(index_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest
+from argparse import Namespace
+
+import numpy as np
+from ete3 import Tree
+
+from file_parsers import parse_ref_build_params, parse_cog_list, read_species_translation_files
+from phylo_dist import build_tree_distance_index
+from reference_bundle import compile_reference_bundle, ReferenceBundle
+from treesapp import get_alignment_dims
+
+TREESAPP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+TREE_DATA_DIR = TREESAPP_DIR + "data" + os.sep + "tree_data" + os.sep
+
+
+class ReferenceBundleTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.output_dir = tempfile.mkdtemp() + os.sep
+        cls.bundle_file = cls.output_dir + "ref_packages.bundle"
+        compile_reference_bundle(TREESAPP_DIR, cls.bundle_file)
+        cls.bundle = ReferenceBundle(cls.bundle_file)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.bundle
+        shutil.rmtree(cls.output_dir)
+
+    def setUp(self):
+        self.args = Namespace(treesapp=TREESAPP_DIR, targets=["ALL"], reftree="p", reference_data_prefix='',
+                              cache_dir=self.output_dir)
+
+    def test_is_current(self):
+        self.assertFalse([file_name for file_name in os.listdir(self.output_dir) if file_name.endswith(".tmp")])
+        self.assertTrue(self.bundle.is_current(TREESAPP_DIR))
+        self.assertFalse(self.bundle.is_current(self.output_dir))
+
+    def test_unreadable_and_unwritable_files(self):
+        with self.assertRaises(SystemExit):
+            compile_reference_bundle(self.output_dir, self.output_dir + "missing_data.bundle")
+        with self.assertRaises(SystemExit):
+            compile_reference_bundle(TREESAPP_DIR, self.output_dir + "missing_dir" + os.sep + "ref_packages.bundle")
+
+    def test_marker_build_dict(self):
+        text_build_dict = parse_cog_list(self.args, parse_ref_build_params(self.args))
+        bundle_build_dict = self.bundle.marker_build_dict(self.args)
+        self.assertTrue(len(text_build_dict) > 0)
+        self.assertEqual(list(text_build_dict.keys()), list(bundle_build_dict.keys()))
+        for denominator in text_build_dict:
+            self.assertEqual(vars(text_build_dict[denominator]), vars(bundle_build_dict[denominator]))
+
+        self.args.targets = sorted(text_build_dict.keys())[:2]
+        self.assertEqual(self.args.targets, sorted(self.bundle.marker_build_dict(self.args).keys()))
+        self.args.reftree = "Z9999"
+        with self.assertRaises(SystemExit):
+            self.bundle.marker_build_dict(self.args)
+
+    def test_leaf_taxonomies(self):
+        marker_build_dict = parse_cog_list(self.args, parse_ref_build_params(self.args))
+        text_leaves, text_lineages, text_taxonomies = read_species_translation_files(self.args, marker_build_dict)
+        bundle_leaves, bundle_lineages, bundle_taxonomies = self.bundle.leaf_taxonomies(marker_build_dict)
+        self.assertEqual(text_lineages, bundle_lineages)
+        for denominator in marker_build_dict:
+            self.assertEqual([vars(leaf) for leaf in text_leaves[denominator]],
+                             [vars(leaf) for leaf in bundle_leaves[denominator]])
+            text_taxonomy = text_taxonomies[denominator]
+            bundle_taxonomy = bundle_taxonomies[denominator]
+            self.assertEqual(text_taxonomy.lineages, bundle_taxonomy.lineages)
+            self.assertEqual(text_taxonomy.parents, bundle_taxonomy.parents)
+            self.assertEqual(text_taxonomy.taxonomic_counts(), bundle_taxonomy.taxonomic_counts())
+
+    def test_alignment_dims(self):
+        marker_build_dict = self.bundle.marker_build_dict(self.args)
+        self.assertEqual(get_alignment_dims(self.args, marker_build_dict),
+                         self.bundle.alignment_dims(marker_build_dict))
+
+    def test_tree_distance_index(self):
+        marker_build_dict = self.bundle.marker_build_dict(self.args)
+        num_trees = 0
+        for denominator in marker_build_dict:
+            tree_file = TREE_DATA_DIR + marker_build_dict[denominator].cog + "_tree.txt"
+            if not os.path.isfile(tree_file):
+                self.assertIsNone(self.bundle.tree_distance_index(denominator))
+                continue
+            num_trees += 1
+            text_index = build_tree_distance_index(Tree(tree_file))
+            bundle_index = self.bundle.tree_distance_index(denominator)
+            for name in ["parents", "dists", "names", "euler", "first"]:
+                np.testing.assert_array_equal(getattr(text_index, name), getattr(bundle_index, name))
+        self.assertTrue(num_trees > 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,273 @@
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+from argparse import Namespace
+
+from classy import ItolJplace, JplacePquery, JplacePlacement
+from fasta import read_fasta_to_dict, write_new_fasta, format_fasta_to_file
+from HMMER_domainTblParser import HmmMatch
+from file_parsers import parse_ref_build_params, parse_cog_list, read_stockholm_to_dict
+from jplace_utils import jplace_parser, write_jplace
+from treesapp import press_hmm_database, prepare_and_run_hmmalign, load_reference_alignment_block,\
+    batch_placement_queries, split_batched_jplaces, extract_hmm_matches, set_cache_dir
+
+TREESAPP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+HMM_DIR = TREESAPP_DIR + "data" + os.sep + "hmm_data" + os.sep
+ALIGNMENT_DIR = TREESAPP_DIR + "data" + os.sep + "alignment_data" + os.sep
+TEST_DATA_DIR = TREESAPP_DIR + "test_data" + os.sep
+
+
+@unittest.skipUnless(shutil.which("hmmpress"), "hmmpress is not installed")
+class PressHmmDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp() + os.sep
+        # The TreeSAPP directory may not be writable, so the database must only be written to the cache directory
+        self.args = Namespace(treesapp=self.cache_dir + "read_only_treesapp" + os.sep,
+                              cache_dir=self.cache_dir,
+                              executables={"hmmpress": shutil.which("hmmpress")})
+        self.hmm_files = [HMM_DIR + "McrA.hmm", HMM_DIR + "McrB.hmm"]
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_database_in_cache_dir(self):
+        hmm_db, hmm_name_map = press_hmm_database(self.args, self.hmm_files)
+        self.assertEqual(self.cache_dir, os.path.dirname(hmm_db) + os.sep)
+        self.assertEqual({"McrA": self.hmm_files[0], "McrB": self.hmm_files[1]}, hmm_name_map)
+        for ext in ["", ".h3m", ".h3i", ".h3f", ".h3p"]:
+            self.assertTrue(os.path.isfile(hmm_db + ext))
+        self.assertFalse(os.path.exists(self.args.treesapp))
+        self.assertFalse([file_name for file_name in os.listdir(self.cache_dir) if file_name.endswith(".tmp")])
+
+        # The cached database is reused rather than pressed again
+        pressed_mtime = os.path.getmtime(hmm_db + ".h3m")
+        self.assertEqual(hmm_db, press_hmm_database(self.args, self.hmm_files)[0])
+        self.assertEqual(pressed_mtime, os.path.getmtime(hmm_db + ".h3m"))
+
+    def test_duplicate_names(self):
+        with self.assertRaises(SystemExit):
+            press_hmm_database(self.args, [HMM_DIR + "McrA.hmm", HMM_DIR + "McrA.hmm"])
+
+
+
+@unittest.skipUnless(shutil.which("hmmalign"), "hmmalign is not installed")
+class ReferenceAlignmentMergeTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp() + os.sep
+        self.args = Namespace(treesapp=TREESAPP_DIR, reference_data_prefix='', targets=["M0701"], reftree="p",
+                              executables={"hmmalign": shutil.which("hmmalign")}, num_threads=2)
+        self.marker_build_dict = parse_cog_list(self.args, parse_ref_build_params(self.args))
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_merge_matches_mapali(self):
+        ref_alignment = ALIGNMENT_DIR + "McrA.fa"
+        hmm_file = HMM_DIR + "McrA.hmm"
+        self.assertIsNotNone(load_reference_alignment_block(ref_alignment, hmm_file))
+
+        # Complete and partial McrA sequences, so the queries have flanking and internal inserts of different lengths
+        query_files = list()
+        for group, test_fasta in enumerate(["Science_Evans_mcrA.fasta", "mcrA_bathyarchaeota_methanoperedens.fasta"]):
+            query_files.append(self.output_dir + "McrA_hmm_purified_group" + str(group) + ".faa")
+            shutil.copyfile(TEST_DATA_DIR + test_fasta, query_files[-1])
+        mfa_files = prepare_and_run_hmmalign(self.args, query_files, self.marker_build_dict)["M0701"]
+        self.assertEqual(len(query_files), len(mfa_files))
+
+        for query_fasta, mfa_file in zip(query_files, mfa_files):
+            mapali_sto = query_fasta + ".mapali.sto"
+            with open(mapali_sto, 'w') as sto_handler:
+                subprocess.run([self.args.executables["hmmalign"], "--mapali", ref_alignment,
+                                "--outformat", "Stockholm", hmm_file, query_fasta], stdout=sto_handler, check=True)
+            mapali_alignment = read_stockholm_to_dict(mapali_sto)
+            expected = {seq_name.split('_')[0]: mapali_alignment[seq_name] for seq_name in mapali_alignment}
+            self.assertEqual(expected, read_fasta_to_dict(mfa_file))
+
+
+def exhaustive_hmm_match_bins(hmm_matches):
+    """
+    Bins the matches by comparing each with every bin's representative, as extract_hmm_matches did before the
+    representatives were indexed by profile start
+    :return: List of bins, each a list of the numeric names of its matches
+    """
+    bins = list()
+    numeric_decrementor = -1
+    for hmm_match in sorted(hmm_matches, key=lambda x: x.end - x.start):
+        binned = False
+        for hmm_bin in bins:
+            bin_rep = hmm_bin[0][1]
+            overlap = min(hmm_match.pend, bin_rep.pend) - max(hmm_match.pstart, bin_rep.pstart)
+            if (100*overlap)/(bin_rep.pend - bin_rep.pstart) > 80:
+                hmm_bin.append((str(numeric_decrementor), hmm_match))
+                binned = True
+                break
+        if not binned:
+            bins.append([(str(numeric_decrementor), hmm_match)])
+        numeric_decrementor -= 1
+    return [[numeric_name for numeric_name, _ in hmm_bin] for hmm_bin in bins]
+
+
+class ExtractHmmMatchesTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp() + os.sep
+        self.fasta_index = format_fasta_to_file(TEST_DATA_DIR + "Science_Evans_mcrA.fasta", "prot", self.output_dir,
+                                                self.output_dir + "formatted_input.fasta")
+
+    def tearDown(self):
+        self.fasta_index.close()
+        shutil.rmtree(self.output_dir)
+
+    def test_hmm_match_bins(self):
+        rng = random.Random(13)
+        seq_names = sorted([header[1:] for header in self.fasta_index.keys()])
+        for trial in range(200):
+            trial_dir = self.output_dir + str(trial) + os.sep
+            os.mkdir(trial_dir)
+            args = Namespace(output_dir_var=trial_dir, output_dir_final=trial_dir)
+            hmm_len = rng.randint(100, 600)
+            hmm_matches = list()
+            for _ in range(rng.randint(1, 40)):
+                hmm_match = HmmMatch()
+                hmm_match.orf = rng.choice(seq_names)
+                hmm_match.desc = '-'
+                hmm_match.target_hmm = "McrA"
+                hmm_match.pstart = rng.randint(1, hmm_len - 1)
+                hmm_match.pend = rng.randint(hmm_match.pstart + 1, hmm_len)
+                hmm_match.start = rng.randint(1, 200)
+                hmm_match.end = hmm_match.start + rng.randint(0, 2) * (hmm_match.pend - hmm_match.pstart) // 2
+                hmm_matches.append(hmm_match)
+
+            group_files, numeric_contig_index = extract_hmm_matches(args, {"McrA": hmm_matches}, self.fasta_index)
+            expected_bins = exhaustive_hmm_match_bins(hmm_matches)
+            self.assertEqual([trial_dir + "McrA_hmm_purified_group" + str(group) + ".faa"
+                              for group in range(len(expected_bins))], group_files)
+            for group_file, expected_bin in zip(group_files, expected_bins):
+                group_seqs = read_fasta_to_dict(group_file)
+                self.assertEqual(expected_bin, list(group_seqs.keys()))
+                for numeric_name in expected_bin:
+                    contig_name, start, end = numeric_contig_index["McrA"][int(numeric_name)].rsplit('_', 2)
+                    full_sequence = self.fasta_index['>' + contig_name]
+                    self.assertEqual(full_sequence[int(start) - 1:int(end)], group_seqs[numeric_name])
+
+
+class CacheDirTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp() + os.sep
+        self.treesapp_dir = self.output_dir + "treesapp" + os.sep
+        os.mkdir(self.treesapp_dir)
+        self.args = Namespace(treesapp=self.treesapp_dir, output=self.output_dir + "output" + os.sep, cache_dir=None)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def block_dir(self, path):
+        # A file in place of the directory, since permissions alone do not stop root from writing to it
+        with open(path, 'w') as blocking_file:
+            blocking_file.write("\n")
+
+    def test_default_cache_dir(self):
+        set_cache_dir(self.args)
+        self.assertEqual(self.treesapp_dir + "data" + os.sep + "cache", os.path.normpath(self.args.cache_dir))
+        self.assertTrue(self.args.cache_dir.endswith(os.sep))
+        self.assertTrue(os.path.isdir(self.args.cache_dir))
+
+    def test_unwritable_default_cache_dir(self):
+        self.block_dir(self.treesapp_dir + "data")
+        with self.assertLogs(level="WARNING"):
+            set_cache_dir(self.args)
+        self.assertEqual(self.args.output + "cache" + os.sep, self.args.cache_dir)
+        self.assertTrue(os.path.isdir(self.args.cache_dir))
+
+    def test_unusable_fallback_cache_dir(self):
+        self.block_dir(self.treesapp_dir + "data")
+        os.mkdir(self.args.output)
+        self.block_dir(self.args.output + "cache")
+        with self.assertRaises(SystemExit) as context:
+            set_cache_dir(self.args)
+        self.assertEqual(3, context.exception.code)
+
+    def test_explicit_cache_dir(self):
+        self.args.cache_dir = self.output_dir + "shared_cache"
+        set_cache_dir(self.args)
+        self.assertEqual(self.output_dir + "shared_cache" + os.sep, self.args.cache_dir)
+        self.assertTrue(os.path.isdir(self.args.cache_dir))
+        self.assertFalse(os.path.exists(self.treesapp_dir + "data"))
+
+        # An explicit cache directory that cannot be used is an error rather than silently replaced
+        self.block_dir(self.output_dir + "blocked")
+        self.args.cache_dir = self.output_dir + "blocked" + os.sep + "cache"
+        with self.assertRaises(SystemExit) as context:
+            set_cache_dir(self.args)
+        self.assertEqual(3, context.exception.code)
+
+
+class PlacementBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp() + os.sep
+        # Each McrA taxon needs 640 kB for 1000 protein columns, so 10 MB fits the 10 references and 5 queries
+        self.args = Namespace(treesapp=TREESAPP_DIR, targets=["M0701"], reftree="p", output_dir_var=self.output_dir,
+                              placement_mem=10)
+        self.marker_build_dict = parse_cog_list(self.args, parse_ref_build_params(self.args))
+        self.ref_alignment_dimensions = {"M0701": (10, 1000)}
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_split_batched_jplaces(self):
+        query_seqs = read_fasta_to_dict(TEST_DATA_DIR + "Science_Evans_mcrA.fasta")
+        seq_names = sorted(query_seqs)
+        groups = {1: seq_names[:6], 2: seq_names[6:8], 3: seq_names[8:]}
+        group_files = list()
+        for group in groups:
+            group_files += write_new_fasta({seq_name: query_seqs[seq_name] for seq_name in groups[group]},
+                                           self.output_dir + "McrA_hmm_purified_group" + str(group) + ".faa")
+
+        batch_files, placement_batches = batch_placement_queries(self.args, group_files, self.marker_build_dict,
+                                                                 self.ref_alignment_dimensions)
+        self.assertEqual([3], [len(placement_batches[denominator]) for denominator in placement_batches])
+        batched_names = list()
+        for batch_file in batch_files:
+            batch_seqs = read_fasta_to_dict(batch_file)
+            self.assertTrue(len(batch_seqs) <= 5)
+            batched_names += list(batch_seqs.keys())
+        self.assertEqual(seq_names, sorted(batched_names))
+
+        # Place each query of a batch on its own edge of the reference tree, as RAxML would write it
+        with open(TREESAPP_DIR + "data" + os.sep + "tree_data" + os.sep + "McrA_tree.txt") as tree_handler:
+            tree = tree_handler.read().strip()
+        fields = ["edge_num", "likelihood", "like_weight_ratio", "distal_length", "pendant_length"]
+        expected_placements = dict()
+        for batch_num in placement_batches["M0701"]:
+            batch_jplace = ItolJplace()
+            batch_jplace.tree = tree
+            batch_jplace.fields = fields
+            batch_jplace.version = 3
+            batch_jplace.metadata = {"invocation": "raxmlHPC -f v"}
+            for seq_name in placement_batches["M0701"][batch_num]:
+                edge = seq_names.index(seq_name)
+                placement = [edge, -1000.0 - edge, 0.9, 0.01 * edge, 0.1]
+                expected_placements[seq_name] = [placement]
+                batch_jplace.placements.append(JplacePquery([seq_name], [JplacePlacement(*placement)]))
+            write_jplace(batch_jplace, self.output_dir + "RAxML_portableTree.M0701_hmm_purified_batch" +
+                         str(batch_num) + ".jplace")
+
+        split_batched_jplaces(self.args, placement_batches)
+        jplace_files = sorted([file_name for file_name in os.listdir(self.output_dir) if file_name.endswith(".jplace")])
+        self.assertEqual(["RAxML_portableTree.M0701_hmm_purified_group" + str(group) + ".jplace" for group in groups],
+                         jplace_files)
+        for group in groups:
+            group_jplace = jplace_parser(self.output_dir + "RAxML_portableTree.M0701_hmm_purified_group" +
+                                         str(group) + ".jplace")
+            self.assertEqual(tree, group_jplace.tree)
+            self.assertEqual(fields, group_jplace.fields)
+            self.assertEqual(groups[group], sorted([pquery.names[0] for pquery in group_jplace.placements]))
+            for pquery in group_jplace.placements:
+                self.assertEqual(expected_placements[pquery.names[0]],
+                                 [placement.to_list(fields) for placement in pquery.placements])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+
+from utilities import allocate_job_threads
+
+
+class AllocateJobThreadsTest(unittest.TestCase):
+    def test_proportional_to_cost(self):
+        self.assertEqual([6, 2], allocate_job_threads([3, 1], 8))
+        self.assertEqual([4, 4], allocate_job_threads([5, 5], 8))
+        self.assertEqual([1, 1, 1], allocate_job_threads([0, 0, 0], 8))
+
+    def test_thread_budget(self):
+        # No job is given more threads than are available, even when it accounts for nearly all the cost
+        self.assertEqual([4, 1], allocate_job_threads([1000, 1], 4))
+        self.assertEqual([1], allocate_job_threads([10], 0))
+        for num_threads in range(1, 17):
+            job_threads = allocate_job_threads([7, 3, 1, 1], num_threads)
+            self.assertTrue(max(job_threads) <= num_threads)
+
+    def test_job_max_threads(self):
+        self.assertEqual([2, 4], allocate_job_threads([3, 1], 16, [2, 10]))
+        self.assertEqual([1, 1], allocate_job_threads([3, 1], 16, [0, 0]))
+
+    def test_min_threads(self):
+        # RAxML-Pthreads refuses to run with fewer than two threads, so its jobs are never given one
+        self.assertEqual([2, 2], allocate_job_threads([3, 1], 16, [0, 1], min_threads=2))
+        self.assertEqual([4, 2], allocate_job_threads([100, 1], 4, min_threads=2))
+        self.assertEqual([2], allocate_job_threads([1], 1, min_threads=2))
+        self.assertEqual([2, 2, 2], allocate_job_threads([0, 0, 0], 8, min_threads=2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,9 +15,11 @@ try:
     import glob
     import time
     import traceback
+    import hashlib
+    import bisect
+    import queue
     import subprocess
     import logging
-    from ete3 import Tree
     from multiprocessing import Pool, Process, Lock, Queue, JoinableQueue
     from os import path
     from os import listdir
@@ -25,17 +27,22 @@ try:
     from time import gmtime, strftime
 
     from utilities import Autovivify, os_type, which, find_executables, generate_blast_database, clean_lineage_string,\
-        reformat_string, available_cpu_count, write_phy_file, reformat_fasta_to_phy
+        reformat_string, available_cpu_count, reformat_fasta_to_phy, concatenate_files,\
+        split_threads, estimate_raxml_memory, allocate_job_threads
     from classy import CreateFuncTreeUtility, CommandLineWorker, CommandLineFarmer, ItolJplace, NodeRetrieverWorker,\
         TreeLeafReference, TreeProtein, ReferenceSequence, prep_logging
-    from fasta import format_read_fasta, get_headers, write_new_fasta, trim_multiple_alignment, read_fasta_to_dict
+    from fasta import format_read_fasta, write_new_fasta, trim_multiple_alignment, read_fasta_to_dict,\
+        format_fasta_to_file, FastaIndex, write_balanced_fasta_chunks
     from entish import create_tree_info_hash, deconvolute_assignments, read_and_understand_the_reference_tree,\
-        get_node, annotate_partition_tree, find_cluster
-    from external_command_interface import launch_write_command, setup_progress_bar
+        get_node, annotate_partition_tree
+    from external_command_interface import launch_write_command, launch_timed_command, setup_progress_bar
+    from HMMER_domainTblParser import split_hmmscan_domtbl
     from lca_calculations import *
     from jplace_utils import *
     from file_parsers import *
     from phylo_dist import *
+    from reference_bundle import load_reference_bundle
+    from reference_cache import reference_cache_path, reference_alignment_summary, cached_reference_phylip
 
     import _tree_parser
     import _fasta_reader
@@ -112,6 +119,22 @@ def get_options():
                                     help='Prints a more verbose runtime log')
     miscellaneous_opts.add_argument("--check_trees", action="store_true", default=False,
                                     help="Quality-check the reference trees before running TreeSAPP")
+    miscellaneous_opts.add_argument("--hmm_db", action="store_true", default=False,
+                                    help="Search the input against all marker HMMs at once with hmmscan, using a "
+                                         "cached and pressed database of the profiles, rather than running hmmsearch "
+                                         "for each marker. Recommended when searching many markers.")
+    miscellaneous_opts.add_argument("--placement_mem", default=0, type=int,
+                                    help="Pack the query sequences of each marker into as few RAxML placement jobs "
+                                         "as fit within this many megabytes of (estimated) memory, rather than "
+                                         "running one job per group of sequences. Not used with --trim_align, "
+                                         "as BMGE would trim the columns of a whole batch rather than of each group. "
+                                         "[DEFAULT = 0, disabled]")
+    miscellaneous_opts.add_argument("--cache_dir", default=None, type=str,
+                                    help="Directory for caching files derived from the reference packages (e.g. "
+                                         "Phylip alignments, alignment dimensions and the HMM database for --hmm_db), "
+                                         "shared by all runs using it. "
+                                         "Cached files are named by a hash of the reference file they were derived "
+                                         "from so they are rebuilt whenever it changes. [DEFAULT = data/cache/]")
     miscellaneous_opts.add_argument('-T', '--num_threads', default=2, type=int,
                                     help='specifies the number of CPU threads to use in RAxML and BLAST '
                                          'and processes throughout the pipeline [DEFAULT = 2]')
@@ -124,6 +147,46 @@ def get_options():
     return args
 
 
+def set_cache_dir(args):
+    """
+    Sets args.cache_dir to the directory the files derived from the reference packages are cached in, creating it if
+    necessary. An explicit --cache_dir must be writable, while the default (data/cache/ in the TreeSAPP directory) falls
+    back to a cache in the output directory if it is not.
+
+    :param args: Command-line argument object with the treesapp, output and cache_dir attributes
+    :return: None
+    """
+    if args.cache_dir:
+        args.cache_dir = os.path.abspath(args.cache_dir) + os.sep
+        try:
+            os.makedirs(args.cache_dir, exist_ok=True)
+        except OSError:
+            logging.error("Unable to create the cache directory " + args.cache_dir + "\n")
+            sys.exit(3)
+        if not os.access(args.cache_dir, os.W_OK):
+            logging.error("Cache directory " + args.cache_dir + " is not writable. Set another with --cache_dir.\n")
+            sys.exit(3)
+    else:
+        args.cache_dir = reference_cache_path(args.treesapp)
+        try:
+            os.makedirs(args.cache_dir, exist_ok=True)
+            cache_writable = os.access(args.cache_dir, os.W_OK)
+        except OSError:
+            cache_writable = False
+        if not cache_writable:
+            # TreeSAPP may be installed somewhere read-only, so files are cached for this run alone
+            fallback_cache_dir = os.path.abspath(args.output) + os.sep + "cache" + os.sep
+            logging.warning("Unable to write to the cache directory " + args.cache_dir + ". Using " +
+                            fallback_cache_dir + " instead; set a shared one with --cache_dir.\n")
+            args.cache_dir = fallback_cache_dir
+            try:
+                os.makedirs(args.cache_dir, exist_ok=True)
+            except OSError:
+                logging.error("Unable to create the cache directory " + args.cache_dir + "\n")
+                sys.exit(3)
+    return
+
+
 def check_parser_arguments(args):
     """
     Ensures the command-line arguments returned by argparse are sensible
@@ -169,6 +232,8 @@ def check_parser_arguments(args):
     args.output_dir_raxml = args.output + 'final_RAxML_outputs' + os.sep
     args.output_dir_final = args.output + 'final_outputs' + os.sep
 
+    set_cache_dir(args)
+
     treesapp_dir = args.treesapp + os.sep + 'data' + os.sep
     genewise_support = treesapp_dir + os.sep + 'genewise_support_files' + os.sep
 
@@ -177,6 +242,11 @@ def check_parser_arguments(args):
                         "Using maximum threads available (" + str(available_cpu_count()) + ")\n")
         args.num_threads = available_cpu_count()
 
+    if args.placement_mem > 0 and args.trim_align:
+        logging.warning("--placement_mem is ignored with --trim_align, since BMGE would trim the alignment columns of "
+                        "each batch of query groups rather than each group, changing their placements.\n")
+        args.placement_mem = 0
+
     if args.rpkm:
         if not args.reads:
             logging.error("At least one FASTQ file must be provided if -rpkm flag is active!")
@@ -257,30 +327,6 @@ def check_previous_output(args):
     return args
 
 
-def get_hmm_length(hmm_file):
-    """
-    Function to open the ref_tree's hmm file and determine its length
-    :param hmm_file: The HMM file produced by hmmbuild to parse for the HMM length
-    :return: The length (int value) of the HMM
-    """
-    try:
-        hmm = open(hmm_file, 'r')
-    except IOError:
-        raise IOError("Unable to open " + hmm_file + " for reading! Exiting.")
-
-    line = hmm.readline()
-    length = 0
-    while line:
-        # LENG XXX
-        if re.match(r"^LENG\s+([0-9]+)", line):
-            length = int(line.split()[1])
-        line = hmm.readline()
-    if length > 0:
-        return length
-    else:
-        raise AssertionError("Unable to parse the HMM length from " + hmm_file + ". Exiting.")
-
-
 def align_ref_queries(args, new_ref_queries, update_tree):
     """
     Function queries the candidate set of proteins to be used for updating the tree against the reference set
@@ -413,18 +459,22 @@ def predict_orfs(args):
     start_time = time.time()
 
     sample_prefix = '.'.join(os.path.basename(args.fasta_input).split('.')[:-1])
+    intermediate_files = list()
     if args.num_threads > 1 and args.composition == "meta":
-        # Split the input FASTA into num_threads files to run Prodigal in parallel
-        input_fasta_dict = format_read_fasta(args.fasta_input, args.molecule, args.output)
-        n_seqs = len(input_fasta_dict.keys())
-        chunk_size = int(n_seqs / args.num_threads) + (n_seqs % args.num_threads)
-        split_files = write_new_fasta(input_fasta_dict,
-                                      args.output_dir_var + sample_prefix,
-                                      chunk_size)
+        # Split the input FASTA into num_threads files, each with a similar number of bases, to run Prodigal in parallel
+        formatted_input = args.output_dir_var + os.path.basename(args.fasta_input) + "_formatted.fasta"
+        input_fasta_index = format_fasta_to_file(args.fasta_input, args.molecule, args.output, formatted_input)
+        split_files = write_balanced_fasta_chunks(input_fasta_index,
+                                                  args.output_dir_var + sample_prefix,
+                                                  args.num_threads)
+        input_fasta_index.close()
+        intermediate_files += split_files + [formatted_input, input_fasta_index.index_file]
     else:
         split_files = [args.fasta_input]
 
     task_list = list()
+    tmp_prodigal_aa_orfs = list()
+    tmp_prodigal_nuc_orfs = list()
     for fasta_chunk in split_files:
         chunk_prefix = args.output_dir_final + '.'.join(os.path.basename(fasta_chunk).split('.')[:-1])
         prodigal_command = [args.executables["prodigal"]]
@@ -434,6 +484,8 @@ def predict_orfs(args):
         prodigal_command += ["-d", chunk_prefix + "_ORFs.fna"]
         prodigal_command += ["1>/dev/null", "2>/dev/null"]
         task_list.append(prodigal_command)
+        tmp_prodigal_aa_orfs.append(chunk_prefix + "_ORFs.faa")
+        tmp_prodigal_nuc_orfs.append(chunk_prefix + "_ORFs.fna")
 
     num_tasks = len(task_list)
     if num_tasks > 0:
@@ -443,16 +495,15 @@ def predict_orfs(args):
         cl_farmer.task_queue.close()
         cl_farmer.task_queue.join()
 
-    # Concatenate outputs
+    # Concatenate outputs, in the order of the chunks
     aa_orfs_file = args.output_dir_final + sample_prefix + "_ORFs.faa"
     nuc_orfs_file = args.output_dir_final + sample_prefix + "_ORFs.fna"
     if not os.path.isfile(aa_orfs_file) and not os.path.isfile(nuc_orfs_file):
-        tmp_prodigal_aa_orfs = glob.glob(args.output_dir_final + sample_prefix + "*_ORFs.faa")
-        tmp_prodigal_nuc_orfs = glob.glob(args.output_dir_final + sample_prefix + "*_ORFs.fna")
-        os.system("cat " + ' '.join(tmp_prodigal_aa_orfs) + " > " + aa_orfs_file)
-        os.system("cat " + ' '.join(tmp_prodigal_nuc_orfs) + " > " + nuc_orfs_file)
-        intermediate_files = list(tmp_prodigal_aa_orfs + tmp_prodigal_nuc_orfs + split_files)
-        for tmp_file in intermediate_files:
+        concatenate_files(tmp_prodigal_aa_orfs, aa_orfs_file)
+        concatenate_files(tmp_prodigal_nuc_orfs, nuc_orfs_file)
+        intermediate_files += tmp_prodigal_aa_orfs + tmp_prodigal_nuc_orfs
+    for tmp_file in intermediate_files:
+        if os.path.isfile(tmp_file):
             os.remove(tmp_file)
 
     logging.info("done.\n")
@@ -499,40 +550,162 @@ def hmmsearch_orfs(args, marker_build_dict):
             else:
                 nucl_target_hmm_files.append(hmm_profile)
 
-    acc = 0.0
+    if args.hmm_db:
+        return hmmscan_orfs(args, prot_target_hmm_files)
+
     logging.info("Searching for marker proteins in ORFs using hmmsearch.\n")
     step_proportion = setup_progress_bar(len(prot_target_hmm_files) + len(nucl_target_hmm_files))
 
-    # Create and launch the hmmsearch commands iteratively.
-    # Since its already rippin' fast, don't need to run in parallel
+    # hmmsearch scales poorly beyond a few threads, so run several searches concurrently with a few threads each
+    parallel_jobs, job_threads = split_threads(args.num_threads, len(prot_target_hmm_files))
     hmmsearch_command_base = [args.executables["hmmsearch"]]
-    hmmsearch_command_base += ["--cpu", str(args.num_threads)]
+    hmmsearch_command_base += ["--cpu", str(job_threads)]
     hmmsearch_command_base.append("--noali")
+    search_results = dict()
+    progress = {"acc": 0.0}
+
+    def log_search(result):
+        cmd_list, stdout, ret_code, wall_time = result
+        search_results[cmd_list[cmd_list.index("--domtblout") + 1]] = (cmd_list, stdout, ret_code, wall_time)
+        # Update the progress bar
+        progress["acc"] += 1.0
+        if progress["acc"] >= step_proportion:
+            progress["acc"] -= step_proportion
+            sys.stdout.write("-")
+            sys.stdout.flush()
+
+    pool = Pool(processes=parallel_jobs)
     for hmm_file in prot_target_hmm_files:
         rp_marker = re.sub(".hmm", '', os.path.basename(hmm_file))
         domtbl = args.output_dir_var + rp_marker + "_to_ORFs_domtbl.txt"
         hmm_domtbl_files.append(domtbl)
         final_hmmsearch_command = hmmsearch_command_base + ["--domtblout", domtbl]
         final_hmmsearch_command += [hmm_file, args.formatted_input_file]
-        stdout, ret_code = launch_write_command(final_hmmsearch_command)
+        pool.apply_async(func=launch_timed_command,
+                         args=(final_hmmsearch_command, ),
+                         callback=log_search)
+    pool.close()
+    pool.join()
+    sys.stdout.write("-]\n")
+
+    # Check the searches in the same order the domain tables are returned
+    timing_string = "\thmmsearch wall time (seconds) using " + str(parallel_jobs) + " job(s) with " +\
+                    str(job_threads) + " thread(s) each:\n"
+    for domtbl in hmm_domtbl_files:
+        if domtbl not in search_results:
+            logging.error("hmmsearch did not return for " + domtbl + "\n")
+            sys.exit(3)
+        cmd_list, stdout, ret_code, wall_time = search_results[domtbl]
         if ret_code != 0:
             logging.error("hmmsearch did not complete successfully! Output:\n" + stdout + "\n" +
-                          "Command used:\n" + ' '.join(final_hmmsearch_command) + "\n")
+                          "Command used:\n" + ' '.join(cmd_list) + "\n")
             sys.exit(3)
+        timing_string += "\t\t" + os.path.basename(cmd_list[-2]) + "\t" + str(round(wall_time, 2)) + "\n"
+    logging.debug(timing_string)
 
-        # Update the progress bar
-        acc += 1.0
-        if acc >= step_proportion:
-            acc -= step_proportion
-            time.sleep(0.1)
-            sys.stdout.write("-")
-            sys.stdout.flush()
+    return hmm_domtbl_files
+
+
+def press_hmm_database(args, hmm_files):
+    """
+    Concatenates the HMM profiles into a single database and presses it with hmmpress for hmmscan.
+    The database is cached in args.cache_dir and named by a hash of the profiles' contents, so it is only built once
+    for each set of markers.
+
+    :param args: Command-line argument object from get_options and check_parser_arguments
+    :param hmm_files: List of HMM profile files to include in the database
+    :return: Path to the HMM database and a dictionary mapping each HMM's name to the profile file it came from
+    """
+    hmm_name_map = dict()
+    content_hash = hashlib.md5()
+    for hmm_file in hmm_files:
+        try:
+            hmm_handler = open(hmm_file, 'rb')
+        except IOError:
+            logging.error("Unable to open " + hmm_file + " for reading!\n")
+            sys.exit(3)
+        hmm_content = hmm_handler.read()
+        hmm_handler.close()
+        content_hash.update(hmm_content)
+        for line in hmm_content.decode("utf-8").split("\n"):
+            if line.startswith("NAME"):
+                hmm_name = line.split()[1]
+                if hmm_name in hmm_name_map:
+                    logging.error("HMM name '" + hmm_name + "' is found in both " + hmm_name_map[hmm_name] +
+                                  " and " + hmm_file + ". The hits of each could not be told apart.\n")
+                    sys.exit(3)
+                hmm_name_map[hmm_name] = hmm_file
+
+    hmm_db = args.cache_dir + "markers_" + content_hash.hexdigest() + ".hmm"
+
+    pressed_exts = [".h3m", ".h3i", ".h3f", ".h3p"]
+    if all([os.path.isfile(hmm_db + ext) for ext in [""] + pressed_exts]):
+        logging.debug("\tUsing the cached HMM database " + hmm_db + "\n")
+    else:
+        logging.info("Pressing the HMM database of " + str(len(hmm_files)) + " markers... ")
+        # Build under a name unique to this process and move the files into place, since other runs may be using
+        # (or pressing) the same database
+        temp_db = hmm_db + '.' + str(os.getpid()) + ".tmp"
+        concatenate_files(hmm_files, temp_db)
+        launch_write_command([args.executables["hmmpress"], "-f", temp_db])
+        try:
+            for ext in [""] + pressed_exts:
+                os.replace(temp_db + ext, hmm_db + ext)
+        except OSError:
+            logging.error("Unable to move the pressed HMM database " + temp_db + " to " + hmm_db + "!\n")
+            sys.exit(3)
+        logging.info("done.\n")
+
+    return hmm_db, hmm_name_map
+
+
+def hmmscan_orfs(args, hmm_files):
+    """
+    Searches the formatted input sequences against all HMM profiles in a single hmmscan run, so the input is only
+    read once, then splits the domain table into one per marker as if hmmsearch_orfs had been run for each.
+    The number of sequences in the input is used for the E-value calculations (-Z) to match those of hmmsearch, and
+    the conditional domain E-values are rescaled per marker by split_hmmscan_domtbl to match them as well.
+
+    :param args: Command-line argument object from get_options and check_parser_arguments
+    :param hmm_files: List of HMM profile files to search against
+    :return: List of the domain table files for each marker
+    """
+    hmm_domtbl_files = list()
+    marker_domtbl_map = dict()
+    hmm_db, hmm_name_map = press_hmm_database(args, hmm_files)
+
+    for hmm_name in hmm_name_map:
+        rp_marker = re.sub(".hmm", '', os.path.basename(hmm_name_map[hmm_name]))
+        marker_domtbl_map[hmm_name] = args.output_dir_var + rp_marker + "_to_ORFs_domtbl.txt"
+    for hmm_file in hmm_files:
+        rp_marker = re.sub(".hmm", '', os.path.basename(hmm_file))
+        hmm_domtbl_files.append(args.output_dir_var + rp_marker + "_to_ORFs_domtbl.txt")
+
+    num_seqs = len(FastaIndex(args.formatted_input_file))
+    logging.info("Searching for marker proteins in ORFs using hmmscan... ")
+    start_time = time.time()
+    combined_domtbl = args.output_dir_var + "markers_to_ORFs_domtbl.txt"
+    hmmscan_command = [args.executables["hmmscan"]]
+    hmmscan_command += ["--cpu", str(args.num_threads)]
+    # Conditional domain E-values are rescaled for each marker when the domain table is split
+    hmmscan_command += ["-Z", str(num_seqs), "--domZ", str(num_seqs), "--domE", str(10 * num_seqs)]
+    hmmscan_command.append("--noali")
+    hmmscan_command += ["--domtblout", combined_domtbl]
+    hmmscan_command += [hmm_db, args.formatted_input_file]
+    launch_write_command(hmmscan_command)
+    split_hmmscan_domtbl(combined_domtbl, marker_domtbl_map, num_seqs)
+    logging.info("done.\n")
+
+    end_time = time.time()
+    hours, remainder = divmod(end_time - start_time, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    logging.debug("\thmmscan time required: " +
+                  ':'.join([str(hours), str(minutes), str(round(seconds, 2))]) + "\n")
 
-    sys.stdout.write("-]\n")
     return hmm_domtbl_files
 
 
-def extract_hmm_matches(args, hmm_matches: dict, fasta_dict: dict):
+def extract_hmm_matches(args, hmm_matches: dict, fasta_index: FastaIndex):
     """
     Function writes the sequences identified by the HMMs to output files in FASTA format.
     Full-length query sequences with homologous regions are put into two FASTA files:
@@ -543,7 +716,8 @@ def extract_hmm_matches(args, hmm_matches: dict, fasta_dict: dict):
 
     :param args: Command-line argument object from get_options and check_parser_arguments
     :param hmm_matches: Contains lists of HmmMatch objects mapped to the marker they matched
-    :param fasta_dict: Stores either the original or ORF-predicted input FASTA. Headers are keys, sequences are values
+    :param fasta_index: FastaIndex of the formatted input FASTA (args.formatted_input_file). Returned by
+     format_fasta_to_file
     :return: List of files that go on to placement stage, dictionary mapping marker-specific numbers to contig names
     """
     logging.info("Extracting the quality-controlled protein sequences... ")
@@ -565,8 +739,10 @@ def extract_hmm_matches(args, hmm_matches: dict, fasta_dict: dict):
         # Algorithm for binning sequences:
         # 1. Sort HmmMatches by the proportion of the HMM profile they covered in increasing order (full-length last)
         # 2. For HmmMatch in sorted matches, determine overlap between HmmMatch and each bin's representative HmmMatch
+        #    (only those representatives whose profile start positions, indexed in rep_starts, could qualify)
         # 3. If overlap exceeds 80% of representative's aligned length add it to the bin, else continue
         # 4. When bins are exhausted create new bin with HmmMatch
+        rep_starts = list()
         for hmm_match in sorted(hmm_matches[marker], key=lambda x: x.end - x.start):
             if hmm_match.desc != '-':
                 contig_name = hmm_match.orf + '_' + hmm_match.desc
@@ -576,23 +752,27 @@ def extract_hmm_matches(args, hmm_matches: dict, fasta_dict: dict):
             orf_coordinates = str(hmm_match.start) + '_' + str(hmm_match.end)
             numeric_contig_index[marker][numeric_decrementor] = contig_name + '_' + orf_coordinates
             # Add the FASTA record of the trimmed sequence - this one moves on for placement
-            full_sequence = fasta_dict[reformat_string('>' + contig_name)]
+            full_sequence = fasta_index[reformat_string('>' + contig_name)]
+            trimmed_record = '>' + str(numeric_decrementor) + "\n" + \
+                             full_sequence[hmm_match.start - 1:hmm_match.end] + "\n"
+            # Only representatives starting within ((4*pstart - pend)/3, pend) on the profile can be covered by >80%
+            lo = bisect.bisect_left(rep_starts, ((4*hmm_match.pstart - hmm_match.pend)//3 - 1, -1))
+            hi = bisect.bisect_right(rep_starts, (hmm_match.pend, len(bins)))
             binned = False
-            for bin_num in sorted(bins):
+            for bin_num in sorted([rep_bin for _, rep_bin in rep_starts[lo:hi]]):
                 bin_rep = bins[bin_num][0]
                 overlap = min(hmm_match.pend, bin_rep.pend) - max(hmm_match.pstart, bin_rep.pstart)
                 if (100*overlap)/(bin_rep.pend - bin_rep.pstart) > 80:
                     bins[bin_num].append(hmm_match)
-                    trimmed_query_bins[bin_num] += '>' + str(numeric_decrementor) + "\n" + \
-                                                   full_sequence[hmm_match.start - 1:hmm_match.end] + "\n"
+                    trimmed_query_bins[bin_num].append(trimmed_record)
                     binned = True
                     break
             if not binned:
                 bin_num = len(bins)
                 bins[bin_num] = list()
                 bins[bin_num].append(hmm_match)
-                trimmed_query_bins[bin_num] = '>' + str(numeric_decrementor) + "\n" + \
-                                              full_sequence[hmm_match.start - 1:hmm_match.end] + "\n"
+                trimmed_query_bins[bin_num] = [trimmed_record]
+                bisect.insort(rep_starts, (hmm_match.pstart, bin_num))
 
             # Now for the header format to be used in the bulk FASTA:
             # >contig_name|marker_gene|start_end
@@ -612,7 +792,7 @@ def extract_hmm_matches(args, hmm_matches: dict, fasta_dict: dict):
                     logging.error("Unable to open " + marker_query_fa + " for writing.\n")
                     sys.exit(3)
                 hmmalign_input_fastas.append(marker_query_fa)
-                homolog_seq_fasta.write(trimmed_query_bins[group])
+                homolog_seq_fasta.write(''.join(trimmed_query_bins[group]))
                 homolog_seq_fasta.close()
         trimmed_query_bins.clear()
         bins.clear()
@@ -623,9 +803,116 @@ def extract_hmm_matches(args, hmm_matches: dict, fasta_dict: dict):
         trimmed_hits_fasta = args.output_dir_final + marker + "_hmm_purified.faa"
         logging.debug("\tWriting " + marker + " sequences to " + trimmed_hits_fasta + "\n")
         write_new_fasta(marker_gene_dict[marker], trimmed_hits_fasta)
+    fasta_index.close()
     return hmmalign_input_fastas, numeric_contig_index
 
  
+def batch_placement_queries(args, homolog_seq_files, marker_build_dict, ref_alignment_dimensions):
+    """
+    Packs the query sequences in the groups written by extract_hmm_matches into batches for each marker,
+    with as many queries in each batch as fit within args.placement_mem megabytes according to
+    estimate_raxml_memory. Since both hmmalign and RAxML's EPA handle each query independently, each batch is aligned
+    and placed in a single job rather than one job per group, reducing the number of times RAxML loads the
+    reference tree and model parameters.
+
+    :param args: Command-line argument object from get_options and check_parser_arguments
+    :param homolog_seq_files: List of query FASTA files returned by extract_hmm_matches
+    :param marker_build_dict: A dictionary (indexed by marker 5-character 'denominator's) mapping MarkerBuild objects
+    :param ref_alignment_dimensions: Dictionary mapping denominators to the dimensions of the reference alignment
+    :return: List of the batched query FASTA files, and a dictionary mapping each denominator to a dictionary of
+     batch numbers, each mapping the query sequence names in the batch to the number of the group it came from
+    """
+    batch_files = list()
+    placement_batches = dict()
+    marker_group_files = dict()
+    group_re = re.compile(r"^(.*)_hmm_purified_group(\d+)\.faa$")
+    for query_fasta in sorted(homolog_seq_files):
+        group_info = group_re.match(os.path.basename(query_fasta))
+        if not group_info:
+            logging.error("Unable to parse the marker and group from " + query_fasta + "\n")
+            sys.exit(3)
+        marker, group = group_info.groups()
+        if marker not in marker_group_files:
+            marker_group_files[marker] = list()
+        marker_group_files[marker].append((int(group), query_fasta))
+
+    for denominator in sorted(marker_build_dict):
+        ref_marker = marker_build_dict[denominator]
+        if ref_marker.cog not in marker_group_files:
+            continue
+        num_ref_seqs, ref_align_len = ref_alignment_dimensions[denominator]
+        taxon_memory = estimate_raxml_memory(1, ref_align_len, ref_marker.molecule)
+        max_queries = max(1, int(args.placement_mem * 1E6 // taxon_memory) - num_ref_seqs)
+
+        placement_batches[denominator] = dict()
+        batch_num = 0
+        batch_seqs = dict()
+        query_groups = dict()
+        for group, query_fasta in sorted(marker_group_files[ref_marker.cog]):
+            group_seqs = read_fasta_to_dict(query_fasta)
+            for seq_name in group_seqs:
+                if len(batch_seqs) == max_queries:
+                    batch_files += write_new_fasta(batch_seqs, args.output_dir_var + ref_marker.cog +
+                                                   "_hmm_purified_batch" + str(batch_num) + ".faa")
+                    placement_batches[denominator][batch_num] = query_groups
+                    batch_num += 1
+                    batch_seqs = dict()
+                    query_groups = dict()
+                batch_seqs[seq_name] = group_seqs[seq_name]
+                query_groups[seq_name] = group
+        if batch_seqs:
+            batch_files += write_new_fasta(batch_seqs, args.output_dir_var + ref_marker.cog +
+                                           "_hmm_purified_batch" + str(batch_num) + ".faa")
+            placement_batches[denominator][batch_num] = query_groups
+        logging.debug("\t" + str(len(marker_group_files[ref_marker.cog])) + " " + ref_marker.cog +
+                      " query groups packed into " + str(len(placement_batches[denominator])) +
+                      " placement batch(es) of up to " + str(max_queries) + " sequences\n")
+
+    return batch_files, placement_batches
+
+
+def split_batched_jplaces(args, placement_batches):
+    """
+    Splits the jplace files of the batches made by batch_placement_queries into one jplace file per query group,
+    named as they would have been if each group had been placed separately.
+
+    :param args: Command-line argument object from get_options and check_parser_arguments
+    :param placement_batches: Dictionary returned by batch_placement_queries
+    :return: None
+    """
+    batch_jplace_re = re.compile(r"^RAxML_portableTree\.([A-Z][0-9]{4}|[a-z])_hmm_purified_batch(\d+)(.*)\.jplace$")
+    batch_jplaces = list()
+    for jplace_file in glob.glob(args.output_dir_var + "RAxML_portableTree.*_hmm_purified_batch*.jplace"):
+        batch_info = batch_jplace_re.match(os.path.basename(jplace_file))
+        if batch_info:
+            denominator, batch_num, suffix = batch_info.groups()
+            batch_jplaces.append((denominator, int(batch_num), suffix, jplace_file))
+
+    # A group's queries may be split across consecutive batches, so its placements are collected from all of them
+    group_jplaces = dict()
+    for denominator, batch_num, suffix, jplace_file in sorted(batch_jplaces):
+        query_groups = placement_batches[denominator][batch_num]
+        batch_jplace = jplace_parser(jplace_file)
+        for pquery in batch_jplace.placements:
+            group_jplace_file = args.output_dir_var + "RAxML_portableTree." + denominator +\
+                                "_hmm_purified_group" + str(query_groups[pquery.names[0]]) + suffix + ".jplace"
+            if group_jplace_file not in group_jplaces:
+                group_jplace = ItolJplace()
+                group_jplace.tree = batch_jplace.tree
+                group_jplace.fields = list(batch_jplace.fields)
+                group_jplace.version = batch_jplace.version
+                group_jplace.metadata = batch_jplace.metadata
+                group_jplace.placements = list()
+                group_jplaces[group_jplace_file] = group_jplace
+            group_jplaces[group_jplace_file].placements.append(pquery)
+
+    for group_jplace_file in group_jplaces:
+        write_jplace(group_jplaces[group_jplace_file], group_jplace_file)
+    for _, _, _, jplace_file in batch_jplaces:
+        os.remove(jplace_file)
+    return
+
+
 def collect_blast_outputs(args):
     """
     Deletes empty BLAST results files.
@@ -797,13 +1084,16 @@ def subsequence(fasta_dictionary, contig_name, start, end):
     """
     Extracts a sub-sequence from `start` to `end` of `contig_name` in `fasta_dictionary`
      with headers for keys and sequences as values. `contig_name` does not contain the '>' character
-    :param fasta_dictionary:
+    :param fasta_dictionary: Either a dictionary or a FastaIndex, which only reads the sub-sequence from disk
     :param contig_name:
     :param start:
     :param end:
     :return: A string representing the sub-sequence of interest
     """
-    subseq = fasta_dictionary['>' + contig_name][start:end]
+    if isinstance(fasta_dictionary, FastaIndex):
+        subseq = fasta_dictionary.subsequence('>' + contig_name, start, end)
+    else:
+        subseq = fasta_dictionary['>' + contig_name][start:end]
     return subseq
 
 
@@ -1402,8 +1692,7 @@ def get_alignment_dims(args, marker_build_dict):
         if cog in all_markers:
             for marker_code in marker_build_dict:
                 if marker_build_dict[marker_code].cog == cog:
-                    seq_dict = read_fasta_to_dict(fasta)
-                    alignment_dimensions_dict[marker_code] = (validate_multiple_alignment_utility(seq_dict, fasta))
+                    alignment_dimensions_dict[marker_code] = reference_alignment_summary(args.cache_dir, fasta)[0]
     return alignment_dimensions_dict
 
 
@@ -1427,13 +1716,12 @@ def multiple_alignments(args, single_query_sequence_files, marker_build_dict, to
     return singlehit_files
 
 
-def create_ref_phy_files(args, single_query_fasta_files, marker_build_dict, ref_alignment_dimensions):
+def create_ref_phy_files(args, single_query_fasta_files, marker_build_dict):
     """
-    Creates a phy file for every reference marker that was matched by a query sequence
+    Creates a phy file for every reference marker that was matched by a query sequence, copied from args.cache_dir
     :param args:
     :param single_query_fasta_files:
     :param marker_build_dict:
-    :param ref_alignment_dimensions:
     :return:
     """
     treesapp_resources = args.treesapp + os.sep + 'data' + os.sep
@@ -1441,24 +1729,11 @@ def create_ref_phy_files(args, single_query_fasta_files, marker_build_dict, ref_
     # Convert the reference sequence alignments to .phy files for every marker identified
     for query_fasta in single_query_fasta_files:
         marker = re.match("(.*)_hmm_purified.*", os.path.basename(query_fasta)).group(1)
-        denominator = None
-        for denominator in marker_build_dict.keys():
-            if marker_build_dict[denominator].cog == marker:
-                break
-
         ref_alignment_phy = args.output_dir_var + marker + ".phy"
         if os.path.isfile(ref_alignment_phy):
             continue
         aligned_fasta = treesapp_resources + "alignment_data" + os.sep + marker + ".fa"
-
-        num_ref_seqs, ref_align_len = ref_alignment_dimensions[denominator]
-        aligned_fasta_dict = read_fasta_to_dict(aligned_fasta)
-        dict_for_phy = dict()
-        for seq_name in aligned_fasta_dict:
-            dict_for_phy[seq_name.split('_')[0]] = aligned_fasta_dict[seq_name]
-        phy_dict = reformat_fasta_to_phy(dict_for_phy)
-
-        write_phy_file(ref_alignment_phy, phy_dict, (num_ref_seqs, ref_align_len))
+        shutil.copyfile(cached_reference_phylip(args.cache_dir, aligned_fasta), ref_alignment_phy)
     return
 
 
@@ -1534,14 +1809,163 @@ def prepare_and_run_papara(args, single_query_fasta_files, marker_build_dict):
     return query_alignment_files
 
 
+_reference_alignment_blocks = dict()
+
+
+def load_reference_alignment_block(ref_alignment, hmm_file):
+    """
+    Converts the rows of a marker's reference alignment to the profile HMM's states, so they can be merged with query
+    sequences aligned by hmmalign without including the reference alignment (--mapali) in every hmmalign call.
+    The block is only built the first time it is requested (in this process, or a parent process it was forked from).
+
+    :param ref_alignment: The FASTA-formatted reference alignment the HMM was built from
+    :param hmm_file: The marker's HMM file
+    :return: A tuple of a dictionary of reference sequence names (truncated at their first underscore) mapped to
+     (match state string, list of insert strings) tuples and a list of the longest insert at each insert position.
+     None if the HMM does not record which alignment column each match state was built from.
+    """
+    if ref_alignment in _reference_alignment_blocks:
+        return _reference_alignment_blocks[ref_alignment]
+
+    map_columns = read_hmm_map_columns(hmm_file)
+    ref_seqs = read_fasta_to_dict(ref_alignment)
+    if not map_columns or not ref_seqs or max(map_columns) >= min([len(seq) for seq in ref_seqs.values()]):
+        logging.debug("Unable to map the columns of " + ref_alignment + " to the match states of " + hmm_file +
+                      ". Reference sequences will be aligned with hmmalign --mapali.\n")
+        _reference_alignment_blocks[ref_alignment] = None
+        return None
+
+    ref_rows = dict()
+    insert_widths = [0] * (len(map_columns) + 1)
+    for seq_name in ref_seqs:
+        sequence = ref_seqs[seq_name].upper()
+        matches = list()
+        inserts = list()
+        previous_column = -1
+        for column in map_columns:
+            inserts.append(re.sub(r"[-.]", '', sequence[previous_column+1:column]))
+            matches.append('-' if sequence[column] == '.' else sequence[column])
+            previous_column = column
+        inserts.append(re.sub(r"[-.]", '', sequence[previous_column+1:]))
+        for state in range(len(inserts)):
+            if len(inserts[state]) > insert_widths[state]:
+                insert_widths[state] = len(inserts[state])
+        ref_rows[seq_name.split('_')[0]] = ("".join(matches), inserts)
+
+    _reference_alignment_blocks[ref_alignment] = (ref_rows, insert_widths)
+    return _reference_alignment_blocks[ref_alignment]
+
+
+def merge_reference_alignment_block(reference_block, query_rows):
+    """
+    Lays out the reference and query rows as hmmalign --mapali would: each insert position is as wide as its longest
+    insert, the N-terminal flank is right-justified, the C-terminal flank left-justified and other inserts are split
+    with the second half right-justified. Gaps are all written as '-'.
+
+    :param reference_block: The (reference rows, insert widths) tuple from load_reference_alignment_block
+    :param query_rows: The query sequences, in the format returned by parse_stockholm_states
+    :return: Dictionary of sequence names mapped to aligned sequences
+    """
+    ref_rows, insert_widths = reference_block
+    insert_widths = list(insert_widths)
+    for seq_name in query_rows:
+        inserts = query_rows[seq_name][1]
+        for state in range(len(inserts)):
+            if len(inserts[state]) > insert_widths[state]:
+                insert_widths[state] = len(inserts[state])
+
+    num_states = len(insert_widths) - 1
+    seq_dict = dict()
+    for rows in [ref_rows, query_rows]:
+        for seq_name in rows:
+            matches, inserts = rows[seq_name]
+            segments = list()
+            for state in range(num_states + 1):
+                insert = inserts[state]
+                padding = '-' * (insert_widths[state] - len(insert))
+                if state == 0:
+                    segments.append(padding + insert)
+                elif state == num_states:
+                    segments.append(insert + padding)
+                else:
+                    half = len(insert) // 2
+                    segments.append(insert[:half] + padding + insert[half:])
+                if state < num_states:
+                    segments.append(matches[state])
+            seq_dict[seq_name] = "".join(segments)
+    return seq_dict
+
+
+def run_multiple_alignment(malign_command, sto_file, mfa_file, ref_alignment=None, hmm_file=None):
+
+    """
+    Runs hmmalign or cmalign and converts the Stockholm alignment it writes to a FASTA file, with each sequence name
+    truncated at its first underscore. Intended to be called from worker processes so errors are returned.
+
+    :param malign_command: The hmmalign or cmalign command, redirecting its output to sto_file
+    :param sto_file: Path to the Stockholm file the command writes
+    :param mfa_file: Path to write the FASTA-formatted multiple alignment to
+    :param ref_alignment: If the command aligns only the queries, the reference alignment to merge them with
+    :param hmm_file: The HMM the queries were aligned to, if ref_alignment is provided
+    :return: The command list, its stdout, returncode and wall time, and an error message (empty if successful)
+    """
+    cmd_list, stdout, returncode, wall_time = launch_timed_command(malign_command)
+    if returncode != 0:
+        return cmd_list, stdout, returncode, wall_time, "Multiple alignment failed for " + sto_file + "."
+    try:
+        sto_handler = open(sto_file, 'r')
+    except IOError:
+        return cmd_list, stdout, returncode, wall_time, "Unable to open " + sto_file + " for reading!"
+    try:
+        mfa_handler = open(mfa_file, 'w')
+    except IOError:
+        return cmd_list, stdout, returncode, wall_time, "Unable to open " + mfa_file + " for writing!"
+
+    if not ref_alignment:
+        try:
+            convert_stockholm(sto_handler, mfa_handler, "fasta", truncate_names=True)
+        except ValueError as error:
+            return cmd_list, stdout, returncode, wall_time, "Unable to convert " + sto_file + ":\n" + str(error)
+        finally:
+            sto_handler.close()
+            mfa_handler.close()
+        return cmd_list, stdout, returncode, wall_time, ""
+
+    try:
+        tmp_dict = parse_stockholm_states(sto_handler)
+    except ValueError as error:
+        mfa_handler.close()
+        return cmd_list, stdout, returncode, wall_time, "Unexpected line format in " + sto_file + ":\n" + str(error)
+    sto_handler.close()
+
+    seq_dict = dict()
+    for seq_name in tmp_dict:
+        seq_dict[seq_name.split('_')[0]] = tmp_dict[seq_name]
+    reference_block = load_reference_alignment_block(ref_alignment, hmm_file)
+    for seq_name in seq_dict:
+        if len(seq_dict[seq_name][0]) != len(reference_block[1]) - 1:
+            mfa_handler.close()
+            return cmd_list, stdout, returncode, wall_time, "Match states of " + sto_file +\
+                   " do not correspond to the reference alignment " + ref_alignment + "."
+    seq_dict = merge_reference_alignment_block(reference_block, seq_dict)
+    for seq_name in sorted(seq_dict):
+        mfa_handler.write('>' + seq_name + "\n" + seq_dict[seq_name] + "\n")
+    mfa_handler.close()
+
+    return cmd_list, stdout, returncode, wall_time, ""
+
+
 def prepare_and_run_hmmalign(args, single_query_fasta_files, marker_build_dict):
     """
-    Runs `hmmalign` to add the query sequences into the reference FASTA multiple alignments
+    Runs `hmmalign` (or `cmalign` for rRNA markers) to add the query sequences into the reference multiple alignments.
+    The alignments, and their conversion from Stockholm to FASTA format, are run in a pool of args.num_threads
+    processes.
 
     :param args:
     :param single_query_fasta_files:
     :param marker_build_dict:
-    :return: list of multiple sequence alignment files (in Clustal format) generated by hmmalign.
+    :return: Dictionary of marker denominators mapped to the list of FASTA multiple alignment files generated,
+     in the sorted order of their query FASTA files
     """
 
     reference_data_prefix = args.reference_data_prefix
@@ -1550,9 +1974,8 @@ def prepare_and_run_hmmalign(args, single_query_fasta_files, marker_build_dict):
     logging.info("Running hmmalign... ")
 
     start_time = time.time()
-    # task_list = list()
+    alignment_jobs = list()
 
-    # Run hmmalign on each fasta file
     for query_fasta in sorted(single_query_fasta_files):
         file_name_info = re.match("(.*)_hmm_purified.*\.(f.*)$", os.path.basename(query_fasta))
         if file_name_info:
@@ -1579,37 +2002,51 @@ def prepare_and_run_hmmalign(args, single_query_fasta_files, marker_build_dict):
                               '--outformat', 'Stockholm',
                               treesapp_resources + reference_data_prefix + 'hmm_data' + os.sep + marker + '.cm',
                               query_fasta, '>', query_multiple_alignment]
+            reference_files = (None, None)
         else:
-            malign_command = [args.executables["hmmalign"], '--mapali',
-                              treesapp_resources + reference_data_prefix + 'alignment_data' +
-                              os.sep + marker + '.fa',
-                              '--outformat', 'Stockholm',
-                              treesapp_resources + reference_data_prefix + 'hmm_data' + os.sep + marker + '.hmm',
-                              query_fasta, '>', query_multiple_alignment]
-        # TODO: Run this using multiple processes
-        # task_list.append(malign_command)
-        stdout, returncode = launch_write_command(malign_command)
-        if returncode != 0:
-            logging.error("Multiple alignment failed for " + query_fasta + ". Command used:\n" +
-                          ' '.join(malign_command) + " output:\n" + stdout + "\n")
-            sys.exit(3)
-        if ref_marker.denominator not in hmmalign_singlehit_files:
-            hmmalign_singlehit_files[ref_marker.denominator] = []
+            ref_alignment = treesapp_resources + reference_data_prefix + 'alignment_data' + os.sep + marker + '.fa'
+            hmm_file = treesapp_resources + reference_data_prefix + 'hmm_data' + os.sep + marker + '.hmm'
+            malign_command = [args.executables["hmmalign"]]
+            # Only the queries are aligned when the reference rows can be merged in from the marker's cached block
+            if load_reference_alignment_block(ref_alignment, hmm_file):
+                reference_files = (ref_alignment, hmm_file)
+            else:
+                malign_command += ['--mapali', ref_alignment]
+                reference_files = (None, None)
+            malign_command += ['--outformat', 'Stockholm', hmm_file, query_fasta, '>', query_multiple_alignment]
         mfa_file = re.sub("\.sto$", ".mfa", query_multiple_alignment)
-        tmp_dict = read_stockholm_to_dict(query_multiple_alignment)
-        seq_dict = dict()
-        for seq_name in tmp_dict:
-            seq_dict[seq_name.split('_')[0]] = tmp_dict[seq_name]
-        write_new_fasta(seq_dict, mfa_file)
-        hmmalign_singlehit_files[ref_marker.denominator].append(mfa_file)
-
-    # num_tasks = len(task_list)
-    # if num_tasks > 0:
-    #     cl_farmer = CommandLineFarmer("cmalign/hmmalign --mapali", args.num_threads)
-    #     cl_farmer.add_tasks_to_queue(task_list)
-    #
-    #     cl_farmer.task_queue.close()
-    #     cl_farmer.task_queue.join()
+        alignment_jobs.append((ref_marker.denominator, malign_command, query_multiple_alignment, mfa_file,
+                               reference_files))
+
+    alignment_results = dict()
+
+    def collect_alignment(result, mfa):
+        alignment_results[mfa] = result
+
+    if alignment_jobs:
+        pool = Pool(processes=max(1, min(int(args.num_threads), len(alignment_jobs))))
+        for denominator, malign_command, sto_file, mfa_file, reference_files in alignment_jobs:
+            pool.apply_async(func=run_multiple_alignment,
+                             args=(malign_command, sto_file, mfa_file) + reference_files,
+                             callback=lambda result, mfa=mfa_file: collect_alignment(result, mfa))
+        pool.close()
+        pool.join()
+
+    # Check the alignments and collect their outputs in the order the jobs were created
+    timing_string = "\tMultiple alignment wall time (seconds):\n"
+    for denominator, malign_command, sto_file, mfa_file, reference_files in alignment_jobs:
+        if mfa_file not in alignment_results:
+            logging.error("Multiple alignment did not return for " + sto_file + "\n")
+            sys.exit(3)
+        cmd_list, stdout, returncode, wall_time, error_message = alignment_results[mfa_file]
+        if error_message:
+            logging.error(error_message + " Command used:\n" + ' '.join(cmd_list) + " output:\n" + stdout + "\n")
+            sys.exit(3)
+        if denominator not in hmmalign_singlehit_files:
+            hmmalign_singlehit_files[denominator] = []
+        hmmalign_singlehit_files[denominator].append(mfa_file)
+        timing_string += "\t\t" + os.path.basename(sto_file) + "\t" + str(round(wall_time, 2)) + "\n"
+    logging.debug(timing_string)
 
     logging.info("done.\n")
 
@@ -1789,7 +2226,8 @@ def check_for_removed_sequences(args, mfa_files: dict, marker_build_dict: dict):
     for denominator in sorted(mfa_files.keys()):
         marker = marker_build_dict[denominator].cog
         # Create a set of the reference sequence names
-        ref_headers = get_headers(os.sep.join([args.treesapp, "data", "alignment_data", marker + ".fa"]))
+        ref_fasta = os.sep.join([args.treesapp, "data", "alignment_data", marker + ".fa"])
+        ref_headers = reference_alignment_summary(args.cache_dir, ref_fasta)[1]
         unique_refs = set([re.sub('_' + re.escape(marker), '', x)[1:] for x in ref_headers])
         for multi_align_file in mfa_files[denominator]:
             filtered_multi_align = dict()
@@ -1978,10 +2416,63 @@ def produce_phy_files(args, qc_ma_dict):
     return phy_files
 
 
-def start_raxml(args, phy_files, marker_build_dict):
+def count_msa_sequences(msa_file):
+    """
+    Counts the number of sequences in a multiple alignment file in either Phylip or FASTA format
+
+    :param msa_file: Path to the multiple alignment file
+    :return: The number of sequences in the file
+    """
+    try:
+        msa_handler = open(msa_file, 'r')
+    except IOError:
+        logging.error("Unable to open " + msa_file + " for reading!\n")
+        sys.exit(3)
+    if re.match("phy|phylip", msa_file.split('.')[-1]):
+        num_seqs = int(msa_handler.readline().split()[0])
+    else:
+        num_seqs = 0
+        for line in msa_handler:
+            if line[0] == '>':
+                num_seqs += 1
+    msa_handler.close()
+    return num_seqs
+
+
+def run_raxml_placement(raxml_command, output_dir, query_name):
+    """
+    Runs a single RAxML EPA job and renames its output files. Intended to be called from worker processes.
+
+    :param raxml_command: A list of strings forming the complete RAxML command
+    :param output_dir: The directory RAxML is writing its outputs to
+    :param query_name: The name (-n) of the RAxML run
+    :return: The command list, a string with stdout and stderr text, the returncode, the wall time in seconds
+     and whether the labelled tree was created
+    """
+    raxml_command, stdout, ret_code, wall_time = launch_timed_command(raxml_command)
+
+    # Rename the RAxML output files
+    renames = [('RAxML_info.', '.RAxML_info.txt'),
+               ('RAxML_classification.', '.RAxML_classification.txt'),
+               ('RAxML_originalLabelledTree.', '.originalRAxML_labelledTree.txt')]
+    for prefix, suffix in renames:
+        if os.path.exists(output_dir + prefix + query_name):
+            os.rename(output_dir + prefix + query_name, output_dir + query_name + suffix)
+    labelled_tree = os.path.exists(output_dir + 'RAxML_labelledTree.' + query_name)
+    if labelled_tree:
+        os.remove(output_dir + 'RAxML_labelledTree.' + query_name)
+
+    return raxml_command, stdout, ret_code, wall_time, labelled_tree
+
+
+def start_raxml(args, phy_files, marker_build_dict, ref_alignment_dimensions):
     """
     Run RAxML using the provided Autovivifications of phy files and COGs, as well as the list of models used for each COG.
 
+    RAxML-Pthreads scales poorly on small reference trees so, rather than running each job in turn with all threads,
+    the threads are divided among the jobs according to their estimated cost (from the reference alignment dimensions
+    and the number of query sequences) and jobs are run concurrently for as long as threads remain available.
+
     Returns an Autovivification listing the output files of RAxML.
     Returns an Autovivification containing the reference tree file associated with each functional or rRNA COG.
     """
@@ -1990,7 +2481,7 @@ def start_raxml(args, phy_files, marker_build_dict):
     start_time = time.time()
 
     raxml_outfiles = Autovivify()
-    raxml_calls = 0
+    raxml_jobs = list()
 
     # Maximum-likelihood sequence placement analyses
     denominator_reference_tree_dict = dict()
@@ -1999,6 +2490,25 @@ def start_raxml(args, phy_files, marker_build_dict):
         output_dir = args.output_dir_var
     else:
         output_dir = os.getcwd() + os.sep + args.output_dir_var
+
+    # Estimate the cost of each job up front, so its number of threads is known when its command is built
+    job_costs = list()
+    job_max_threads = list()
+    for denominator in sorted(phy_files.keys()):
+        ref_marker = marker_build_dict[denominator]
+        num_ref_seqs, ref_align_len = ref_alignment_dimensions[denominator]
+        for phy_file in phy_files[denominator]:
+            # EPA evaluates every query on every branch of the reference tree
+            num_queries = max(1, count_msa_sequences(phy_file) - num_ref_seqs)
+            job_costs.append(estimate_raxml_memory(num_ref_seqs, ref_align_len, ref_marker.molecule) * num_queries)
+            # RAxML-Pthreads divides alignment patterns among threads, so keep a few hundred patterns per thread
+            if ref_marker.molecule == "prot":
+                job_max_threads.append(ref_align_len // 150)
+            else:
+                job_max_threads.append(ref_align_len // 500)
+    # RAxML-Pthreads refuses to run with fewer than two threads
+    job_threads = allocate_job_threads(job_costs, args.num_threads, job_max_threads, min_threads=2)
+
     for denominator in sorted(phy_files.keys()):
         # Establish the reference tree file to be used for this contig
         reference_tree_file = mltree_resources + 'tree_data' + os.sep + args.reference_tree
@@ -2039,13 +2549,12 @@ def start_raxml(args, phy_files, marker_build_dict):
             if ref_marker.model is None:
                 raise AssertionError("No best AA model could be detected for the ML step!")
             # Set up the command to run RAxML
-            raxml_command = [args.executables["raxmlHPC"], '-m', ref_marker.model]
+            job_index = len(raxml_jobs)
+            raxml_command = [args.executables["raxmlHPC"], '-m', ref_marker.model, '-T', str(job_threads[job_index])]
             if os.path.isfile(mltree_resources + 'tree_data' + os.sep + ref_marker.cog +
                               "_RAxML_binaryModelParameters.PARAMS"):
                 raxml_command += ["-R", mltree_resources + 'tree_data' + os.sep + ref_marker.cog +
                                   "_RAxML_binaryModelParameters.PARAMS"]
-            # Run RAxML using multiple threads, if CPUs available
-            raxml_command += ['-T', str(int(args.num_threads))]
             raxml_command += ['-s', phy_file,
                               "-p", str(12345),
                               '-t', reference_tree_file,
@@ -2055,43 +2564,65 @@ def start_raxml(args, phy_files, marker_build_dict):
                               '-w', str(output_dir),
                               '>', str(output_dir) + str(query_name) + '_RAxML.txt']
 
-            launch_write_command(raxml_command)
-
-            raxml_calls += 1
-
-            # Rename the RAxML output files
-            move_command = ['mv', str(output_dir) + 'RAxML_info.' + str(query_name),
-                            str(output_dir) + str(query_name) + '.RAxML_info.txt']
-            if os.path.exists(str(output_dir) + 'RAxML_info.' + str(query_name)):
-                os.system(' '.join(move_command))
             raxml_outfiles[denominator][query_name]['classification'] = str(output_dir) + \
                                                                         str(query_name) + \
                                                                         '.RAxML_classification.txt'
             raxml_outfiles[denominator][query_name]['labelled_tree'] = str(output_dir) + \
                                                                        str(query_name) + \
                                                                        '.originalRAxML_labelledTree.txt'
-            move_command1 = ['mv', str(output_dir) + 'RAxML_classification.' + str(query_name),
-                             str(raxml_outfiles[denominator][query_name]['classification'])]
-            move_command2 = ['mv', str(output_dir) + 'RAxML_originalLabelledTree.' + str(query_name),
-                             str(raxml_outfiles[denominator][query_name]['labelled_tree'])]
-            remove_command = ['rm', str(output_dir) + 'RAxML_labelledTree.' + str(query_name)]
-            if os.path.exists(str(output_dir) + 'RAxML_classification.' + str(query_name)):
-                os.system(' '.join(move_command1))
-            if os.path.exists(str(output_dir) + 'RAxML_originalLabelledTree.' + str(query_name)):
-                os.system(' '.join(move_command2))
-            if os.path.exists(str(output_dir) + 'RAxML_labelledTree.' + str(query_name)):
-                os.system(' '.join(remove_command))
+
+            raxml_jobs.append((job_costs[job_index], job_threads[job_index], raxml_command, query_name))
+
+    # Schedule the most expensive jobs first, starting another whenever enough threads are free.
+    # A job is always started when none are running, in case it needs more threads than num_threads.
+    pending = sorted(raxml_jobs, key=lambda job: job[0], reverse=True)
+    raxml_results = dict()
+    finished = queue.Queue()
+    free_threads = max(1, int(args.num_threads))
+    num_running = 0
+    pool = Pool(processes=max(1, min(free_threads, len(pending))))
+    while pending or num_running:
+        i = 0
+        while i < len(pending):
+            threads = pending[i][1]
+            if threads <= free_threads or num_running == 0:
+                job_cost, threads, raxml_command, query_name = pending.pop(i)
+                pool.apply_async(func=run_raxml_placement,
+                                 args=(raxml_command, output_dir, query_name),
+                                 callback=lambda result, n=query_name, t=threads: finished.put((n, t, result)),
+                                 error_callback=lambda err, n=query_name, t=threads: finished.put((n, t, err)))
+                free_threads -= threads
+                num_running += 1
             else:
-                logging.error("Some files were not successfully created for " + str(query_name) + "\n" +
-                              "Check " + str(output_dir) + str(query_name) + "_RAxML.txt for an error!\n")
-                sys.exit(3)
+                i += 1
+        query_name, threads, result = finished.get()
+        raxml_results[query_name] = (threads, result)
+        free_threads += threads
+        num_running -= 1
+    pool.close()
+    pool.join()
+
+    timing_string = "\tRAxML wall time (seconds) and threads for each job:\n"
+    for job in raxml_jobs:
+        query_name = job[3]
+        threads, result = raxml_results[query_name]
+        if isinstance(result, Exception):
+            logging.error("RAxML job for " + query_name + " failed:\n" + str(result) + "\n")
+            sys.exit(3)
+        raxml_command, stdout, ret_code, wall_time, labelled_tree = result
+        if ret_code != 0 or not labelled_tree:
+            logging.error("Some files were not successfully created for " + str(query_name) + "\n" +
+                          "Check " + str(output_dir) + str(query_name) + "_RAxML.txt for an error!\n")
+            sys.exit(3)
+        timing_string += "\t\t" + query_name + "\t" + str(round(wall_time, 2)) + "\t" + str(threads) + "\n"
+    logging.debug(timing_string)
 
     end_time = time.time()
     hours, remainder = divmod(end_time - start_time, 3600)
     minutes, seconds = divmod(remainder, 60)
     logging.debug("\tRAxML time required: " +
                   ':'.join([str(hours), str(minutes), str(round(seconds, 2))]) + "\n")
-    logging.debug("\tRAxML was called " + str(raxml_calls) + " times.\n")
+    logging.debug("\tRAxML was called " + str(len(raxml_jobs)) + " times.\n")
 
     return raxml_outfiles, denominator_reference_tree_dict, len(phy_files.keys())
 
@@ -2759,7 +3290,7 @@ def write_classified_nuc_sequences(tree_saps, nuc_orfs_formatted_dict, orf_nuc_f
     """
     Function to write the nucleotide sequences representing the full-length ORF for each classified sequence
     :param tree_saps: A dictionary of gene_codes as keys and TreeSap objects as values
-    :param nuc_orfs_formatted_dict:
+    :param nuc_orfs_formatted_dict: Dictionary or FastaIndex of the formatted nucleotide ORF sequences
     :param orf_nuc_fasta:
     :return: nothing
     """
@@ -2995,7 +3526,7 @@ def update_func_tree_workflow(args, ref_marker: MarkerBuild):
     hmm_length = get_hmm_length(ref_hmm_file)
     unaligned_ref_seqs = get_reference_sequence_dict(args, update_tree)
     # read_species_translation_files expects the entire marker_build_dict, so we're making a mock one
-    ref_organism_lineage_info = read_species_translation_files(args, {ref_marker.denominator: ref_marker})
+    ref_organism_lineage_info = read_species_translation_files(args, {ref_marker.denominator: ref_marker})[0]
 
     # Set up the output directories
     time_of_run = strftime("%d_%b_%Y_%H_%M", gmtime())
@@ -3246,22 +3777,7 @@ def lowest_confident_taxonomy(lct, depth):
     return confident_assignment
 
 
-def enumerate_taxonomic_lineages(lineage_list):
-    rank = 1
-    taxonomic_counts = dict()
-    while rank < 9:
-        for lineage in lineage_list:
-            if len(lineage) < rank:
-                continue
-            taxonomy = "; ".join(lineage[:rank])
-            if taxonomy not in taxonomic_counts:
-                taxonomic_counts[taxonomy] = 0
-            taxonomic_counts[taxonomy] += 1
-        rank += 1
-    return taxonomic_counts
-
-
-def filter_placements(args, tree_saps, marker_build_dict, unclassified_counts):
+def filter_placements(args, tree_saps, marker_build_dict, unclassified_counts, reference_bundle=None):
     """
     Determines the total distance of each placement from its branch point on the tree
     and removes the placement if the distance is deemed too great
@@ -3270,14 +3786,22 @@ def filter_placements(args, tree_saps, marker_build_dict, unclassified_counts):
     :param tree_saps: A dictionary containing TreeProtein objects
     :param marker_build_dict: A dictionary of MarkerBuild objects (used here for lowest_confident_rank)
     :param unclassified_counts: A dictionary tracking the number of putative markers that were not classified
+    :param reference_bundle: A ReferenceBundle to read the tree distance indices from, if one was loaded
     :return:
     """
     for denominator in tree_saps:
-        tree = Tree(os.sep.join([args.treesapp, "data", "tree_data", marker_build_dict[denominator].cog + "_tree.txt"]))
+        tree_index = None
+        if reference_bundle:
+            tree_index = reference_bundle.tree_distance_index(denominator)
+        if tree_index is None:
+            tree_data_prefix = os.sep.join([args.treesapp, "data", "tree_data", marker_build_dict[denominator].cog])
+            tree_index = load_tree_distance_index(tree_data_prefix + "_tree.txt",
+                                                  tree_data_prefix + "_tree_index.npz")
+        # max_dist_threshold equals the maximum path length from root to tip in its clade
+        # Too permissive of a threshold, but good for first pass
+        max_dist_threshold = tree_index.farthest_leaf_distance()
         distant_seqs = list()
         for tree_sap in tree_saps[denominator]:
-            # max_dist_threshold equals the maximum path length from root to tip in its clade
-            max_dist_threshold = tree.get_farthest_leaf()[1]  # Too permissive of a threshold, but good for first pass
             if tree_sap.name not in unclassified_counts.keys():
                 unclassified_counts[tree_sap.name] = 0
             if not tree_sap.placements:
@@ -3287,7 +3811,7 @@ def filter_placements(args, tree_saps, marker_build_dict, unclassified_counts):
                                 tree_sap.summarize())
                 tree_sap.classified = False
                 continue
-            elif tree_sap.placements[0] == '{}':
+            elif not tree_sap.placements[0].placements:
                 unclassified_counts[tree_sap.name] += 1
                 tree_sap.classified = False
                 continue
@@ -3298,13 +3822,12 @@ def filter_placements(args, tree_saps, marker_build_dict, unclassified_counts):
             leaf_children = tree_sap.node_map[int(tree_sap.inode)]
             # Find the distance away from this edge's bifurcation (if internal) or tip (if leaf)
             if len(leaf_children) > 1:
-                # We need to find the LCA in the Tree instance to find the distances to tips for ete3
-                parent = tree.get_common_ancestor(leaf_children)
-                tip_distances = parent_to_tip_distances(parent, leaf_children)
+                # We need to find the LCA in the reference tree to find the distances to tips
+                leaf_ids = [tree_index.leaf(leaf) for leaf in leaf_children]
+                parent = tree_index.lca(leaf_ids)
+                tip_distances = tree_index.distances_to_ancestor(parent, leaf_ids).tolist()
             else:
-                tree_leaf = tree.get_leaves_by_name(leaf_children[0])[0]
-                sister = tree_leaf.get_sisters()[0]
-                parent = tree_leaf.get_common_ancestor(sister)
+                parent = int(tree_index.parents[tree_index.leaf(leaf_children[0])])
                 tip_distances = [0.0]
 
             tree_sap.avg_evo_dist = round(distal_length + pendant_length + (sum(tip_distances) / len(tip_distances)), 4)
@@ -3320,12 +3843,9 @@ def filter_placements(args, tree_saps, marker_build_dict, unclassified_counts):
                 continue
 
             # Estimate the branch lengths of the clade to factor heterogeneous substitution rates
-            ancestor = find_cluster(parent)
-            clade_tip_distances = list()
-            for leaf in ancestor.get_leaf_names():
-                clade_tip_distances.append(ancestor.get_distance(leaf))
+            ancestor = tree_index.find_cluster(parent)
             # If the longest root-to-tip distance from the ancestral node (one-up from LCA) is exceeded, discard
-            if pendant_length > max(clade_tip_distances) * 1.2 and \
+            if pendant_length > tree_index.max_tip_distance(ancestor) * 1.2 and \
                     rank_recommender(pendant_length, marker_build_dict[denominator].pfit) < 0:
                 unclassified_counts[tree_sap.name] += 1
                 distant_seqs.append(tree_sap.contig_name)
@@ -3339,17 +3859,18 @@ def filter_placements(args, tree_saps, marker_build_dict, unclassified_counts):
     return tree_saps
 
 
-def write_tabular_output(args, tree_saps, tree_numbers_translation, marker_build_dict):
+def write_tabular_output(args, tree_saps, tree_numbers_translation, leaf_lineages, taxonomies, marker_build_dict):
     """
 
 
     :param args: Command-line argument object from get_options and check_parser_arguments
     :param tree_saps: A dictionary containing TreeProtein objects
     :param tree_numbers_translation: Dictionary containing taxonomic information for each leaf in the reference tree
+    :param leaf_lineages: Dictionary of each marker's leaf numbers mapped to their cleaned lineage strings
+    :param taxonomies: Dictionary of each marker's TaxonomyTrie
     :param marker_build_dict: A dictionary of MarkerBuild objects (used here for lowest_confident_rank)
     :return:
     """
-    leaf_taxa_map = dict()
     mapping_output = args.output_dir_final + os.sep + "marker_contig_map.tsv"
     sample_name = os.path.basename(args.output)
     if not sample_name:
@@ -3364,21 +3885,20 @@ def write_tabular_output(args, tree_saps, tree_numbers_translation, marker_build
     for denominator in tree_saps:
         # All the leaves for that tree [number, translation, lineage]
         leaves = tree_numbers_translation[denominator]
-        lineage_complete = False
-        lineage_list = list()
+        marker_lineages = leaf_lineages[denominator]
+        taxonomy = taxonomies[denominator]
         # Test if the reference set have lineage information
+        lineage_complete = False
         for leaf in leaves:
-            lineage_list.append(clean_lineage_string(leaf.lineage).split('; '))
             if leaf.complete:
                 lineage_complete = True
-            leaf_taxa_map[leaf.number] = leaf.lineage
-        taxonomic_counts = enumerate_taxonomic_lineages(lineage_list)
+                break
 
         for tree_sap in tree_saps[denominator]:
             if not tree_sap.classified:
                 continue
 
-            tree_sap.lineage_list = children_lineage(leaves, tree_sap.placements[0], tree_sap.node_map)
+            tree_sap.lineage_list = children_lineage(marker_lineages, tree_sap.placements[0], tree_sap.node_map)
 
             # Based on the calculated distance from the leaves, what rank is most appropriate?
             recommended_rank = rank_recommender(tree_sap.avg_evo_dist,
@@ -3396,9 +3916,9 @@ def write_tabular_output(args, tree_saps, tree_numbers_translation, marker_build
                 tree_sap.wtd = 0.0
             if len(tree_sap.lineage_list) > 1:
                 if lineage_complete:
-                    lca = tree_sap.megan_lca()
+                    lca = tree_sap.megan_lca(taxonomy)
                     # algorithm options are "MEGAN", "LCAp", and "LCA*" (default)
-                    tree_sap.lct = lowest_common_taxonomy(tree_sap.lineage_list, lca, taxonomic_counts, "LCA*")
+                    tree_sap.lct = lowest_common_taxonomy(tree_sap.lineage_list, lca, taxonomy, "LCA*")
                     tree_sap.wtd, status = compute_taxonomic_distance(tree_sap.lineage_list, tree_sap.lct)
                     if status > 0:
                         tree_sap.summarize()
@@ -3425,11 +3945,93 @@ def write_tabular_output(args, tree_saps, tree_numbers_translation, marker_build
     return
 
 
-def parse_raxml_output(args, marker_build_dict):
+def parse_marker_jplaces(marker, jplace_files, contig_index, min_likelihood, placement_parser, treesapp_dir):
+    """
+    Parses and classifies the pqueries in all jplace files of a single marker. Intended to be called from worker
+    processes so it returns compact records for each classified query rather than TreeProtein objects.
+
+    :param marker: Name of the marker (e.g. McrA) the jplace files were placed on
+    :param jplace_files: List of the marker's jplace files
+    :param contig_index: Dictionary mapping the numeric query names to the contig names. If provided, the pqueries
+     are renamed and the jplace files rewritten with the contig names.
+    :param min_likelihood: Placements with a likelihood weight ratio below this are removed
+    :param placement_parser: Algorithm for choosing among the remaining placements ('best' or 'lca')
+    :param treesapp_dir: Path to the TreeSAPP directory
+    :return: A tuple of: an ItolJplace holding all the marker's pqueries, the node map of the marker's tree,
+     a list of tuples (name, contig_name, seq_len, inode, lwr, likelihood, pquery) for each classified query,
+     the number of unclassified queries, and an error message (an empty string if no error occurred)
+    """
+    marker_jplace = None
+    node_map = None
+    pquery_records = list()
+    num_unclassified = 0
+    for filename in jplace_files:
+        # Load the JSON placement (jplace) file containing >= 1 pquery into ItolJplace object
+        jplace_data = jplace_parser(filename)
+        if contig_index is not None:
+            for pquery in jplace_data.placements:
+                pquery.names = [contig_index[int(pquery.names[0])]]
+            write_jplace(jplace_data, filename + ".tmp")
+            os.rename(filename + ".tmp", filename)
+        # All pqueries on the same tree share its (cached) node map
+        jplace_data.create_jplace_node_map()
+        node_map = jplace_data.node_map
+        # Demultiplex all pqueries in jplace_data into individual TreeProtein objects
+        tree_placement_queries = demultiplex_pqueries(jplace_data)
+        # Filter the placements, determine the likelihood associated with the harmonized placement
+        for pquery in tree_placement_queries:
+            pquery.name = marker
+            pquery.filter_min_weight_threshold(min_likelihood)
+            if not pquery.classified:
+                num_unclassified += 1
+                logging.debug("A putative " + marker +
+                              " sequence has been unclassified due to low placement likelihood weights. " +
+                              "More info:\n" +
+                              pquery.summarize())
+                continue
+            if re.match(".*_(\d+)_(\d+)$", pquery.contig_name):
+                start, end = re.match(".*_(\d+)_(\d+)$", pquery.contig_name).groups()
+                pquery.seq_len = int(end) - int(start)
+                pquery.contig_name = re.sub(r"_(\d+)_(\d+)$", '', pquery.contig_name)
+            pquery.node_map = node_map
+            if placement_parser == "best":
+                pquery.filter_max_weight_placement()
+            else:
+                pquery.harmonize_placements(treesapp_dir)
+            if pquery.classified and len(pquery.placements) != 1:
+                return None, None, None, 0, "Number of JPlace pqueries is " + str(len(pquery.placements)) +\
+                       " when only 1 is expected at this point.\n" + pquery.summarize()
+            pquery_records.append((pquery.name,
+                                   pquery.contig_name,
+                                   pquery.seq_len,
+                                   str(pquery.get_jplace_element("edge_num")),
+                                   float(pquery.get_jplace_element("like_weight_ratio")),
+                                   float(pquery.get_jplace_element("likelihood")),
+                                   pquery.placements[0]))
+
+        if not marker_jplace:
+            marker_jplace = jplace_data
+            marker_jplace.name = marker
+            marker_jplace.node_map = dict()
+        else:
+            # If a JPlace file for that tree has already been parsed, just append the placements
+            marker_jplace.placements = marker_jplace.placements + jplace_data.placements
+
+        # I have decided to not remove the original JPlace files since some may find these useful
+        # os.remove(filename)
+
+    return marker_jplace, node_map, pquery_records, num_unclassified, ""
+
+
+def parse_raxml_output(args, marker_build_dict, numeric_contig_index=None):
     """
+    Parses the jplace files of each marker in a separate process, optionally replacing the numeric query names
+    with the original contig names (as assigned by extract_hmm_matches) in the same pass.
 
     :param args: Command-line argument object from get_options and check_parser_arguments
     :param marker_build_dict:
+    :param numeric_contig_index: Dictionary indexed by marker names of the numeric query names mapped to contig names.
+     None if the jplace files already use the contig names (e.g. with --reclassify).
     :return: 
     """
 
@@ -3444,57 +4046,53 @@ def parse_raxml_output(args, marker_build_dict):
     unclassified_counts = dict()  # A dictionary tracking the number of putative markers that were not classified
     # Use the jplace files to guide which markers iTOL outputs should be created for
     classified_seqs = 0
+    marker_results = dict()
+
+    def collect_marker(result, denom):
+        marker_results[denom] = result
+
+    pool = Pool(processes=max(1, min(args.num_threads, len(jplace_collection))))
     for denominator in jplace_collection:
         marker = marker_build_dict[denominator].cog
+        if numeric_contig_index is not None:
+            contig_index = numeric_contig_index[marker]
+        else:
+            contig_index = None
+        pool.apply_async(func=parse_marker_jplaces,
+                         args=(marker, jplace_collection[denominator], contig_index,
+                               args.min_likelihood, args.placement_parser, args.treesapp),
+                         callback=lambda result, denom=denominator: collect_marker(result, denom))
+    pool.close()
+    pool.join()
+
+    for denominator in jplace_collection:
+        marker = marker_build_dict[denominator].cog
+        if denominator not in marker_results:
+            logging.error("Parsing the jplace files of " + marker + " did not complete.\n")
+            sys.exit(3)
+        marker_jplace, node_map, pquery_records, num_unclassified, error_message = marker_results[denominator]
+        if error_message:
+            logging.error(error_message)
+            sys.exit(3)
         if denominator not in tree_saps:
             tree_saps[denominator] = list()
         if marker not in unclassified_counts.keys():
             unclassified_counts[marker] = 0
-        for filename in jplace_collection[denominator]:
-            # Load the JSON placement (jplace) file containing >= 1 pquery into ItolJplace object
-            jplace_data = jplace_parser(filename)
-            # Demultiplex all pqueries in jplace_data into individual TreeProtein objects
-            tree_placement_queries = demultiplex_pqueries(jplace_data)
-            # Filter the placements, determine the likelihood associated with the harmonized placement
-            for pquery in tree_placement_queries:
-                pquery.name = marker
-                pquery.filter_min_weight_threshold(args.min_likelihood)
-                if not pquery.classified:
-                    unclassified_counts[marker] += 1
-                    logging.debug("A putative " + marker +
-                                  " sequence has been unclassified due to low placement likelihood weights. " +
-                                  "More info:\n" +
-                                  pquery.summarize())
-                    continue
-                if re.match(".*_(\d+)_(\d+)$", pquery.contig_name):
-                    start, end = re.match(".*_(\d+)_(\d+)$", pquery.contig_name).groups()
-                    pquery.seq_len = int(end) - int(start)
-                    pquery.contig_name = re.sub(r"_(\d+)_(\d+)$", '', pquery.contig_name)
-                pquery.create_jplace_node_map()
-                if args.placement_parser == "best":
-                    pquery.filter_max_weight_placement()
-                else:
-                    pquery.harmonize_placements(args.treesapp)
-                if pquery.classified and len(pquery.placements) != 1:
-                    logging.error("Number of JPlace pqueries is " + str(len(pquery.placements)) +
-                                  " when only 1 is expected at this point.\n" +
-                                  pquery.summarize())
-                    sys.exit(3)
-                pquery.inode = str(pquery.get_jplace_element("edge_num"))
-                pquery.lwr = float(pquery.get_jplace_element("like_weight_ratio"))
-                pquery.likelihood = float(pquery.get_jplace_element("likelihood"))
-                tree_saps[denominator].append(pquery)
-                classified_seqs += 1
-
-            if marker not in itol_data:
-                itol_data[marker] = jplace_data
-                itol_data[marker].name = marker
-            else:
-                # If a JPlace file for that tree has already been parsed, just append the placements
-                itol_data[marker].placements = itol_data[marker].placements + jplace_data.placements
-
-            # I have decided to not remove the original JPlace files since some may find these useful
-            # os.remove(filename)
+        unclassified_counts[marker] += num_unclassified
+        for name, contig_name, seq_len, inode, lwr, likelihood, pquery in pquery_records:
+            tree_sap = TreeProtein()
+            tree_sap.transfer(marker_jplace)
+            tree_sap.placements = [pquery]
+            tree_sap.name = name
+            tree_sap.contig_name = contig_name
+            tree_sap.seq_len = seq_len
+            tree_sap.node_map = node_map
+            tree_sap.inode = inode
+            tree_sap.lwr = lwr
+            tree_sap.likelihood = likelihood
+            tree_saps[denominator].append(tree_sap)
+            classified_seqs += 1
+        itol_data[marker] = marker_jplace
 
     logging.info("done.\n")
 
@@ -3573,9 +4171,14 @@ def main(argv):
     args = check_parser_arguments(args)
     args = check_previous_output(args)
 
-    marker_build_dict = parse_ref_build_params(args)
-    marker_build_dict = parse_cog_list(args, marker_build_dict)
-    tree_numbers_translation = read_species_translation_files(args, marker_build_dict)
+    reference_bundle = load_reference_bundle(args)
+    if reference_bundle:
+        marker_build_dict = reference_bundle.marker_build_dict(args)
+        tree_numbers_translation, leaf_lineages, taxonomies = reference_bundle.leaf_taxonomies(marker_build_dict)
+    else:
+        marker_build_dict = parse_ref_build_params(args)
+        marker_build_dict = parse_cog_list(args, marker_build_dict)
+        tree_numbers_translation, leaf_lineages, taxonomies = read_species_translation_files(args, marker_build_dict)
     if args.check_trees:
         validate_inputs(args, marker_build_dict)
     if args.skip == 'n':
@@ -3583,26 +4186,35 @@ def main(argv):
         if args.molecule == "dna":
             # args.fasta_input is set to the predicted ORF protein sequences
             args = predict_orfs(args)
-        logging.info("Formatting " + args.fasta_input + " for pipeline... ")
-        formatted_fasta_dict = format_read_fasta(args.fasta_input, "prot", args.output)
-        logging.info("done.\n")
-
-        logging.info("\tTreeSAPP will analyze the " + str(len(formatted_fasta_dict)) + " sequences found in input.\n")
         if re.match(r'\A.*\/(.*)', args.fasta_input):
             input_multi_fasta = os.path.basename(args.fasta_input)
         else:
             input_multi_fasta = args.fasta_input
         args.formatted_input_file = args.output_dir_var + input_multi_fasta + "_formatted.fasta"
-        formatted_fasta_files = write_new_fasta(formatted_fasta_dict, args.formatted_input_file)
-        ref_alignment_dimensions = get_alignment_dims(args, marker_build_dict)
+        logging.info("Formatting " + args.fasta_input + " for pipeline... ")
+        formatted_fasta_index = format_fasta_to_file(args.fasta_input, "prot", args.output,
+                                                       args.formatted_input_file)
+        logging.info("done.\n")
+
+        logging.info("\tTreeSAPP will analyze the " + str(len(formatted_fasta_index)) +
+                     " sequences found in input.\n")
+        if reference_bundle:
+            ref_alignment_dimensions = reference_bundle.alignment_dims(marker_build_dict)
+        else:
+            ref_alignment_dimensions = get_alignment_dims(args, marker_build_dict)
 
         # STAGE 3: Run hmmsearch on the query sequences to search for marker homologs
         hmm_domtbl_files = hmmsearch_orfs(args, marker_build_dict)
         hmm_matches = parse_domain_tables(args, hmm_domtbl_files)
-        homolog_seq_files, numeric_contig_index = extract_hmm_matches(args, hmm_matches, formatted_fasta_dict)
+        homolog_seq_files, numeric_contig_index = extract_hmm_matches(args, hmm_matches, formatted_fasta_index)
+        placement_batches = dict()
+        if args.placement_mem > 0:
+            homolog_seq_files, placement_batches = batch_placement_queries(args, homolog_seq_files,
+                                                                           marker_build_dict,
+                                                                           ref_alignment_dimensions)
 
         # STAGE 4: Run hmmalign or PaPaRa, and optionally BMGE, to produce the MSAs required to for the ML estimations
-        create_ref_phy_files(args, homolog_seq_files, marker_build_dict, ref_alignment_dimensions)
+        create_ref_phy_files(args, homolog_seq_files, marker_build_dict)
         concatenated_msa_files = multiple_alignments(args, homolog_seq_files, marker_build_dict)
         file_types = set()
         for mc in concatenated_msa_files:
@@ -3636,10 +4248,14 @@ def main(argv):
         delete_files(args, 3)
 
         # STAGE 5: Run RAxML to compute the ML estimations
-        start_raxml(args, phy_files, marker_build_dict)
-        sub_indices_for_seq_names_jplace(args, numeric_contig_index, marker_build_dict)
-    tree_saps, itol_data, unclassified_counts = parse_raxml_output(args, marker_build_dict)
-    tree_saps = filter_placements(args, tree_saps, marker_build_dict, unclassified_counts)
+        start_raxml(args, phy_files, marker_build_dict, ref_alignment_dimensions)
+        if placement_batches:
+            split_batched_jplaces(args, placement_batches)
+    else:
+        # The jplace files of the previous run already use the contig names
+        numeric_contig_index = None
+    tree_saps, itol_data, unclassified_counts = parse_raxml_output(args, marker_build_dict, numeric_contig_index)
+    tree_saps = filter_placements(args, tree_saps, marker_build_dict, unclassified_counts, reference_bundle)
 
     abundance_file = None
     if args.molecule == "dna":
@@ -3648,9 +4264,18 @@ def main(argv):
         if not os.path.isfile(orf_nuc_fasta):
             logging.info("Creating nucleotide FASTA file of classified sequences '" + orf_nuc_fasta + "'... ")
             genome_nuc_genes_file = args.output_dir_final + sample_name + "_ORFs.fna"
+            formatted_nuc_genes_file = args.output_dir_var + os.path.basename(genome_nuc_genes_file) +\
+                "_formatted.fasta"
             if os.path.isfile(genome_nuc_genes_file):
-                nuc_orfs_formatted_dict = format_read_fasta(genome_nuc_genes_file, 'dna', args.output)
-                write_classified_nuc_sequences(tree_saps, nuc_orfs_formatted_dict, orf_nuc_fasta)
+                if os.path.isfile(formatted_nuc_genes_file + ".fai") and \
+                        os.path.getmtime(formatted_nuc_genes_file + ".fai") >= os.path.getmtime(genome_nuc_genes_file):
+                    # Re-use the index from a previous run (e.g. with --reclassify) rather than formatting again
+                    nuc_orfs_index = FastaIndex(formatted_nuc_genes_file)
+                else:
+                    nuc_orfs_index = format_fasta_to_file(genome_nuc_genes_file, 'dna', args.output,
+                                                          formatted_nuc_genes_file)
+                write_classified_nuc_sequences(tree_saps, nuc_orfs_index, orf_nuc_fasta)
+                nuc_orfs_index.close()
                 logging.info("done.\n")
             else:
                 logging.info("failed.\nWARNING: Unable to read '" + genome_nuc_genes_file + "'.\n" +
@@ -3662,7 +4287,7 @@ def main(argv):
     else:
         pass
 
-    write_tabular_output(args, tree_saps, tree_numbers_translation, marker_build_dict)
+    write_tabular_output(args, tree_saps, tree_numbers_translation, leaf_lineages, taxonomies, marker_build_dict)
     produce_itol_inputs(args, tree_saps, marker_build_dict, itol_data, abundance_file)
     delete_files(args, 4)
 
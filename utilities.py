@@ -3,8 +3,11 @@ __author__ = 'Connor Morgan-Lang'
 import os
 import re
 import sys
+import shutil
+import operator
 import subprocess
 import logging
+import numpy as np
 from external_command_interface import launch_write_command
 
 
@@ -147,6 +150,63 @@ def available_cpu_count():
     logging.error('Can not determine number of CPUs on this system')
 
 
+def split_threads(num_threads, num_jobs, max_job_threads=4):
+    """
+    Divides num_threads among concurrent jobs for tools that scale poorly beyond a few threads each
+
+    :param num_threads: The total number of threads available
+    :param num_jobs: The number of jobs that need to be run
+    :param max_job_threads: The number of threads beyond which a single job no longer benefits from more
+    :return: The number of jobs to run concurrently and the number of threads each should use
+    """
+    num_threads = max(1, int(num_threads))
+    parallel_jobs = max(1, min(num_jobs, -(-num_threads // max_job_threads)))
+    job_threads = max(1, num_threads // parallel_jobs)
+    return parallel_jobs, job_threads
+
+
+def allocate_job_threads(job_costs, num_threads, job_max_threads=None, min_threads=1):
+    """
+    Divides num_threads among jobs in proportion to their estimated costs, so the largest jobs receive more threads
+    while the small ones are given min_threads each and can be run concurrently
+
+    :param job_costs: List of the estimated relative costs of each job
+    :param num_threads: The total number of threads available
+    :param job_max_threads: Optional list of the number of threads beyond which each job no longer benefits from more
+    :param min_threads: The fewest threads a job can run with, even if this exceeds num_threads
+    :return: List of the number of threads each job should use, in the same order as job_costs
+    """
+    num_threads = max(1, int(num_threads))
+    total_cost = sum(job_costs)
+    job_threads = list()
+    for i in range(len(job_costs)):
+        if total_cost > 0:
+            threads = int(round(num_threads * job_costs[i] / total_cost))
+        else:
+            threads = min_threads
+        if job_max_threads:
+            threads = min(threads, job_max_threads[i])
+        job_threads.append(max(min_threads, min(num_threads, threads)))
+    return job_threads
+
+
+def estimate_raxml_memory(num_taxa, num_columns, molecule):
+    """
+    A rough estimate of the memory RAxML needs for its likelihood vectors when placing sequences on a tree,
+    assuming four GAMMA rate categories and double-precision values
+
+    :param num_taxa: The number of sequences in the alignment (reference and query)
+    :param num_columns: The number of columns in the multiple alignment
+    :param molecule: Molecule type of the sequences ['prot', 'dna', 'rrna']
+    :return: The estimated number of bytes
+    """
+    if molecule == "prot":
+        num_states = 20
+    else:
+        num_states = 4
+    return num_taxa * num_columns * num_states * 4 * 8
+
+
 def find_executables(args):
     """
     Finds the executables in a user's path to alleviate the requirement of a sub_binaries directory
@@ -160,6 +220,9 @@ def find_executables(args):
     if hasattr(args, "rpkm") and args.rpkm:
         dependencies += ["bwa", "rpkm"]
 
+    if hasattr(args, "hmm_db") and args.hmm_db:
+        dependencies += ["hmmpress", "hmmscan"]
+
     if hasattr(args, "update_tree"):
         if args.update_tree:
             dependencies += ["usearch", "blastn", "blastp", "makeblastdb", "mafft"]
@@ -407,6 +470,31 @@ def annotate_internal_nodes(args, internal_node_map, clusters):
     return annotated_clade_members, leaves_in_clusters
 
 
+def concatenate_files(input_files, output_file):
+    """
+    Concatenates the input files, in the order provided, into output_file
+
+    :param input_files: List of paths to the files to be concatenated
+    :param output_file: Path to the file to write
+    :return: None
+    """
+    try:
+        output_handler = open(output_file, 'wb')
+    except IOError:
+        logging.error("Unable to open " + output_file + " for writing!\n")
+        sys.exit(13)
+    for input_file in input_files:
+        try:
+            input_handler = open(input_file, 'rb')
+        except IOError:
+            logging.error("Unable to open " + input_file + " for reading!\n")
+            sys.exit(13)
+        shutil.copyfileobj(input_handler, output_handler)
+        input_handler.close()
+    output_handler.close()
+    return
+
+
 def reformat_fasta_to_phy(fasta_dict):
     phy_dict = dict()
     for seq_name in fasta_dict:
@@ -421,53 +509,105 @@ def reformat_fasta_to_phy(fasta_dict):
     return phy_dict
 
 
-def write_phy_file(phy_output_file: str, phy_dict: dict, alignment_dims=None):
+def interleave_phylip_blocks(names: list, sequences: list):
     """
-    Writes a Phylip-formatted alignment file
+    Generator for the interleaved blocks of a Phylip alignment, as written by write_phy_file: 50 columns per block
+    split into groups of 10, prefixed by the (padded) sequence names in the first block and 11 spaces afterwards.
+    Sequences shorter than the others are absent from the blocks beyond their length.
+    When the sequences are all the same length and the names all 11 characters, the blocks are formatted with numpy
+    rather than slicing every group of every sequence.
+    :param names: List of sequence names, padded to the width of the name column
+    :param sequences: List of the aligned sequences, in the same order as names
+    :return: Strings of each block's lines, each followed by a blank line
+    """
+    seq_lengths = [len(sequence) for sequence in sequences]
+    max_length = max(seq_lengths, default=0)
+    residues = None
+    if min(seq_lengths, default=0) == max_length and set(len(name) for name in names) == {11}:
+        try:
+            residues = np.frombuffer("".join(sequences).encode("ascii"), dtype=np.uint8).reshape(len(sequences), -1)
+            name_column = np.frombuffer("".join(names).encode("ascii"), dtype=np.uint8).reshape(len(names), 11)
+        except UnicodeEncodeError:
+            residues = None
+
+    if residues is not None:
+        for start in range(0, max_length, 50):
+            width = min(50, max_length - start)
+            num_groups = (width + 9) // 10
+            # Lay each group of 10 residues out in 11 columns, the last being the space separating it from the next
+            groups = np.full((len(sequences), num_groups, 11), ord(' '), dtype=np.uint8)
+            block = np.full((len(sequences), num_groups*10), ord(' '), dtype=np.uint8)
+            block[:, :width] = residues[:, start:start+width]
+            groups[:, :, :10] = block.reshape(len(sequences), num_groups, 10)
+            lines = np.full((len(sequences), 11 + width + num_groups), ord(' '), dtype=np.uint8)
+            if start == 0:
+                lines[:, :11] = name_column
+            lines[:, 11:-1] = groups.reshape(len(sequences), num_groups*11)[:, :width + num_groups - 1]
+            lines[:, -1] = ord('\n')
+            yield lines.tobytes().decode("ascii") + "\n"
+        return
+
+    # The columns of block n are grouped_seq[55*n:55*n+54]: 50 residues plus the 4 spaces between its groups of 10
+    groups = [slice(i, i+10) for i in range(0, max_length, 10)]
+    grouped_seqs = list()
+    for sequence in sequences:
+        grouped_seqs.append(' '.join(map(sequence.__getitem__, groups[:(len(sequence) + 9) // 10])))
+    for start in range(0, max_length, 50):
+        block_seqs = [grouped_seqs[i] for i in range(len(sequences)) if seq_lengths[i] > start]
+        if start == 0:
+            prefixes = names
+        else:
+            prefixes = [11*' ']*len(block_seqs)
+        offset = start // 50 * 55
+        yield '\n'.join(map(operator.add, prefixes, map(operator.itemgetter(slice(offset, offset+54)),
+                                                          block_seqs))) + "\n\n"
+
+
+def write_phy_file(phy_output_file: str, aligned_seqs: dict, alignment_dims=None):
+    """
+    Writes a Phylip-formatted alignment file, interleaved in blocks of 50 columns that are split into groups of 10.
     PaPaRa is EXTREMELY particular about the input of its Phylip file. Don't mess.
+    Sequence names must be integers (e.g. leaf node numbers) and are written in numerical order, with 'X' written as '-'.
+    The blocks are formatted by interleave_phylip_blocks and written to the (buffered) file one at a time.
     :param phy_output_file: File path to write the Phylip file
-    :param phy_dict: Dictionary of sequences to write
+    :param aligned_seqs: Dictionary of aligned sequences indexed by their names
     :param alignment_dims: Tuple containing (num_seqs, alignment_len)
     :return:
     """
+    phy_seqs = dict()
+    for seq_name in aligned_seqs:
+        phy_seqs[int(seq_name)] = aligned_seqs[seq_name].replace('X', '-')
+    # Empty sequences have no blocks so they are neither counted nor written
+    seq_names = [seq_name for seq_name in phy_seqs if phy_seqs[seq_name]]
+    seq_lengths = [len(phy_seqs[seq_name]) for seq_name in seq_names]
+
     if not alignment_dims:
-        seq_chunks = [len(aligned_seq) for aligned_seq in phy_dict.values()]
-        if min(seq_chunks) != max(seq_chunks):
-            logging.error("Inconsistent number of sequences in Phylip dictionary keys.")
-        num_seqs = seq_chunks[0]
-        aligned_seqs = dict()
-        for seq_chunk in phy_dict.keys():
-            for seq_name in phy_dict[seq_chunk].keys():
-                if seq_name not in aligned_seqs:
-                    aligned_seqs[seq_name] = ""
-                aligned_seqs[seq_name] += phy_dict[seq_chunk][seq_name]
-        aligned_seq_lengths = [len(aligned_seqs[aligned_seq]) for aligned_seq in aligned_seqs.keys()]
-        if min(aligned_seq_lengths) != max(aligned_seq_lengths):
-            logging.error("Lengths of aligned sequences are heterogeneous.")
-        alignment_len = aligned_seq_lengths[0]
-        aligned_seqs.clear()
-        seq_chunks.clear()
+        num_seqs = len(seq_names)
+        alignment_len = 0
+        if seq_names:
+            seq_chunks = [(seq_len + 49) // 50 for seq_len in seq_lengths]
+            if min(seq_chunks) != max(seq_chunks):
+                logging.error("Inconsistent number of sequences in Phylip dictionary keys.")
+            if min(seq_lengths) != max(seq_lengths):
+                logging.error("Lengths of aligned sequences are heterogeneous.")
+            alignment_len = seq_lengths[0]
     else:
         num_seqs, alignment_len = alignment_dims
 
-    with open(phy_output_file, 'w') as phy_output:
-        phy_string = ' ' + str(num_seqs) + ' ' + str(alignment_len) + '\n'
-        for count in sorted(phy_dict.keys(), key=int):
-            for seq_name in sorted(phy_dict[count].keys()):
-                sequence_part = re.sub('X', '-', phy_dict[count][seq_name])
-                if count == 0:
-                    phy_string += str(seq_name)
-                    length = len(str(seq_name))
-                    c = length
-                    while c < 11:
-                        phy_string += ' '
-                        c += 1
-                else:
-                    phy_string += 11*' '
-                phy_string += ' '.join(re.findall(r'.{1,10}', sequence_part)) + '\n'
-            phy_string += "\n"
-
-        phy_output.write(phy_string)
+    seq_names.sort()
+    sequences = [phy_seqs[seq_name] for seq_name in seq_names]
+    names = [str(seq_name).ljust(11) for seq_name in seq_names]
+
+    try:
+        phy_output = open(phy_output_file, 'w')
+    except IOError:
+        logging.error("Unable to open " + phy_output_file + " for writing!\n")
+        sys.exit(13)
+
+    phy_output.write(' ' + str(num_seqs) + ' ' + str(alignment_len) + '\n')
+    for block in interleave_phylip_blocks(names, sequences):
+        phy_output.write(block)
+    phy_output.close()
     return
 
 